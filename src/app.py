@@ -1,15 +1,19 @@
 import streamlit as st
-from config import INDEX_NAME, LLM_MODEL 
+from config import INDEX_NAME, LLM_MODEL, SPOOL_WATCH_ENABLED, SPOOL_DIR, INGEST_JOBS_POLL_SECONDS
 from data.loader import load_json
-from data.processor import process_thread
-from embeddings.generator import create_chunks, get_embeddings
-from embeddings.indexer import update_document_in_index
+from data.catalog import get_catalog, clear_catalog, remove_from_catalog
+from data.watcher import get_spool_watcher
+from data.jobs import get_ingest_queue
+from embeddings.generator import get_embeddings
+from embeddings.indexer import get_pinecone_client
+from embeddings.thread_index import clear_thread_index, remove_threads
+from embeddings.partitions import PartitionedIndex, partition_range, UNDATED_PARTITION
 from rag.retriever import SmartRetriever
+from rag.reranker import get_reranker
 from rag.chain import setup_rag_chain
-import hashlib
+from rag.summaries import clear_thread_summaries, get_summary_store
 import time
 from datetime import datetime
-from pinecone import Pinecone
 from ui.styles import apply_custom_styles, render_sidebar
 from config import INDEX_NAME
 import pandas as pd
@@ -31,17 +35,15 @@ def initialize_session_state():
         st.session_state.messages = []
     if 'processed_threads' not in st.session_state:
         st.session_state.processed_threads = set()
-
-def get_thread_id(thread):
-    """Genera un ID unico per il thread."""
-    thread_key = f"{thread['url']}_{thread['scrape_time']}"
-    return hashlib.md5(thread_key.encode()).hexdigest()
+    if 'conversation' not in st.session_state:
+        st.session_state.conversation = None  # Turno precedente, riusato dai follow-up
 
 def initialize_pinecone():
     """Inizializza connessione a Pinecone."""
     try:
-        pc = Pinecone(api_key=st.secrets["PINECONE_API_KEY"])
-        index = pc.Index(INDEX_NAME)
+        pc = get_pinecone_client(st.secrets["PINECONE_API_KEY"])
+        # Namespace partizionati per periodo: upsert instradati, query in parallelo
+        index = PartitionedIndex(pc.Index(INDEX_NAME))
         
         # Verifica che l'indice contenga dati
         stats = index.describe_index_stats()
@@ -53,33 +55,6 @@ def initialize_pinecone():
         st.error(f"Errore connessione Pinecone: {str(e)}")
         return None
 
-def process_and_index_thread(thread, embeddings, index):
-    """Processa e indicizza un thread."""
-    thread_id = get_thread_id(thread)
-    
-    try:
-        texts = process_thread(thread)
-        chunks = create_chunks(texts)
-        
-        for i, chunk in enumerate(chunks):
-            chunk_id = f"{thread_id}_{i}"
-            embedding = embeddings.embed_query(chunk.page_content)
-            metadata = {
-                "text": chunk.page_content,
-                "thread_id": thread_id,
-                "thread_title": thread['title'],
-                "url": thread['url'],
-                "timestamp": thread['scrape_time'],
-                "chunk_index": i
-            }
-            update_document_in_index(index, chunk_id, embedding, metadata)
-        
-        st.session_state.processed_threads.add(thread_id)
-        return len(chunks)
-    except Exception as e:
-        st.error(f"Errore processamento thread: {str(e)}")
-        return 0
-
 def render_database_cleanup(index):
     """Render database cleanup interface with proper deletion handling"""
     st.warning("⚠️ Danger Zone - Database Maintenance")
@@ -139,12 +114,70 @@ def render_database_cleanup(index):
             try:
                 # Delete all vectors
                 index.delete(delete_all=True)
+                clear_catalog()
+                clear_thread_index()
+                clear_thread_summaries()
+                st.session_state.pop('conversation', None)
+                st.session_state.pop('thread_posts', None)
                 st.success("Database cleared successfully!")
                 time.sleep(1)
                 st.rerun()
             except Exception as e:
                 st.error(f"Error clearing database: {str(e)}")
                 st.error("Full error:", exception=e)
+    
+    render_partition_management(index)
+
+def drop_partition_data(index, name):
+    """Elimina una partizione e i post corrispondenti da catalogo, indice e sintesi dei thread.
+
+    I thread rimasti senza post escono dall'indice dei thread. Per quelli che
+    attraversano più mesi la sintesi viene scartata (le domande di panoramica
+    usano i post rimasti) e sarà ricalcolata alla prossima ingestione del
+    thread. Il loro vettore nell'indice dei thread invece resta quello
+    calcolato con tutti i post finché il thread non viene reingerito: orienta
+    solo la prima fase del retrieval, che poi recupera dall'indice soltanto
+    i post rimasti.
+    """
+    index.drop_partition(name)
+    bounds = partition_range(name) or ((0, 1) if name == UNDATED_PARTITION else None)
+    if bounds is not None:
+        emptied, partial = remove_from_catalog(*bounds)
+        remove_threads(emptied)
+        get_summary_store().remove_many(emptied + partial)
+    st.session_state.pop('conversation', None)
+    st.session_state.pop('thread_posts', None)
+
+def render_partition_management(index):
+    """Elenco delle partizioni temporali con eliminazione (retention)."""
+    if not hasattr(index, "list_partitions"):
+        return
+    try:
+        partitions = index.list_partitions(refresh=True)
+    except Exception as e:
+        st.error(f"Error listing partitions: {str(e)}")
+        return
+    # Il namespace predefinito (dati precedenti al partizionamento) si svuota con "Clear Database"
+    droppable = sorted(name for name in partitions if name)
+    if not droppable:
+        return
+    
+    st.subheader("🗂️ Partizioni")
+    st.dataframe(
+        pd.DataFrame([{"Partizione": name, "Vettori": partitions[name]} for name in droppable]),
+        hide_index=True,
+        use_container_width=True
+    )
+    selected = st.selectbox("Partizione da eliminare", droppable)
+    st.caption("I thread a cavallo di più mesi perdono la sintesi e mantengono il vettore del thread fino alla prossima ingestione.")
+    if st.button("🗑️ Elimina partizione", type="secondary"):
+        try:
+            drop_partition_data(index, selected)
+            st.success(f"Partizione {selected} eliminata")
+            time.sleep(1)
+            st.rerun()
+        except Exception as e:
+            st.error(f"Error dropping partition: {str(e)}")
 
 def fetch_all_documents(index):
     """Fetch all documents from index with proper error handling"""
@@ -238,13 +271,22 @@ def display_chat_interface(index, embeddings):
             st.markdown(prompt)
         
         try:
-            retriever = SmartRetriever(index, embeddings)
+            reranker = get_reranker() if st.session_state.get('use_reranker') else None
+            retriever = SmartRetriever(index, embeddings, reranker=reranker)
             chain = setup_rag_chain(retriever)
             
             with st.chat_message("assistant", avatar="🧚"):
-                with st.spinner("Sto creando..."):
-                    response = chain({"query": prompt})
-                    st.markdown(response["result"])
+                # Lo stato dell'analisi resta sopra, la risposta viene scritta man mano sotto
+                status_area = st.container()
+                answer_placeholder = st.empty()
+                
+                def render_partial_answer(text):
+                    answer_placeholder.markdown(text + "▌")
+                
+                with status_area:
+                    with st.spinner("Sto creando..."):
+                        response = chain({"query": prompt}, on_token=render_partial_answer)
+                answer_placeholder.markdown(response["result"])
             
             st.session_state.messages.append(
                 {"role": "assistant", "content": response["result"]}
@@ -254,8 +296,123 @@ def display_chat_interface(index, embeddings):
     
     st.markdown('</div>', unsafe_allow_html=True)
 
+def load_thread_posts(index, catalog, thread_id, dimension):
+    """Carica e ricompone i post di un singolo thread (solo quando viene aperto)."""
+    results = index.query(
+        vector=[1.0] + [0.0] * (dimension - 1),
+        top_k=10000,
+        filter={"thread_id": thread_id},
+        include_metadata=True
+    )
+    documents = SmartRetriever(index, None, catalog=catalog).collapse_matches(results.matches)
+    
+    posts = []
+    for doc in documents:
+        post_data = parse_post_content(doc.page_content)
+        post_data['author'] = doc.metadata.get('author') or post_data['author']
+        post_data['time'] = doc.metadata.get('post_time') or post_data['time']
+        posts.append(post_data)
+    return posts
+
+def display_catalog_view(index, catalog):
+    """Visualizzazione del database a partire dal catalogo colonnare dei post."""
+    st.header("📊 Database Management")
+    
+    if 'selected_thread' not in st.session_state:
+        st.session_state.selected_thread = None
+    if 'thread_posts' not in st.session_state:
+        st.session_state.thread_posts = {}
+    
+    try:
+        stats = index.describe_index_stats()
+    except Exception as e:
+        st.error(f"Error retrieving database stats: {str(e)}")
+        return
+    
+    thread_stats = catalog.thread_stats()
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Total Documents", stats['total_vector_count'])
+    with col2:
+        st.metric("Total Threads", len(thread_stats))
+    with col3:
+        st.metric("Total Posts", len(catalog))
+    
+    threads_df = pd.DataFrame([{
+        'Thread ID': thread['thread_id'],
+        'Title': thread['title'],
+        'URL': thread['url'],
+        'Total Posts': thread['posts'],
+        'Authors': thread['authors'],
+        'First Post': pd.to_datetime(thread['first_post'], unit='s', utc=True),
+        'Last Post': pd.to_datetime(thread['last_post'], unit='s', utc=True)
+    } for thread in thread_stats])
+    
+    if threads_df.empty:
+        st.info("No documents found in the database")
+        return
+    
+    # Filtri
+    st.subheader("🔍 Filters")
+    col1, col2 = st.columns(2)
+    with col1:
+        title_filter = st.multiselect(
+            "Filter by Title",
+            options=sorted(threads_df['Title'].unique())
+        )
+    
+    filtered_df = threads_df
+    if title_filter:
+        filtered_df = filtered_df[filtered_df['Title'].isin(title_filter)]
+    
+    # Lista thread
+    st.subheader("📋 Thread List")
+    
+    for _, row in filtered_df.sort_values('Last Post', ascending=False).iterrows():
+        thread_id = row['Thread ID']
+        
+        with st.expander(
+            f"🧵 {row['Title']} ({row['Total Posts']} posts, {row['Authors']} authors)",
+            expanded=(st.session_state.selected_thread == thread_id)
+        ):
+            st.markdown(f"🔗 [Thread URL]({row['URL']})")
+            st.caption(f"{row['First Post']:%Y-%m-%d %H:%M} → {row['Last Post']:%Y-%m-%d %H:%M}")
+            
+            if st.session_state.selected_thread == thread_id:
+                st.button("Hide Posts", key=f"hide_{thread_id}", 
+                         on_click=lambda: setattr(st.session_state, 'selected_thread', None))
+                
+                if thread_id not in st.session_state.thread_posts:
+                    with st.spinner("Loading posts..."):
+                        try:
+                            st.session_state.thread_posts[thread_id] = load_thread_posts(
+                                index, catalog, thread_id, stats['dimension']
+                            )
+                        except Exception as e:
+                            st.error(f"Error fetching posts: {str(e)}")
+                            continue
+                
+                for post in st.session_state.thread_posts[thread_id]:
+                    st.markdown(f"""
+                    **Author:** {post['author']}  
+                    **Time:** {post['time']}  
+                    
+                    {format_post_content(post)}
+                    ---
+                    """)
+            else:
+                st.button("Load Posts", key=f"load_{thread_id}", 
+                         on_click=lambda tid=thread_id: setattr(st.session_state, 'selected_thread', tid))
+
 def display_database_view(index):
     """Visualizzazione e gestione del database."""
+    # Se il catalogo è disponibile statistiche e lista thread non richiedono query all'indice
+    catalog = get_catalog()
+    if len(catalog):
+        display_catalog_view(index, catalog)
+        return
+    
     st.header("📊 Database Management")
     
     # Initialize session states
@@ -442,21 +599,62 @@ def format_post_content(post):
 
 
 def process_uploaded_file(uploaded_file, index, embeddings):
-    """Process uploaded JSON file with button in sidebar."""
+    """Mette in coda l'ingestione del file caricato, eseguita in background."""
     if uploaded_file:
         if st.sidebar.button("Process File", key="process_file", use_container_width=True):
-            with st.spinner("Processing file..."):
-                data = load_json(uploaded_file)
-                if data:
-                    progress = st.progress(0)
-                    total_chunks = 0
-                    
-                    for i, thread in enumerate(data):
-                        chunks = process_and_index_thread(thread, embeddings, index)
-                        total_chunks += chunks
-                        progress.progress((i + 1) / len(data))
-                    
-                    st.success(f"Processed {len(data)} threads and created {total_chunks} chunks")
+            data = load_json(uploaded_file)
+            if data:
+                try:
+                    job = get_ingest_queue(index, embeddings).submit(uploaded_file.name, data)
+                    st.session_state.pop('thread_posts', None)
+                    st.sidebar.success(f"File in coda ({len(data)} thread), job {job.job_id}")
+                except Exception as e:
+                    st.sidebar.error(f"Errore accodamento file: {str(e)}")
+
+def render_ingest_jobs() -> bool:
+    """Stato dei job di ingestione del processo, con annullamento; True se ci sono job in attesa o in corso."""
+    ingest_queue = get_ingest_queue()
+    if ingest_queue is None:
+        return False
+    jobs = ingest_queue.list_jobs()
+    if not jobs:
+        return False
+    active = sum(1 for job in jobs if not job.finished)
+    with st.sidebar.expander(f"📥 Ingestione ({active} attivi)", expanded=active > 0):
+        if active:
+            st.caption(f"Aggiornamento automatico ogni {INGEST_JOBS_POLL_SECONDS:.0f}s")
+        for job in jobs[:5]:
+            if job.status == "running":
+                st.progress(job.progress, text=f"{job.filename}: {job.done}/{job.total} thread")
+            else:
+                st.caption(f"{job.filename}: {job.status} — {job.posts} nuovi post, {job.duplicates} duplicati")
+            if not job.finished:
+                if st.button("Annulla", key=f"cancel_job_{job.job_id}", use_container_width=True):
+                    ingest_queue.cancel(job.job_id)
+                    st.rerun()
+            for error in job.errors[-3:]:
+                st.error(error)
+    return active > 0
+
+def render_spool_status():
+    """Stato dell'ingestione continua dalla directory di spool."""
+    watcher = get_spool_watcher()
+    if watcher is None:
+        return
+    metrics = watcher.metrics()
+    st.subheader("📡 Ingestione continua")
+    st.caption(f"Directory: {SPOOL_DIR} — {'attiva' if metrics['running'] else 'ferma'}")
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Ingest lag", f"{metrics['ingest_lag']:.0f}s")
+    with col2:
+        st.metric("Thread", metrics["threads"])
+    with col3:
+        st.metric("Nuovi post", metrics["posts"])
+    with col4:
+        st.metric("In attesa", f"{metrics['pending_files']} file")
+    if metrics["last_error"]:
+        st.warning(f"Ultimo errore ({metrics['errors']} totali): {metrics['last_error']}")
 
 def main():
     # Apply custom styles
@@ -467,6 +665,7 @@ def main():
     
     # Render sidebar and get selected option
     selected, uploaded_file = render_sidebar()
+    jobs_active = False
     
     try:
         index = initialize_pinecone()
@@ -475,8 +674,13 @@ def main():
         
         embeddings = get_embeddings()
         
+        # Watcher dello spool condiviso dal processo, avviato alla prima esecuzione
+        if SPOOL_WATCH_ENABLED:
+            get_spool_watcher(index, embeddings)
+        
         if uploaded_file:
             process_uploaded_file(uploaded_file, index, embeddings)
+        jobs_active = render_ingest_jobs()
         
         if "Chat" in selected:
             st.markdown("## 💬 Chat")
@@ -487,10 +691,16 @@ def main():
             
         else:  # Settings
             st.markdown("## ⚙️ Settings")
+            render_spool_status()
             render_database_cleanup(index)
             
     except Exception as e:
         st.error(f"Application error: {str(e)}")
+    
+    # Con job in attesa o in corso la pagina si aggiorna da sola; si ferma quando sono tutti conclusi
+    if jobs_active:
+        time.sleep(INGEST_JOBS_POLL_SECONDS)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
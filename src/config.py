@@ -7,4 +7,100 @@ EMBEDDING_MODEL = "paraphrase-multilingual-mpnet-base-v2"
 LLM_MODEL = "gpt-3.5-turbo"
 INDEX_NAME = "forum-index"
 CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 200
\ No newline at end of file
+CHUNK_OVERLAP = 200
+EMBEDDING_BATCH_SIZE = 64  # Testi per chiamata al modello durante l'ingestione
+UPSERT_BATCH_SIZE = 100  # Vettori per chiamata upsert a Pinecone
+FETCH_BATCH_SIZE = 100  # Id per chiamata fetch a Pinecone
+MIGRATION_QUERY_TOP_K = 1000  # Chunk letti per query durante la migrazione degli id legacy
+# Retrieval
+RETRIEVER_HIGHLIGHT_MATCHES = False  # Evidenzia nel post lo span del chunk trovato
+RETRIEVER_HIGHLIGHT_MARKERS = ("**", "**")
+
+# Re-ranking
+RERANK_ENABLED = False
+RERANKER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+RERANK_BATCH_SIZE = 32
+RERANK_MAX_CANDIDATES = 200  # Candidati valutati dal cross-encoder
+RERANK_TIME_BUDGET = 2.0  # Secondi
+RERANK_CACHE_SIZE = 20000  # Coppie (query, post) in cache
+RERANK_TOP_N = None  # Se impostato, tiene solo i primi N post riordinati
+
+# Catalogo colonnare dei metadati dei post
+CATALOG_DIR = "data/catalog"
+
+# Retrieval coarse-to-fine per thread
+THREAD_INDEX_DIR = "data/thread_index"
+THREAD_TOP_K = 20  # Thread selezionati nella prima fase
+COARSE_RETRIEVAL_MIN_THREADS = 50  # Sotto questa soglia la ricerca resta piatta
+
+# Conteggio token
+TOKENIZER_MODEL = "gpt-3.5-turbo"
+TOKEN_CACHE_SIZE = 50000  # Righe brevi (intestazioni, etichette) con conteggio in cache LRU
+
+# Rate limiting LLM condiviso dal processo: i limiti devono corrispondere al tier dell'account OpenAI
+LLM_REQUESTS_PER_MINUTE = 3500
+LLM_TOKENS_PER_MINUTE = 160000
+LLM_EXPECTED_COMPLETION_TOKENS = 800  # Risposta prenotata nel bucket; l'uso effettivo è conteggiato a fine chiamata
+LLM_MAX_CONCURRENCY = 10
+LLM_MIN_CONCURRENCY = 1
+LLM_LATENCY_TARGET = 30.0  # Secondi; oltre questa latenza la concorrenza cala
+LLM_RATE_LIMIT_COOLDOWN = 5.0  # Pausa condivisa dopo un 429
+
+# Deadline delle query multi-agente
+QUERY_DEADLINE_SECONDS = 90.0
+SYNTHESIS_RESERVE_SECONDS = 20.0  # Tempo lasciato alla sintesi prima della scadenza
+LIMITER_WAIT_MAX_SECONDS = 90.0  # Proroga massima della deadline per l'attesa sul rate limiter
+HEDGE_LATENCY_FACTOR = 2.0  # Hedge degli agenti oltre 2x la latenza mediana
+HEDGE_MIN_COMPLETED = 2  # Agenti completati necessari per stimare la mediana
+
+# Cache persistente delle risposte LLM
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = "data/llm_cache.sqlite3"
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 10000
+
+# Sintesi dei thread precalcolate dopo l'ingestione
+THREAD_SUMMARIES_ENABLED = False
+THREAD_SUMMARIES_PATH = "data/thread_summaries.json"
+SUMMARY_MAX_TOKENS = 600
+SUMMARY_CONTEXT_TOKENS = 9000
+SUMMARY_RAW_THREADS = 3
+
+# Cascata: risposta rapida con una sola chiamata prima dello swarm
+CASCADE_ENABLED = True
+CASCADE_TOP_POSTS = 20
+CASCADE_CONTEXT_TOKENS = 2500
+CASCADE_CONFIDENCE_THRESHOLD = 70
+
+# Domande di follow-up: riuso del turno precedente della conversazione
+FOLLOW_UP_SIMILARITY = 0.8
+FOLLOW_UP_MARKER_SIMILARITY = 0.4  # Similarità minima per le domande brevi con riferimenti anaforici
+FOLLOW_UP_MAX_WORDS = 12
+FOLLOW_UP_CONTEXT_TOKENS = 6000
+FOLLOW_UP_ANALYSES_TOKENS = 3000
+CONVERSATION_MAX_DOCUMENTS = 500  # Post più rilevanti conservati nel turno per i follow-up
+
+# Retrieval in streaming verso lo swarm
+STREAM_RETRIEVAL_ENABLED = True
+RETRIEVAL_BATCH_THREADS = 5
+STREAM_EMIT_FILL = 0.5
+
+# Partizioni temporali dell'indice (namespace Pinecone)
+PARTITION_GRANULARITY = "month"  # "month", "year" oppure None (namespace unico)
+PARTITION_PREFIX = "posts"
+PARTITION_QUERY_WORKERS = 8  # Query concorrenti sulle partizioni
+PARTITION_REFRESH_SECONDS = 60  # Validità dell'elenco delle partizioni in memoria
+
+# Ingestione continua da directory di spool (file JSON/JSONL del crawler)
+SPOOL_WATCH_ENABLED = False
+SPOOL_DIR = "data/spool"
+SPOOL_STATE_PATH = "data/spool_state.json"  # Offset per file, salvati dopo ogni micro-batch
+SPOOL_POLL_SECONDS = 30
+SPOOL_BATCH_THREADS = 20  # Thread per micro-batch
+SPOOL_SETTLE_SECONDS = 5  # I file JSON modificati da meno tempo sono considerati ancora in scrittura
+
+# Coda dei job di ingestione in background
+INGEST_JOBS_DIR = "data/jobs"  # Stato dei job e file caricati in attesa
+INGEST_JOBS_HISTORY = 20  # Job conclusi conservati nello stato
+INGEST_PROGRESS_SAVE_SECONDS = 2.0  # Intervallo minimo tra i salvataggi dell'avanzamento
+INGEST_JOBS_POLL_SECONDS = 3.0  # Aggiornamento della pagina finché ci sono job attivi
@@ -0,0 +1,399 @@
+import json
+import os
+import shutil
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from config import CATALOG_DIR
+
+logger = logging.getLogger(__name__)
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def to_epoch(post_time: str) -> int:
+    """Converte un timestamp ISO in secondi epoch (UTC se senza fuso)."""
+    try:
+        dt = datetime.fromisoformat(post_time)
+    except (TypeError, ValueError):
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def encode_values(values: Sequence[str], dictionary: List[str]) -> np.ndarray:
+    """Codifica i valori con un dizionario, estendendolo con i valori nuovi."""
+    positions = {value: code for code, value in enumerate(dictionary)}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        code = positions.get(value)
+        if code is None:
+            code = len(dictionary)
+            positions[value] = code
+            dictionary.append(value)
+        codes[i] = code
+    return codes
+
+class PostCatalog:
+    """Catalogo colonnare dei metadati dei post, condiviso da retriever, swarm e UI.
+
+    Ogni colonna è un array NumPy con una riga per post; thread, autori e
+    keyword sono codificati con dizionario. Le keyword sono in formato CSR
+    (``keyword_codes`` + ``keyword_offsets``). ``content_hashes`` è l'hash del
+    testo di ogni post, per riconoscere i post modificati.
+    """
+
+    ARRAYS = (
+        "post_ids", "thread_codes", "author_codes", "post_times",
+        "sentiments", "token_counts", "keyword_codes", "keyword_offsets", "content_hashes"
+    )
+
+    def __init__(self,
+                 post_ids: np.ndarray,
+                 thread_codes: np.ndarray,
+                 author_codes: np.ndarray,
+                 post_times: np.ndarray,
+                 sentiments: np.ndarray,
+                 token_counts: np.ndarray,
+                 keyword_codes: np.ndarray,
+                 keyword_offsets: np.ndarray,
+                 content_hashes: np.ndarray,
+                 threads: List[Dict[str, str]],
+                 authors: List[str],
+                 keywords: List[str]):
+        self.post_ids = post_ids
+        self.thread_codes = thread_codes
+        self.author_codes = author_codes
+        self.post_times = post_times
+        self.sentiments = sentiments
+        self.token_counts = token_counts
+        self.keyword_codes = keyword_codes
+        self.keyword_offsets = keyword_offsets
+        self.content_hashes = content_hashes
+        self.threads = threads
+        self.authors = authors
+        self.keywords = keywords
+        self._row_index = None
+        self._thread_index = None
+
+    def __len__(self) -> int:
+        return len(self.post_ids)
+
+    @classmethod
+    def empty(cls) -> "PostCatalog":
+        return cls(
+            post_ids=np.array([], dtype="<U32"),
+            thread_codes=np.array([], dtype=np.int32),
+            author_codes=np.array([], dtype=np.int32),
+            post_times=np.array([], dtype=np.int64),
+            sentiments=np.array([], dtype=np.float32),
+            token_counts=np.array([], dtype=np.int32),
+            keyword_codes=np.array([], dtype=np.int32),
+            keyword_offsets=np.zeros(1, dtype=np.int64),
+            content_hashes=np.array([], dtype="<U32"),
+            threads=[],
+            authors=[],
+            keywords=[]
+        )
+
+    @property
+    def thread_ids(self) -> List[str]:
+        return [thread["thread_id"] for thread in self.threads]
+
+    @property
+    def row_index(self) -> Dict[str, int]:
+        """Mappa unique_post_id → riga, costruita alla prima richiesta."""
+        if self._row_index is None:
+            self._row_index = {post_id: row for row, post_id in enumerate(self.post_ids.tolist())}
+        return self._row_index
+
+    @property
+    def thread_index(self) -> Dict[str, int]:
+        """Mappa thread_id → codice del thread."""
+        if self._thread_index is None:
+            self._thread_index = {thread_id: code for code, thread_id in enumerate(self.thread_ids)}
+        return self._thread_index
+
+    def merge(self, records: List[Dict]) -> "PostCatalog":
+        """Restituisce un nuovo catalogo con i post aggiunti o sostituiti (per unique_post_id)."""
+        if not records:
+            return self
+
+        # L'ultimo record per ogni post vince
+        unique_records = list({record["unique_post_id"]: record for record in records}.values())
+        new_ids = np.array([record["unique_post_id"] for record in unique_records])
+
+        threads = list(self.threads)
+        thread_lookup = {thread["thread_id"]: code for code, thread in enumerate(threads)}
+        thread_codes = np.empty(len(unique_records), dtype=np.int32)
+        for i, record in enumerate(unique_records):
+            code = thread_lookup.get(record["thread_id"])
+            if code is None:
+                code = len(threads)
+                thread_lookup[record["thread_id"]] = code
+                threads.append({
+                    "thread_id": record["thread_id"],
+                    "title": record.get("thread_title", "Unknown Thread"),
+                    "url": record.get("url", "")
+                })
+            thread_codes[i] = code
+
+        authors = list(self.authors)
+        keywords = list(self.keywords)
+        author_codes = encode_values([record.get("author", "Unknown") for record in unique_records], authors)
+        post_times = np.array([to_epoch(record.get("post_time", "")) for record in unique_records], dtype=np.int64)
+        sentiments = np.array([float(record.get("sentiment") or 0.0) for record in unique_records], dtype=np.float32)
+        token_counts = np.array([int(record.get("token_count") or 0) for record in unique_records], dtype=np.int32)
+        content_hashes = np.array([record.get("content_hash", "") for record in unique_records], dtype="<U32")
+
+        record_keywords = [list(record.get("keywords") or []) for record in unique_records]
+        keyword_lengths = np.array([len(kws) for kws in record_keywords], dtype=np.int64)
+        keyword_codes = encode_values([kw for kws in record_keywords for kw in kws], keywords)
+
+        # Righe esistenti non sostituite dai nuovi record
+        keep = ~np.isin(self.post_ids, new_ids)
+        old_lengths = np.diff(self.keyword_offsets)
+        kept_keyword_codes = self.keyword_codes[np.repeat(keep, old_lengths)]
+
+        lengths = np.concatenate([old_lengths[keep], keyword_lengths])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        return PostCatalog(
+            post_ids=np.concatenate([self.post_ids[keep], new_ids]),
+            thread_codes=np.concatenate([self.thread_codes[keep], thread_codes]),
+            author_codes=np.concatenate([self.author_codes[keep], author_codes]),
+            post_times=np.concatenate([self.post_times[keep], post_times]),
+            sentiments=np.concatenate([self.sentiments[keep], sentiments]),
+            token_counts=np.concatenate([self.token_counts[keep], token_counts]),
+            keyword_codes=np.concatenate([kept_keyword_codes, keyword_codes]).astype(np.int32),
+            keyword_offsets=offsets,
+            content_hashes=np.concatenate([self.content_hashes[keep], content_hashes]),
+            threads=threads,
+            authors=authors,
+            keywords=keywords
+        )
+
+    def without(self, mask: np.ndarray) -> "PostCatalog":
+        """Restituisce un nuovo catalogo senza i post selezionati da ``mask``."""
+        keep = ~mask
+        old_lengths = np.diff(self.keyword_offsets)
+        lengths = old_lengths[keep]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return PostCatalog(
+            post_ids=self.post_ids[keep],
+            thread_codes=self.thread_codes[keep],
+            author_codes=self.author_codes[keep],
+            post_times=self.post_times[keep],
+            sentiments=self.sentiments[keep],
+            token_counts=self.token_counts[keep],
+            keyword_codes=self.keyword_codes[np.repeat(keep, old_lengths)],
+            keyword_offsets=offsets,
+            content_hashes=self.content_hashes[keep],
+            threads=list(self.threads),
+            authors=list(self.authors),
+            keywords=list(self.keywords)
+        )
+
+    def save(self, path: str = CATALOG_DIR):
+        """Salva il catalogo su disco sostituendo atomicamente la versione precedente."""
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        old_path = f"{path}.old-{os.getpid()}"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            for name in self.ARRAYS:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(getattr(self, name)))
+            with open(os.path.join(tmp_path, "dictionaries.json"), "w", encoding="utf-8") as f:
+                json.dump({
+                    "threads": self.threads,
+                    "authors": self.authors,
+                    "keywords": self.keywords
+                }, f, ensure_ascii=False)
+
+            if os.path.exists(path):
+                os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+            logger.info(f"Saved post catalog with {len(self)} posts to {path}")
+        except Exception as e:
+            logger.error(f"Error saving post catalog: {str(e)}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path: str = CATALOG_DIR, mmap: bool = True) -> "PostCatalog":
+        """Carica il catalogo; gli array sono memory-mapped in sola lettura."""
+        if not os.path.exists(os.path.join(path, "dictionaries.json")):
+            return cls.empty()
+
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+            if os.path.exists(os.path.join(path, f"{name}.npy"))
+        }
+        # Cataloghi salvati prima dell'introduzione dei conteggi dei token
+        if "token_counts" not in arrays:
+            arrays["token_counts"] = np.zeros(len(arrays["post_ids"]), dtype=np.int32)
+        # ...e degli hash del contenuto (hash vuoto: post mai confrontato)
+        if "content_hashes" not in arrays:
+            arrays["content_hashes"] = np.full(len(arrays["post_ids"]), "", dtype="<U32")
+        with open(os.path.join(path, "dictionaries.json"), encoding="utf-8") as f:
+            dictionaries = json.load(f)
+
+        catalog = cls(**arrays, **dictionaries)
+        logger.info(f"Loaded post catalog with {len(catalog)} posts from {path}")
+        return catalog
+
+    def rows_for(self, post_ids: Sequence[str]) -> np.ndarray:
+        """Righe dei post richiesti (-1 se assenti dal catalogo)."""
+        row_index = self.row_index
+        return np.array([row_index.get(post_id, -1) for post_id in post_ids], dtype=np.int64)
+
+    def post_times_for(self, post_ids: Sequence[str], fallback_times: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Timestamp epoch dei post; per i post assenti usa ``fallback_times``."""
+        rows = self.rows_for(post_ids)
+        times = np.zeros(len(rows), dtype=np.int64)
+        found = rows >= 0
+        times[found] = self.post_times[rows[found]]
+        if fallback_times is not None:
+            for i in np.flatnonzero(~found):
+                times[i] = to_epoch(fallback_times[i])
+        return times
+
+    def thread_mask(self, thread_id: str) -> np.ndarray:
+        code = self.thread_index.get(thread_id, -1)
+        return self.thread_codes == code
+
+    def thread_posts(self, thread_id: str) -> Dict[str, str]:
+        """Post del thread: unique_post_id → hash del contenuto."""
+        rows = np.flatnonzero(self.thread_mask(thread_id))
+        return dict(zip(self.post_ids[rows].tolist(), self.content_hashes[rows].tolist()))
+
+    def keyword_mask(self, keyword: str) -> np.ndarray:
+        """Maschera dei post che hanno ``keyword`` tra le keyword."""
+        mask = np.zeros(len(self), dtype=bool)
+        code = self.keywords.index(keyword) if keyword in self.keywords else -1
+        positions = np.flatnonzero(self.keyword_codes == code)
+        # Ogni posizione CSR appartiene alla riga il cui intervallo di offset la contiene
+        mask[np.searchsorted(self.keyword_offsets, positions, side="right") - 1] = True
+        return mask
+
+    def filter(self,
+               thread_id: Optional[str] = None,
+               author: Optional[str] = None,
+               start: Optional[int] = None,
+               end: Optional[int] = None,
+               keyword: Optional[str] = None) -> np.ndarray:
+        """Maschera booleana dei post che rispettano i filtri."""
+        mask = np.ones(len(self), dtype=bool)
+        if thread_id is not None:
+            mask &= self.thread_mask(thread_id)
+        if author is not None:
+            code = self.authors.index(author) if author in self.authors else -1
+            mask &= self.author_codes == code
+        if keyword is not None:
+            mask &= self.keyword_mask(keyword)
+        if start is not None:
+            mask &= self.post_times >= start
+        if end is not None:
+            mask &= self.post_times < end
+        return mask
+
+    def thread_stats(self) -> List[Dict]:
+        """Statistiche per thread (post, autori, primo e ultimo post) calcolate in modo vettoriale."""
+        num_threads = len(self.threads)
+        if not len(self):
+            return []
+
+        post_counts = np.bincount(self.thread_codes, minlength=num_threads)
+        first_times = np.full(num_threads, np.iinfo(np.int64).max, dtype=np.int64)
+        last_times = np.zeros(num_threads, dtype=np.int64)
+        np.minimum.at(first_times, self.thread_codes, self.post_times)
+        np.maximum.at(last_times, self.thread_codes, self.post_times)
+
+        # Autori distinti per thread: coppie (thread, autore) uniche
+        pairs = np.unique(self.thread_codes.astype(np.int64) * max(len(self.authors), 1) + self.author_codes)
+        author_counts = np.bincount(pairs // max(len(self.authors), 1), minlength=num_threads)
+
+        stats = []
+        for code in np.flatnonzero(post_counts):
+            thread = self.threads[code]
+            stats.append({
+                "thread_id": thread["thread_id"],
+                "title": thread["title"],
+                "url": thread["url"],
+                "posts": int(post_counts[code]),
+                "authors": int(author_counts[code]),
+                "first_post": int(first_times[code]),
+                "last_post": int(last_times[code])
+            })
+        return stats
+
+def _load_catalog(path: str) -> PostCatalog:
+    """Carica il catalogo condiviso; va chiamata tenendo ``_catalog_lock``."""
+    global _catalog
+    if _catalog is None:
+        try:
+            _catalog = PostCatalog.load(path)
+        except Exception as e:
+            logger.error(f"Error loading post catalog: {str(e)}")
+            _catalog = PostCatalog.empty()
+    return _catalog
+
+def get_catalog(path: str = CATALOG_DIR) -> PostCatalog:
+    """Restituisce il catalogo del processo, caricandolo da disco al primo accesso."""
+    with _catalog_lock:
+        return _load_catalog(path)
+
+def update_catalog(records: List[Dict], path: str = CATALOG_DIR) -> PostCatalog:
+    """Aggiunge i post indicizzati al catalogo, lo salva e lo ricarica memory-mapped."""
+    global _catalog
+    with _catalog_lock:
+        _load_catalog(path).merge(records).save(path)
+        _catalog = PostCatalog.load(path)
+        return _catalog
+
+def remove_from_catalog(start: Optional[int], end: Optional[int],
+                        path: str = CATALOG_DIR) -> Tuple[List[str], List[str]]:
+    """Rimuove i post con timestamp in [start, end) e salva il catalogo.
+
+    Restituisce i thread rimasti senza post e quelli che hanno perso solo
+    una parte dei post.
+    """
+    global _catalog
+    with _catalog_lock:
+        catalog = _load_catalog(path)
+        mask = catalog.filter(start=start, end=end)
+        if not mask.any():
+            return [], []
+        affected = np.unique(catalog.thread_codes[mask])
+        catalog = catalog.without(mask)
+        remaining = np.bincount(catalog.thread_codes, minlength=len(catalog.threads))
+        catalog.save(path)
+        _catalog = PostCatalog.load(path)
+        logger.info(f"Removed {int(mask.sum())} posts from the catalog")
+        emptied = [catalog.threads[code]["thread_id"] for code in affected if remaining[code] == 0]
+        partial = [catalog.threads[code]["thread_id"] for code in affected if remaining[code] > 0]
+        return emptied, partial
+
+def replace_threads_in_catalog(thread_ids: List[str], records: List[Dict],
+                               path: str = CATALOG_DIR) -> PostCatalog:
+    """Sostituisce i post dei thread indicati con ``records`` e salva il catalogo."""
+    global _catalog
+    with _catalog_lock:
+        catalog = _load_catalog(path)
+        codes = [catalog.thread_index[thread_id] for thread_id in thread_ids if thread_id in catalog.thread_index]
+        catalog.without(np.isin(catalog.thread_codes, codes)).merge(records).save(path)
+        _catalog = PostCatalog.load(path)
+        return _catalog
+
+def clear_catalog(path: str = CATALOG_DIR):
+    """Elimina il catalogo (da usare quando si svuota l'indice)."""
+    global _catalog
+    with _catalog_lock:
+        shutil.rmtree(path, ignore_errors=True)
+        _catalog = PostCatalog.empty()
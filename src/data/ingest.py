@@ -0,0 +1,235 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+import numpy as np
+from config import THREAD_SUMMARIES_ENABLED
+from data.processor import process_thread_posts, get_thread_id, parse_post_text
+from data.catalog import get_catalog, update_catalog
+from embeddings.generator import create_chunks
+from data.migration import migrate_legacy_ids
+from embeddings.indexer import upsert_documents, fetch_post_records
+from embeddings.thread_index import compute_thread_vector, get_thread_index, update_thread_index
+from rag.tokens import count_text_tokens
+from rag.runtime import get_async_runner
+from rag.summaries import ThreadSummarizer
+
+logger = logging.getLogger(__name__)
+
+# Un'ingestione alla volta nel processo: upload, job e watcher condividono modello e indice
+_ingest_lock = threading.Lock()
+
+def log_summary_result(future):
+    """Registra l'esito dell'aggiornamento in background delle sintesi."""
+    try:
+        logger.info(f"Background thread summaries: {future.result()} updated")
+    except Exception as e:
+        logger.error(f"Background thread summaries failed: {str(e)}")
+
+@dataclass
+class IngestResult:
+    """Esito di un'ingestione: thread e post indicizzati (di cui modificati), duplicati saltati, errori."""
+    threads: int = 0
+    posts: int = 0
+    updated: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    stopped: bool = False
+    thread_ids: List[str] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+class Ingestor:
+    """Pipeline di ingestione dei thread condivisa da upload e watcher.
+
+    Per ogni thread: estrazione dei post, scarto dei post già indicizzati
+    con lo stesso contenuto (per ``unique_post_id``, che deriva da URL del
+    thread e ``post_id`` e quindi resta lo stesso tra uno scrape e l'altro,
+    e ``content_hash``: i post modificati sono reindicizzati), chunking,
+    embedding in batch e upsert; alla fine aggiorna catalogo, indice dei
+    thread e, se abilitate, le sintesi dei thread in background. Prima di
+    ingerire migra gli eventuali post con id legacy (``migrate_legacy_ids``).
+    """
+
+    def __init__(self, index, embeddings):
+        self.index = index
+        self.embeddings = embeddings
+
+    @staticmethod
+    def post_vectors(chunks: List, chunk_embeddings: np.ndarray) -> np.ndarray:
+        """Un vettore per post (media dei suoi chunk), così i post lunghi non pesano più degli altri."""
+        post_ids = [chunk.metadata['unique_post_id'] for chunk in chunks]
+        _, first_rows, inverse = np.unique(post_ids, return_index=True, return_inverse=True)
+        sums = np.zeros((len(first_rows), chunk_embeddings.shape[1]), dtype=np.float32)
+        np.add.at(sums, inverse, chunk_embeddings)
+        counts = np.bincount(inverse, minlength=len(first_rows)).astype(np.float32)
+        return sums / counts[:, None]
+
+    def thread_vector(self, thread_id: str, thread: Dict, post_vectors: np.ndarray,
+                      existing_posts: int, thread_vectors: Dict[str, np.ndarray]) -> np.ndarray:
+        """Vettore del thread: media normalizzata del titolo e dei vettori dei post.
+
+        Per i thread già indicizzati il vettore esistente pesa come il titolo
+        più i post già presenti, e si aggiunge la somma dei vettori dei post nuovi.
+        """
+        if existing_posts:
+            previous = thread_vectors.get(thread_id)
+            if previous is None:
+                thread_index = get_thread_index()
+                rows = np.flatnonzero(thread_index.thread_ids == thread_id)
+                previous = thread_index.vectors[rows[0]] if len(rows) else None
+            if previous is not None:
+                centroid = previous * (existing_posts + 1) + post_vectors.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                return centroid / norm if norm > 0 else centroid
+        title_embedding = self.embeddings.embed_query(thread['title'])
+        return compute_thread_vector(title_embedding, post_vectors)
+
+    def remove_stale_chunks(self, previous_records: List[Dict], chunks: List):
+        """Elimina i chunk in eccesso dei post modificati che ora hanno meno chunk di prima.
+
+        ``previous_records`` sono i metadati dei post letti dall'indice prima dell'upsert.
+        """
+        new_totals = {chunk.metadata['unique_post_id']: chunk.metadata['total_chunks'] for chunk in chunks}
+        stale_ids = [
+            f"{record['unique_post_id']}_{number}"
+            for record in previous_records
+            for number in range(new_totals.get(record['unique_post_id'], 0), int(record.get('total_chunks') or 0))
+        ]
+        if stale_ids:
+            self.index.delete(ids=stale_ids)
+            logger.info(f"Deleted {len(stale_ids)} stale chunks of edited posts")
+
+    def index_thread(self, thread: Dict, known_posts: Dict[str, str], catalog_records: List[Dict],
+                     summary_records: List[Dict], thread_vectors: Dict[str, np.ndarray], result: IngestResult):
+        """Indicizza i post nuovi o modificati di un thread e accumula record del catalogo, post da sintetizzare e vettore del thread.
+
+        ``known_posts`` mappa ``unique_post_id`` → ``content_hash`` dei post già
+        indicizzati; i post del catalogo senza hash (indicizzati prima degli
+        hash del contenuto) sono reindicizzati una volta.
+        """
+        thread_id = get_thread_id(thread)
+        posts = process_thread_posts(thread)
+        new_posts = [post for post in posts if known_posts.get(post["unique_post_id"]) != post["content_hash"]]
+        edited_posts = [post for post in new_posts if post["unique_post_id"] in known_posts]
+        result.duplicates += len(posts) - len(new_posts)
+        # La sintesi decide da sé, con l'hash del thread, se i post sono cambiati
+        summary_records.extend(posts)
+        if not new_posts:
+            return
+        # Post del thread già rappresentati nel vettore del thread, esclusi quelli modificati
+        indexed = set(get_catalog().thread_posts(thread_id))
+        indexed.update(post["unique_post_id"] for post in posts if post["unique_post_id"] in known_posts)
+        existing_posts = len(indexed) - len(edited_posts)
+        known_posts.update((post["unique_post_id"], post["content_hash"]) for post in new_posts)
+
+        # Token contati una sola volta all'ingestione e salvati con il post: testo
+        # completo (formato esteso) e contenuto e citazione del formato compatto
+        for post in new_posts:
+            post["token_count"] = count_text_tokens(post["text"].strip())
+            post["content_tokens"] = count_text_tokens(parse_post_text(post["text"])["content"])
+            post["quote_tokens"] = count_text_tokens(post["quoted_content"]) if post.get("quoted_content") else 0
+        chunks = create_chunks([post["text"] for post in new_posts], new_posts)
+        # Embedding dei chunk in batch: matrice float32 convertita solo all'upsert
+        chunk_embeddings = self.embeddings.embed_documents([chunk.page_content for chunk in chunks])
+
+        chunk_ids = []
+        chunk_metadatas = []
+        for i, chunk in enumerate(chunks):
+            # Id stabile per post e chunk: reinviare lo stesso post sovrascrive invece di duplicare
+            chunk_ids.append(f"{chunk.metadata['unique_post_id']}_{chunk.metadata['chunk_number']}")
+            # I metadati del post (unique_post_id, author, post_time, ...) viaggiano
+            # con ogni chunk: il retriever li usa per ricomporre i post
+            chunk_metadatas.append({
+                **chunk.metadata,
+                "thread_id": thread_id,
+                "thread_title": thread['title'],
+                "url": thread['url'],
+                "timestamp": thread['scrape_time'],
+                "chunk_index": i
+            })
+        # Numero di chunk dei post modificati prima di sovrascriverli
+        previous_records = fetch_post_records(
+            self.index, [post["unique_post_id"] for post in edited_posts]
+        ) if edited_posts else []
+        upsert_documents(self.index, chunk_ids, chunk_embeddings, chunk_metadatas)
+        self.remove_stale_chunks(previous_records, chunks)
+        catalog_records.extend(new_posts)
+
+        # Vettore del thread (titolo + post) per il retrieval coarse-to-fine
+        if len(chunk_embeddings):
+            post_vectors = self.post_vectors(chunks, chunk_embeddings)
+            thread_vectors[thread_id] = self.thread_vector(thread_id, thread, post_vectors, existing_posts, thread_vectors)
+
+        result.posts += len(new_posts)
+        result.updated += len(edited_posts)
+        result.chunks += len(chunks)
+        result.thread_ids.append(thread_id)
+
+    def ingest(self, threads: Iterable[Dict],
+               on_progress: Optional[Callable[[int, int], None]] = None,
+               should_stop: Optional[Callable[[], bool]] = None) -> IngestResult:
+        """Ingerisce i thread; un errore su un thread non blocca gli altri.
+
+        ``on_progress(completati, totale)`` viene chiamata dopo ogni thread;
+        se ``should_stop()`` diventa vero l'ingestione si ferma al thread
+        successivo, aggiornando comunque catalogo e indice per quelli già
+        indicizzati. Le ingestioni concorrenti sono serializzate.
+        """
+        with _ingest_lock:
+            threads = list(threads)
+            result = IngestResult()
+
+            # I post con id legacy vanno riscritti prima: ingerire ora li duplicherebbe
+            try:
+                migrate_legacy_ids(self.index)
+            except Exception as e:
+                logger.error(f"Error migrating legacy ids: {str(e)}")
+                result.errors.append(f"Errore migrazione degli id legacy, ingestione annullata: {str(e)}")
+                return result
+
+            catalog = get_catalog()
+            known_posts = dict(zip(catalog.post_ids.tolist(), catalog.content_hashes.tolist()))
+            catalog_records = []
+            summary_records = []
+            thread_vectors = {}
+            start_time = time.monotonic()
+
+            for i, thread in enumerate(threads):
+                if should_stop is not None and should_stop():
+                    result.stopped = True
+                    logger.info(f"Ingestion stopped after {i}/{len(threads)} threads")
+                    break
+                try:
+                    self.index_thread(thread, known_posts, catalog_records, summary_records, thread_vectors, result)
+                    result.threads += 1
+                except Exception as e:
+                    logger.error(f"Error ingesting thread {thread.get('url', '?')}: {str(e)}")
+                    result.errors.append(f"Errore processamento thread: {str(e)}")
+                if on_progress is not None:
+                    on_progress(i + 1, len(threads))
+
+            # Aggiorna il catalogo colonnare con i post indicizzati
+            try:
+                update_catalog(catalog_records)
+            except Exception as e:
+                logger.error(f"Error updating catalog: {str(e)}")
+                result.errors.append(f"Errore aggiornamento catalogo: {str(e)}")
+
+            # Aggiorna l'indice dei thread
+            try:
+                update_thread_index(thread_vectors)
+            except Exception as e:
+                logger.error(f"Error updating thread index: {str(e)}")
+                result.errors.append(f"Errore aggiornamento indice thread: {str(e)}")
+
+            # Sintesi dei thread cambiati, calcolate in background sul loop condiviso
+            if THREAD_SUMMARIES_ENABLED and summary_records:
+                future = get_async_runner().submit(ThreadSummarizer(index=self.index).summarize_threads(summary_records))
+                future.add_done_callback(log_summary_result)
+
+            logger.info(
+                f"Ingested {result.threads} threads: {result.posts} new posts ({result.updated} edited), {result.chunks} chunks, "
+                f"{result.duplicates} duplicates skipped in {time.monotonic() - start_time:.1f}s"
+            )
+            return result
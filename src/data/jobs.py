@@ -0,0 +1,201 @@
+import dataclasses
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from config import INGEST_JOBS_DIR, INGEST_JOBS_HISTORY, INGEST_PROGRESS_SAVE_SECONDS
+from data.ingest import Ingestor
+
+logger = logging.getLogger(__name__)
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+@dataclass
+class IngestJob:
+    """Stato di un job di ingestione, persistito su file e visibile da ogni sessione."""
+    job_id: str
+    filename: str
+    status: str = "queued"  # queued, running, completed, failed, cancelled
+    total: int = 0
+    done: int = 0
+    threads: int = 0
+    posts: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    errors: List[str] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancel_requested: bool = False
+
+    @property
+    def progress(self) -> float:
+        return self.done / self.total if self.total else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+class IngestJobQueue:
+    """Coda FIFO dei job di ingestione, eseguiti da un worker in background.
+
+    Il file caricato viene salvato in ``jobs_dir`` e lo stato dei job in
+    ``jobs.json``, così un rerun o una disconnessione non interrompono il job
+    e un riavvio del processo rimette in coda quelli non conclusi (i post già
+    indicizzati vengono scartati). Un solo worker: gli upload concorrenti sono
+    eseguiti uno alla volta.
+    """
+
+    def __init__(self, ingestor: Ingestor,
+                 jobs_dir: str = INGEST_JOBS_DIR,
+                 history: int = INGEST_JOBS_HISTORY):
+        self.ingestor = ingestor
+        self.jobs_dir = jobs_dir
+        self.state_path = os.path.join(jobs_dir, "jobs.json")
+        self.history = history
+        self.jobs: Dict[str, IngestJob] = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._last_save = 0.0
+
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.load_state()
+        self.worker = threading.Thread(target=self.run, name="ingest-worker", daemon=True)
+        self.worker.start()
+
+    def payload_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def load_state(self):
+        """Carica i job salvati e rimette in coda quelli non conclusi."""
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading ingestion jobs: {str(e)}")
+            return
+        for data in saved:
+            job = IngestJob(**data)
+            if not job.finished:
+                if os.path.exists(self.payload_path(job.job_id)):
+                    job.status, job.done = "queued", 0
+                    self._queue.put(job.job_id)
+                    logger.info(f"Requeued ingestion job {job.job_id} ({job.filename})")
+                else:
+                    job.status, job.finished_at = "failed", time.time()
+                    job.errors.append("File del job non più disponibile")
+            self.jobs[job.job_id] = job
+
+    def save_state(self):
+        """Salva atomicamente lo stato dei job; va chiamata tenendo ``_lock``."""
+        tmp_path = f"{self.state_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([dataclasses.asdict(job) for job in self.jobs.values()], f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+        self._last_save = time.monotonic()
+
+    def prune_history(self):
+        """Tiene solo gli ultimi ``history`` job conclusi; va chiamata tenendo ``_lock``."""
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job.job_id]
+
+    def submit(self, filename: str, threads: List[Dict]) -> IngestJob:
+        """Mette in coda i thread di un file caricato e restituisce il job."""
+        job = IngestJob(job_id=uuid.uuid4().hex[:12], filename=filename, total=len(threads))
+        tmp_path = f"{self.payload_path(job.job_id)}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(threads, f, ensure_ascii=False)
+        os.replace(tmp_path, self.payload_path(job.job_id))
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self.save_state()
+        self._queue.put(job.job_id)
+        logger.info(f"Queued ingestion job {job.job_id} ({filename}, {len(threads)} threads)")
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """Annulla un job in coda o chiede l'arresto di quello in esecuzione."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            job.cancel_requested = True
+            if job.status == "queued":
+                job.status, job.finished_at = "cancelled", time.time()
+            self.save_state()
+        return True
+
+    def list_jobs(self) -> List[IngestJob]:
+        """Copie dei job, dal più recente."""
+        with self._lock:
+            return [dataclasses.replace(job, errors=list(job.errors)) for job in reversed(self.jobs.values())]
+
+    def run(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self.run_job(job_id)
+            except Exception as e:
+                logger.error(f"Ingestion job {job_id} failed: {str(e)}")
+                with self._lock:
+                    job = self.jobs.get(job_id)
+                    if job is not None and not job.finished:
+                        job.status, job.finished_at = "failed", time.time()
+                        job.errors.append(str(e))
+                        self.save_state()
+            finally:
+                # Il file caricato serve solo finché il job non è concluso
+                try:
+                    os.remove(self.payload_path(job_id))
+                except OSError:
+                    pass
+
+    def run_job(self, job_id: str):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return
+            job.status, job.started_at = "running", time.time()
+            self.save_state()
+
+        with open(self.payload_path(job_id), "r", encoding="utf-8") as f:
+            threads = json.load(f)
+
+        def on_progress(done: int, total: int):
+            with self._lock:
+                job.done, job.total = done, total
+                if time.monotonic() - self._last_save >= INGEST_PROGRESS_SAVE_SECONDS:
+                    self.save_state()
+
+        result = self.ingestor.ingest(threads, on_progress=on_progress, should_stop=lambda: job.cancel_requested)
+
+        with self._lock:
+            job.threads, job.posts, job.chunks, job.duplicates = result.threads, result.posts, result.chunks, result.duplicates
+            job.errors.extend(result.errors)
+            if result.stopped:
+                job.status = "cancelled"
+            elif result.errors and not result.threads:
+                job.status = "failed"
+            else:
+                job.status = "completed"
+            job.finished_at = time.time()
+            self.prune_history()
+            self.save_state()
+        logger.info(f"Ingestion job {job_id} {job.status}: {result.threads}/{len(threads)} threads")
+
+def get_ingest_queue(index=None, embeddings=None) -> Optional[IngestJobQueue]:
+    """Restituisce la coda del processo, creandola al primo accesso con indice ed embeddings."""
+    global _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None and index is not None and embeddings is not None:
+            _ingest_queue = IngestJobQueue(Ingestor(index, embeddings))
+        return _ingest_queue
@@ -0,0 +1,115 @@
+import logging
+from dataclasses import dataclass
+from typing import Dict, List
+import numpy as np
+from config import EMBEDDING_DIMENSION, UPSERT_BATCH_SIZE, MIGRATION_QUERY_TOP_K
+from data.catalog import PostCatalog, get_catalog, replace_threads_in_catalog
+from data.processor import generate_post_id, get_thread_id
+from embeddings.indexer import to_vector_values
+from embeddings.thread_index import get_thread_index, remove_threads, update_thread_index
+from rag.summaries import get_summary_store
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class MigrationResult:
+    """Esito della migrazione: thread legacy, chunk riscritti, chunk già presenti con il nuovo id, chunk lasciati."""
+    threads: int = 0
+    rekeyed: int = 0
+    duplicates: int = 0
+    skipped: int = 0
+
+def legacy_thread_ids(catalog: PostCatalog) -> List[str]:
+    """Thread del catalogo con id legacy: hash di URL e scrape_time invece che del solo URL."""
+    legacy = []
+    for code in np.unique(catalog.thread_codes).tolist():
+        thread = catalog.threads[code]
+        if thread.get("url") and thread["thread_id"] != get_thread_id(thread):
+            legacy.append(thread["thread_id"])
+    return legacy
+
+def migrate_legacy_ids(index) -> MigrationResult:
+    """Riscrive con gli id stabili i post indicizzati con lo schema legacy.
+
+    Con lo schema legacy ``thread_id`` derivava da URL e scrape_time, quindi
+    ogni snapshot di un thread aveva id diversi. Per ogni thread legacy del
+    catalogo i chunk sono letti dall'indice (valori e metadati), reinseriti
+    con ``thread_id`` dall'URL e ``unique_post_id`` dal ``post_id`` del forum,
+    poi eliminati con il vecchio id. Gli snapshot dello stesso thread
+    confluiscono negli stessi post, e i post già presenti con il nuovo id
+    vincono. Catalogo, indice dei thread e sintesi passano ai nuovi id. I
+    chunk senza ``post_id`` (ingestioni precedenti al catalogo) restano come
+    sono. Senza thread legacy non fa nulla, quindi si può chiamare ad ogni
+    ingestione.
+    """
+    result = MigrationResult()
+    catalog = get_catalog()
+    legacy = legacy_thread_ids(catalog)
+    if not legacy:
+        return result
+
+    known_posts = set(catalog.row_index)
+    thread_index = get_thread_index()
+    query_vector = [0.0] * EMBEDDING_DIMENSION
+    query_vector[0] = 1.0
+    records: Dict[str, Dict] = {}
+    thread_vectors: Dict[str, np.ndarray] = {}
+
+    for legacy_id in legacy:
+        seen = set()
+        while True:
+            page = index.query(
+                vector=query_vector,
+                top_k=MIGRATION_QUERY_TOP_K,
+                filter={"thread_id": legacy_id},
+                include_values=True,
+                include_metadata=True
+            ).matches or []
+            matches = [match for match in page if match.id not in seen]
+            if not matches:
+                if len(page) >= MIGRATION_QUERY_TOP_K:
+                    logger.warning(f"Legacy thread {legacy_id}: deletions not yet visible, some chunks may be left")
+                break
+            seen.update(match.id for match in matches)
+
+            vectors, old_ids = [], []
+            for match in matches:
+                metadata = dict(match.metadata or {})
+                if metadata.get("post_id") is None or not metadata.get("url"):
+                    result.skipped += 1
+                    continue
+                thread_id = get_thread_id(metadata)
+                post_id = generate_post_id(metadata, thread_id)
+                old_ids.append(match.id)
+                if post_id in known_posts and post_id not in records:
+                    result.duplicates += 1
+                    continue
+                metadata.update({"thread_id": thread_id, "unique_post_id": post_id})
+                records[post_id] = metadata
+                vectors.append({
+                    "id": f"{post_id}_{metadata.get('chunk_number', 0)}",
+                    "values": to_vector_values(match.values),
+                    "metadata": metadata
+                })
+                if thread_id not in thread_vectors and not np.any(thread_index.thread_ids == thread_id):
+                    rows = np.flatnonzero(thread_index.thread_ids == legacy_id)
+                    if len(rows):
+                        thread_vectors[thread_id] = thread_index.vectors[rows[0]]
+
+            # Prima i nuovi id, poi l'eliminazione dei vecchi: un'interruzione lascia duplicati, mai buchi
+            for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+                index.upsert(vectors=vectors[start:start + UPSERT_BATCH_SIZE])
+            for start in range(0, len(old_ids), UPSERT_BATCH_SIZE):
+                index.delete(ids=old_ids[start:start + UPSERT_BATCH_SIZE])
+            result.rekeyed += len(vectors)
+        result.threads += 1
+
+    replace_threads_in_catalog(legacy, list(records.values()))
+    remove_threads(legacy)
+    update_thread_index(thread_vectors)
+    get_summary_store().remove_many(legacy)
+    logger.info(
+        f"Migrated {result.threads} legacy threads: {result.rekeyed} chunks re-keyed, "
+        f"{result.duplicates} already indexed with the new ids, {result.skipped} left unchanged"
+    )
+    return result
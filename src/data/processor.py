@@ -4,8 +4,8 @@ import hashlib
 import re
 
 def generate_post_id(post: Dict, thread_id: str) -> str:
-    """Genera un ID unico per ogni post basato sul suo contenuto e timestamp."""
-    post_key = f"{thread_id}_{post['post_id']}_{post['post_time']}"
+    """Genera un ID unico per ogni post, stabile tra uno scrape e l'altro dello stesso thread."""
+    post_key = f"{thread_id}_{post['post_id']}"
     return hashlib.md5(post_key.encode()).hexdigest()
 
 def extract_quote(content: str) -> tuple[str, str]:
@@ -65,6 +65,7 @@ Sentiment: {post.get('sentiment', 0)}
         "keywords": post['keywords'],
         "sentiment": post.get('sentiment', 0),
         "content_length": len(actual_content),
+        "content_hash": hashlib.md5(formatted_text.encode()).hexdigest(),
         "thread_id": thread_id,
         "text": formatted_text
     }
@@ -79,8 +80,44 @@ Sentiment: {post.get('sentiment', 0)}
     
     return metadata
 
+POST_HEADER_PATTERN = re.compile(r"^(Author|Time|Quoted Author|Quoted Content): ?", re.MULTILINE)
+
+def parse_post_text(text: str) -> Dict[str, str]:
+    """Ricava i campi dal testo formattato da ``extract_post_content``.
+
+    I testi senza intestazioni (es. chunk indicizzati senza metadati del post)
+    vengono restituiti interamente come ``content``.
+    """
+    content_start = text.find("\nContent: ")
+    if content_start < 0:
+        return {"content": text.strip()}
+
+    fields = {}
+    header = text[:content_start]
+    matches = list(POST_HEADER_PATTERN.finditer(header))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(header)
+        fields[match.group(1).lower().replace(" ", "_")] = header[match.end():end].strip()
+
+    # Keywords e Sentiment chiudono sempre il testo: cerca dall'ultima occorrenza
+    content_end = text.rfind("\nKeywords: ")
+    if content_end < content_start:
+        content_end = len(text)
+    fields["content"] = text[content_start + len("\nContent: "):content_end].strip()
+
+    for line in text[content_end:].strip().splitlines():
+        if line.startswith("Keywords: "):
+            fields["keywords"] = line[len("Keywords: "):].strip()
+        elif line.startswith("Sentiment: "):
+            fields["sentiment"] = line[len("Sentiment: "):].strip()
+    return fields
+
 def process_thread(thread: Dict) -> List[str]:
     """Processa un thread e restituisce una lista di testi per il chunking."""
+    return [metadata["text"] for metadata in process_thread_posts(thread)]
+
+def process_thread_posts(thread: Dict) -> List[Dict]:
+    """Processa un thread e restituisce i metadati completi di ogni post."""
     thread_id = get_thread_id(thread)
     processed_posts = []
     
@@ -103,76 +140,14 @@ def process_thread(thread: Dict) -> List[str]:
         metadata = extract_post_content(post, thread_id)
         metadata.update(thread_metadata)
         metadata["is_post"] = True  # Flag per identificare che questo è un post
-        processed_posts.append(metadata["text"])
+        processed_posts.append(metadata)
     
     return processed_posts
 
 def get_thread_id(thread: Dict) -> str:
-    """Genera un ID unico per il thread."""
-    thread_key = f"{thread['url']}_{thread['scrape_time']}"
-    return hashlib.md5(thread_key.encode()).hexdigest()
-
-def should_update_post(existing_post: Dict, new_post: Dict) -> bool:
-    """Determina se un post esistente dovrebbe essere aggiornato."""
-    return (
-        existing_post.get('content_length') != new_post.get('content_length') or
-        existing_post.get('sentiment') != new_post.get('sentiment') or
-        set(existing_post.get('keywords', [])) != set(new_post.get('keywords', []))
-    )
-
-async def update_thread_in_index(index, thread: Dict, embeddings):
-    """Aggiorna un thread nell'indice, gestendo i duplicati e gli aggiornamenti."""
-    thread_id = get_thread_id(thread)
-    
-    # Metadati comuni del thread
-    thread_metadata = {
-        "thread_id": thread_id,
-        "thread_title": thread['title'],
-        "url": thread['url'],
-        "scrape_time": thread['scrape_time'],
-        "total_posts": len(thread['posts']),
-        "is_thread": True
-    }
-    
-    if 'metadata' in thread:
-        thread_metadata.update(thread['metadata'])
-    
-    # Recupera i post esistenti per questo thread
-    existing_posts = await index.query(
-        filter={"thread_id": thread_id},
-        include_metadata=True
-    )
-    
-    existing_post_ids = {post.metadata.get('unique_post_id'): post for post in existing_posts.matches}
-    
-    # Processa ogni post
-    for post in thread['posts']:
-        metadata = extract_post_content(post, thread_id)
-        metadata.update(thread_metadata)
-        metadata["is_post"] = True
-        post_id = metadata['unique_post_id']
-        
-        if post_id not in existing_post_ids:
-            # Nuovo post - aggiungi all'indice
-            embedding = embeddings.embed_query(metadata['text'])
-            await index.upsert(
-                vectors=[{
-                    "id": post_id,
-                    "values": embedding,
-                    "metadata": metadata
-                }]
-            )
-        else:
-            # Post esistente - verifica se necessita aggiornamento
-            existing_post = existing_post_ids[post_id]
-            if should_update_post(existing_post.metadata, metadata):
-                embedding = embeddings.embed_query(metadata['text'])
-                await index.upsert(
-                    vectors=[{
-                        "id": post_id,
-                        "values": embedding,
-                        "metadata": metadata
-                    }]
-                )
+    """Genera un ID unico per il thread dal suo URL.
 
-    return len(thread['posts'])
\ No newline at end of file
+    Lo scrape_time non fa parte dell'ID: gli snapshot successivi dello stesso
+    thread mantengono thread e post già indicizzati e aggiungono solo i nuovi.
+    """
+    return hashlib.md5(thread['url'].encode()).hexdigest()
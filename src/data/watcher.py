@@ -0,0 +1,221 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from config import (
+    SPOOL_DIR,
+    SPOOL_STATE_PATH,
+    SPOOL_POLL_SECONDS,
+    SPOOL_BATCH_THREADS,
+    SPOOL_SETTLE_SECONDS
+)
+from data.ingest import Ingestor, IngestResult
+
+logger = logging.getLogger(__name__)
+
+_spool_watcher = None
+_spool_watcher_lock = threading.Lock()
+
+class SpoolWatcher:
+    """Segue una directory di spool e ingerisce a micro-batch i thread scritti dal crawler.
+
+    I file ``.jsonl`` contengono un thread per riga e sono letti in coda
+    dall'ultimo offset salvato, solo per righe complete; i file ``.json``
+    (lista di thread o thread singolo) sono letti interi quando non vengono
+    modificati da ``SPOOL_SETTLE_SECONDS``. Gli offset sono salvati su file
+    dopo ogni micro-batch, così un riavvio riprende da dove si era fermato; i
+    post già indicizzati vengono comunque scartati dall'``Ingestor``.
+    """
+
+    def __init__(self, ingestor: Ingestor,
+                 spool_dir: str = SPOOL_DIR,
+                 state_path: str = SPOOL_STATE_PATH,
+                 poll_seconds: float = SPOOL_POLL_SECONDS,
+                 batch_threads: int = SPOOL_BATCH_THREADS):
+        self.ingestor = ingestor
+        self.spool_dir = spool_dir
+        self.state_path = state_path
+        self.poll_seconds = poll_seconds
+        self.batch_threads = batch_threads
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = None
+        self.offsets = self.load_state()
+        self.stats = {
+            "threads": 0, "posts": 0, "duplicates": 0, "errors": 0,
+            "last_scan": None, "last_ingest": None, "last_batch_lag": None, "last_error": None
+        }
+        self.pending = {}
+
+    def load_state(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading spool state: {str(e)}")
+            return {}
+
+    def save_state(self):
+        """Salva atomicamente gli offset dei file."""
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.offsets, f)
+        os.replace(tmp_path, self.state_path)
+
+    def spool_files(self) -> List[str]:
+        """File JSON/JSONL dello spool, dal meno recente."""
+        paths = glob.glob(os.path.join(self.spool_dir, "*.json")) + glob.glob(os.path.join(self.spool_dir, "*.jsonl"))
+        return sorted(paths, key=os.path.getmtime)
+
+    def read_jsonl(self, path: str, offset: int) -> List[Tuple[Dict, int]]:
+        """Thread delle righe complete dopo ``offset``, ciascuno con l'offset di fine riga."""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n")
+        if end < 0:
+            return []
+        threads = []
+        position = offset
+        for line in data[:end + 1].splitlines(keepends=True):
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                threads.append((json.loads(line), position))
+            except json.JSONDecodeError as e:
+                logger.error(f"Skipping invalid line in {path} at offset {position - len(line)}: {str(e)}")
+                threads.append((None, position))
+        return threads
+
+    def read_json(self, path: str, size: int) -> List[Tuple[Dict, int]]:
+        """Thread di un file JSON completo; l'offset (dimensione del file) è raggiunto all'ultimo thread.
+
+        Se l'ingestione si interrompe a metà il file viene riletto per intero.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            content = json.load(f)
+        threads = content if isinstance(content, list) else [content]
+        return [(thread, size if i == len(threads) - 1 else 0) for i, thread in enumerate(threads)]
+
+    def ingest_file(self, path: str, stat: os.stat_result, entry: Dict):
+        """Ingerisce i thread nuovi di un file a micro-batch, salvando l'offset dopo ogni batch."""
+        if path.endswith(".jsonl"):
+            items = self.read_jsonl(path, entry["offset"])
+        else:
+            items = self.read_json(path, stat.st_size)
+        if not items:
+            return
+
+        for start in range(0, len(items), self.batch_threads):
+            batch = items[start:start + self.batch_threads]
+            threads = [thread for thread, _ in batch if isinstance(thread, dict)]
+            result = self.ingestor.ingest(threads) if threads else IngestResult()
+            offset = max(position for _, position in batch)
+            if offset:
+                entry["offset"] = offset
+                entry["mtime"] = stat.st_mtime
+            with self._lock:
+                self.offsets[os.path.basename(path)] = entry
+                self.save_state()
+                self.record_batch(result, stat.st_mtime)
+
+    def record_batch(self, result: IngestResult, written_at: float):
+        """Aggiorna i contatori; il ritardo del batch va dalla scrittura del file alla fine dell'ingestione."""
+        now = time.time()
+        self.stats["threads"] += result.threads
+        self.stats["posts"] += result.posts
+        self.stats["duplicates"] += result.duplicates
+        self.stats["errors"] += len(result.errors)
+        if result.errors:
+            self.stats["last_error"] = result.errors[-1]
+        self.stats["last_ingest"] = now
+        self.stats["last_batch_lag"] = max(0.0, now - written_at)
+
+    def scan_once(self):
+        """Un giro sullo spool: ingerisce i dati nuovi di ogni file."""
+        if not os.path.isdir(self.spool_dir):
+            return
+        now = time.time()
+        pending = {}
+        for path in self.spool_files():
+            name = os.path.basename(path)
+            try:
+                stat = os.stat(path)
+                with self._lock:
+                    entry = dict(self.offsets.get(name) or {"offset": 0})
+                # File sostituito o troncato: si riparte dall'inizio
+                if entry.get("inode") != stat.st_ino or stat.st_size < entry["offset"]:
+                    entry = {"offset": 0, "inode": stat.st_ino}
+                if path.endswith(".jsonl"):
+                    if stat.st_size <= entry["offset"]:
+                        continue
+                    self.ingest_file(path, stat, entry)
+                    # Riga finale ancora incompleta: resta in attesa
+                    if stat.st_size > entry["offset"]:
+                        pending[name] = (stat.st_size - entry["offset"], stat.st_mtime)
+                else:
+                    if entry.get("mtime") == stat.st_mtime:
+                        continue
+                    if now - stat.st_mtime < SPOOL_SETTLE_SECONDS:
+                        pending[name] = (stat.st_size, stat.st_mtime)
+                        continue
+                    entry["offset"] = 0
+                    self.ingest_file(path, stat, entry)
+            except Exception as e:
+                logger.error(f"Error ingesting spool file {path}: {str(e)}")
+                with self._lock:
+                    self.stats["errors"] += 1
+                    self.stats["last_error"] = f"{name}: {str(e)}"
+        with self._lock:
+            self.pending = pending
+            self.stats["last_scan"] = time.time()
+
+    def metrics(self) -> Dict:
+        """Contatori e ritardo di ingestione (secondi dalla scrittura dei dati non ancora ingeriti)."""
+        with self._lock:
+            metrics = dict(self.stats)
+            pending = dict(self.pending)
+        metrics["pending_files"] = len(pending)
+        metrics["pending_bytes"] = sum(size for size, _ in pending.values())
+        if pending:
+            metrics["ingest_lag"] = max(0.0, time.time() - min(mtime for _, mtime in pending.values()))
+        else:
+            metrics["ingest_lag"] = metrics["last_batch_lag"] or 0.0
+        metrics["running"] = self.thread is not None and self.thread.is_alive()
+        return metrics
+
+    def run(self):
+        logger.info(f"Watching spool directory {self.spool_dir} every {self.poll_seconds}s")
+        while not self._stop.is_set():
+            try:
+                self.scan_once()
+            except Exception as e:
+                logger.error(f"Spool scan failed: {str(e)}")
+            self._stop.wait(self.poll_seconds)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self._stop.clear()
+            self.thread = threading.Thread(target=self.run, name="spool-watcher", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+def get_spool_watcher(index=None, embeddings=None) -> Optional[SpoolWatcher]:
+    """Restituisce il watcher del processo, avviandolo al primo accesso con indice ed embeddings."""
+    global _spool_watcher
+    with _spool_watcher_lock:
+        if _spool_watcher is None and index is not None and embeddings is not None:
+            _spool_watcher = SpoolWatcher(Ingestor(index, embeddings))
+            _spool_watcher.start()
+        return _spool_watcher
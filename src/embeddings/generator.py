@@ -2,13 +2,18 @@ from sentence_transformers import SentenceTransformer
 import torch
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import logging
+import threading
 from datetime import datetime
-from config import CHUNK_OVERLAP, CHUNK_SIZE, EMBEDDING_DIMENSION, EMBEDDING_MODEL
+import numpy as np
+from config import CHUNK_OVERLAP, CHUNK_SIZE, EMBEDDING_DIMENSION, EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE
 
 logger = logging.getLogger(__name__)
 
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
 class SentenceTransformersEmbeddings:
     def __init__(self, model_name=EMBEDDING_MODEL):
         try:
@@ -35,24 +40,44 @@ class SentenceTransformersEmbeddings:
             logger.error(f"Errore inizializzazione embeddings: {str(e)}")
             raise
 
-    def embed_query(self, text):
-        """Genera embedding per una singola query."""
+    def embed_query(self, text) -> np.ndarray:
+        """Genera embedding per una singola query (array float32 contiguo)."""
         try:
             with torch.no_grad():
                 logger.info(f"Generating embedding for text of length: {len(text)}")
                 
-                embedding = self.model.encode(text, normalize_embeddings=True)
+                embedding = self.model.encode(text, normalize_embeddings=True, convert_to_numpy=True)
                 
-                if len(embedding) != self.dimension:
-                    raise ValueError(f"Dimensione embedding non corretta. Attesa {self.dimension}, ricevuta {len(embedding)}")
+                if embedding.shape != (self.dimension,):
+                    raise ValueError(f"Dimensione embedding non corretta. Attesa {self.dimension}, ricevuta {embedding.shape[-1]}")
                 
                 logger.info(f"Successfully generated embedding of dimension: {len(embedding)}")
-                return embedding.tolist()
+                return np.ascontiguousarray(embedding, dtype=np.float32)
                 
         except Exception as e:
             logger.error(f"Errore generazione embedding: {str(e)}")
             raise
 
+    def embed_documents(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> np.ndarray:
+        """Genera gli embedding di più testi in batch: matrice float32 (n, dimensione)."""
+        try:
+            if not texts:
+                return np.zeros((0, self.dimension), dtype=np.float32)
+            with torch.no_grad():
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=batch_size,
+                    normalize_embeddings=True,
+                    convert_to_numpy=True
+                )
+            if embeddings.shape != (len(texts), self.dimension):
+                raise ValueError(f"Dimensione embedding non corretta. Attesa {self.dimension}, ricevuta {embeddings.shape[-1]}")
+            logger.info(f"Generated {len(texts)} embeddings in batches of {batch_size}")
+            return np.ascontiguousarray(embeddings, dtype=np.float32)
+        except Exception as e:
+            logger.error(f"Errore generazione embedding: {str(e)}")
+            raise
+
 def extract_metadata(text: str) -> Dict[str, Any]:
     """Estrae i metadati dal testo del post."""
     metadata = {}
@@ -80,8 +105,12 @@ def extract_metadata(text: str) -> Dict[str, Any]:
                 
     return metadata
 
-def create_chunks(texts: List[str]) -> List[Document]:
-    """Divide i testi in chunks mantenendo i metadati."""
+def create_chunks(texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None) -> List[Document]:
+    """Divide i testi in chunks mantenendo i metadati.
+
+    Se ``metadatas`` è fornito (uno per testo) viene usato al posto dei
+    metadati estratti dal testo, così ogni chunk porta l'identità del post.
+    """
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=CHUNK_SIZE,
         chunk_overlap=CHUNK_OVERLAP,
@@ -89,9 +118,12 @@ def create_chunks(texts: List[str]) -> List[Document]:
     )
     
     chunks = []
-    for text in texts:
+    for position, text in enumerate(texts):
         # Estrai i metadati prima del chunking
-        metadata = extract_metadata(text)
+        if metadatas is not None:
+            metadata = dict(metadatas[position])
+        else:
+            metadata = extract_metadata(text)
         
         # Crea i chunks mantenendo i metadati
         doc_chunks = text_splitter.create_documents([text])
@@ -101,7 +133,8 @@ def create_chunks(texts: List[str]) -> List[Document]:
                 "chunk_number": i,
                 "total_chunks": len(doc_chunks),
                 "text": text,  # Mantieni il testo originale completo
-                "chunk_text": chunk.page_content  # Il testo del chunk specifico
+                "chunk_text": chunk.page_content,  # Il testo del chunk specifico
+                "chunk_start": chunk.metadata.get("start_index", -1)  # Offset del chunk nel testo
             })
             chunks.append(Document(
                 page_content=chunk.page_content,
@@ -112,12 +145,18 @@ def create_chunks(texts: List[str]) -> List[Document]:
     return chunks
 
 def get_embeddings():
-    """Inizializza il modello embeddings con logging dettagliato."""
+    """Inizializza il modello embeddings con logging dettagliato.
+
+    Il modello viene caricato una sola volta per processo e riusato ad ogni rerun.
+    """
+    global _embeddings
     try:
-        logger.info("Initializing embeddings model...")
-        embeddings = SentenceTransformersEmbeddings()
-        logger.info(f"Successfully initialized embeddings with dimension: {embeddings.dimension}")
-        return embeddings
+        with _embeddings_lock:
+            if _embeddings is None:
+                logger.info("Initializing embeddings model...")
+                _embeddings = SentenceTransformersEmbeddings()
+                logger.info(f"Successfully initialized embeddings with dimension: {_embeddings.dimension}")
+            return _embeddings
     except Exception as e:
         logger.error(f"Fatal error initializing embeddings: {str(e)}")
         raise
\ No newline at end of file
@@ -1,20 +1,42 @@
 # indexer.py
 
 import streamlit as st
-from config import INDEX_NAME, EMBEDDING_DIMENSION
+from config import INDEX_NAME, EMBEDDING_DIMENSION, UPSERT_BATCH_SIZE, FETCH_BATCH_SIZE
 import logging
+from typing import Dict, List
+import numpy as np
 from pinecone import Pinecone
+from .partitions import PartitionedIndex
+
+try:
+    # Trasporto gRPC (protobuf binario), disponibile con pinecone-client[grpc]
+    from pinecone.grpc import PineconeGRPC
+except ImportError:
+    PineconeGRPC = None
 
 logger = logging.getLogger(__name__)
 
+def get_pinecone_client(api_key):
+    """Client Pinecone: gRPC se installato, altrimenti REST."""
+    if PineconeGRPC is not None:
+        logger.info("Using Pinecone gRPC transport")
+        return PineconeGRPC(api_key=api_key)
+    return Pinecone(api_key=api_key)
+
+def to_vector_values(embedding) -> List[float]:
+    """Converte un embedding NumPy nella lista di float richiesta dal client remoto."""
+    if isinstance(embedding, np.ndarray):
+        return embedding.tolist()
+    return list(embedding)
+
 def ensure_index_exists(api_key):
     """Verifica e connette all'indice Pinecone."""
     try:
         logger.info("Initializing Pinecone connection...")
-        pc = Pinecone(api_key=api_key)
+        pc = get_pinecone_client(api_key)
         
-        # Verifica indice esistente
-        index = pc.Index(INDEX_NAME)
+        # Verifica indice esistente (namespace partizionati per periodo)
+        index = PartitionedIndex(pc.Index(INDEX_NAME))
         
         # Verifica dimensione corretta
         stats = index.describe_index_stats()
@@ -46,7 +68,7 @@ def update_document_in_index(index, doc_id, embedding, metadata):
         index.upsert(
             vectors=[{
                 "id": doc_id,
-                "values": embedding,
+                "values": to_vector_values(embedding),
                 "metadata": metadata
             }]
         )
@@ -55,4 +77,46 @@ def update_document_in_index(index, doc_id, embedding, metadata):
         
     except Exception as e:
         logger.error(f"Errore aggiornamento documento {doc_id}: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def upsert_documents(index, doc_ids: List[str], embeddings: np.ndarray, metadatas: List[Dict],
+                     batch_size: int = UPSERT_BATCH_SIZE):
+    """Inserisce nell'indice una matrice di embedding (n, dimensione) a blocchi.
+
+    La dimensione è verificata una volta sulla matrice; la conversione in
+    liste avviene solo per il blocco inviato al client.
+    """
+    if not doc_ids:
+        return
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim != 2 or embeddings.shape[1] != EMBEDDING_DIMENSION:
+        raise ValueError(f"Dimensione embedding non valida: {embeddings.shape}")
+    if not (len(doc_ids) == len(metadatas) == embeddings.shape[0]):
+        raise ValueError("Numero di id, embedding e metadati non corrispondente")
+
+    for start in range(0, len(doc_ids), batch_size):
+        end = start + batch_size
+        values = embeddings[start:end].tolist()
+        index.upsert(vectors=[
+            {"id": doc_id, "values": vector, "metadata": metadata}
+            for doc_id, vector, metadata in zip(doc_ids[start:end], values, metadatas[start:end])
+        ])
+    logger.info(f"Upserted {len(doc_ids)} documents in {-(-len(doc_ids) // batch_size)} batches")
+
+def fetch_post_records(index, post_ids: List[str], batch_size: int = FETCH_BATCH_SIZE) -> List[Dict]:
+    """Metadati completi dei post indicati, letti dal loro primo chunk.
+
+    Ogni chunk porta testo e metadati del post, quindi basta il chunk 0
+    (id ``{unique_post_id}_0``); i post non trovati vengono ignorati.
+    """
+    records = []
+    for start in range(0, len(post_ids), batch_size):
+        ids = [f"{post_id}_0" for post_id in post_ids[start:start + batch_size]]
+        result = index.fetch(ids=ids)
+        for vector in (result.vectors or {}).values():
+            metadata = vector.get("metadata") if isinstance(vector, dict) else getattr(vector, "metadata", None)
+            if metadata and "text" in metadata:
+                records.append(dict(metadata))
+    if len(records) < len(post_ids):
+        logger.warning(f"Fetched {len(records)}/{len(post_ids)} posts from the index")
+    return records
@@ -0,0 +1,199 @@
+import heapq
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from config import (
+    PARTITION_GRANULARITY,
+    PARTITION_PREFIX,
+    PARTITION_QUERY_WORKERS,
+    PARTITION_REFRESH_SECONDS
+)
+from data.catalog import to_epoch
+
+logger = logging.getLogger(__name__)
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+# Namespace predefinito: vettori indicizzati prima del partizionamento
+LEGACY_NAMESPACE = ""
+UNDATED_PARTITION = f"{PARTITION_PREFIX}-undated"
+PARTITION_PATTERN = re.compile(rf"^{re.escape(PARTITION_PREFIX)}-(\d{{4}})(?:-(\d{{2}}))?$")
+
+def get_query_executor() -> ThreadPoolExecutor:
+    """Pool condiviso dal processo per le query concorrenti sulle partizioni."""
+    global _query_executor
+    with _query_executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(
+                max_workers=PARTITION_QUERY_WORKERS,
+                thread_name_prefix="partition-query"
+            )
+        return _query_executor
+
+def partition_name(epoch: int, granularity: Optional[str] = PARTITION_GRANULARITY) -> str:
+    """Namespace del post con timestamp ``epoch``: ``posts-2024-03`` (mese) o ``posts-2024`` (anno)."""
+    if granularity is None:
+        return LEGACY_NAMESPACE
+    if not epoch:
+        return UNDATED_PARTITION
+    dt = datetime.fromtimestamp(epoch, tz=timezone.utc)
+    if granularity == "year":
+        return f"{PARTITION_PREFIX}-{dt.year:04d}"
+    return f"{PARTITION_PREFIX}-{dt.year:04d}-{dt.month:02d}"
+
+def partition_range(name: str) -> Optional[Tuple[int, int]]:
+    """Intervallo [inizio, fine) in epoch coperto dalla partizione (None se non datata)."""
+    match = PARTITION_PATTERN.match(name)
+    if not match:
+        return None
+    year = int(match.group(1))
+    if match.group(2) is None:
+        start, end = datetime(year, 1, 1, tzinfo=timezone.utc), datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        month = int(match.group(2))
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+class PartitionedQueryResult:
+    """Risultato unito delle query sulle partizioni, con la stessa forma di quello di Pinecone."""
+
+    def __init__(self, matches: List):
+        self.matches = matches
+
+class PartitionedIndex:
+    """Indice Pinecone con i vettori partizionati per periodo in namespace separati.
+
+    Gli upsert sono instradati nella partizione del ``post_time`` del vettore;
+    le query interrogano in parallelo le partizioni richieste (tutte, se non
+    specificate) e uniscono i top-k per punteggio. Eliminare una partizione è
+    una singola cancellazione del namespace. I vettori indicizzati prima del
+    partizionamento restano nel namespace predefinito, sempre interrogato.
+    Gli altri metodi sono delegati all'indice originale.
+    """
+
+    def __init__(self, index, granularity: Optional[str] = PARTITION_GRANULARITY):
+        self.index = index
+        self.granularity = granularity
+        self._namespaces = None
+        self._namespaces_time = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == "index":
+            raise AttributeError(name)
+        return getattr(self.index, name)
+
+    def list_partitions(self, refresh: bool = False) -> Dict[str, int]:
+        """Namespace presenti nell'indice con il numero di vettori."""
+        with self._lock:
+            expired = time.monotonic() - self._namespaces_time > PARTITION_REFRESH_SECONDS
+            if self._namespaces is None or refresh or expired:
+                stats = self.index.describe_index_stats()
+                namespaces = getattr(stats, "namespaces", None) or {}
+                self._namespaces = {
+                    name: int(getattr(summary, "vector_count", 0) or 0)
+                    for name, summary in namespaces.items()
+                }
+                self._namespaces_time = time.monotonic()
+            return dict(self._namespaces)
+
+    def partitions_for_range(self, start: Optional[int], end: Optional[int]) -> List[str]:
+        """Partizioni che si sovrappongono a [start, end), più quelle non datate."""
+        selected = []
+        for name in self.list_partitions():
+            bounds = partition_range(name)
+            if bounds is None:
+                selected.append(name)
+            elif (start is None or bounds[1] > start) and (end is None or bounds[0] < end):
+                selected.append(name)
+        return selected
+
+    def query(self, vector, top_k: int, filter: Optional[Dict] = None, include_metadata: bool = True,
+              namespaces: Optional[List[str]] = None, namespace: Optional[str] = None, **kwargs):
+        """Query concorrenti sulle partizioni con unione dei top-k per punteggio."""
+        if namespace is not None:
+            return self.index.query(vector=vector, top_k=top_k, filter=filter,
+                                    include_metadata=include_metadata, namespace=namespace, **kwargs)
+        if namespaces is None:
+            namespaces = list(self.list_partitions()) or [LEGACY_NAMESPACE]
+        if not namespaces:
+            return PartitionedQueryResult([])
+
+        def query_partition(name: str):
+            return self.index.query(vector=vector, top_k=top_k, filter=filter,
+                                    include_metadata=include_metadata, namespace=name, **kwargs)
+
+        if len(namespaces) == 1:
+            return query_partition(namespaces[0])
+        start_time = time.monotonic()
+        results = list(get_query_executor().map(query_partition, namespaces))
+        matches = heapq.nlargest(
+            top_k,
+            (match for result in results for match in (result.matches or [])),
+            key=lambda match: match.score or 0.0
+        )
+        logger.info(
+            f"Queried {len(namespaces)} partitions in {time.monotonic() - start_time:.2f}s: "
+            f"{len(matches)} matches"
+        )
+        return PartitionedQueryResult(matches)
+
+    def upsert(self, vectors: List[Dict], namespace: Optional[str] = None, **kwargs):
+        """Inserisce i vettori, ciascuno nella partizione del proprio ``post_time``."""
+        if namespace is not None:
+            return self.index.upsert(vectors=vectors, namespace=namespace, **kwargs)
+        groups = {}
+        for vector in vectors:
+            post_time = (vector.get("metadata") or {}).get("post_time", "")
+            groups.setdefault(partition_name(to_epoch(post_time), self.granularity), []).append(vector)
+        for name, group in groups.items():
+            self.index.upsert(vectors=group, namespace=name, **kwargs)
+        with self._lock:
+            if self._namespaces is not None:
+                for name, group in groups.items():
+                    self._namespaces[name] = self._namespaces.get(name, 0) + len(group)
+
+    def delete(self, ids: Optional[List[str]] = None, delete_all: bool = False,
+               namespace: Optional[str] = None, **kwargs):
+        """Elimina per id (o tutto) in ogni partizione, salvo ``namespace`` esplicito."""
+        if namespace is not None:
+            return self.index.delete(ids=ids, delete_all=delete_all, namespace=namespace, **kwargs)
+        for name in self.list_partitions(refresh=True) or [LEGACY_NAMESPACE]:
+            if delete_all:
+                self.drop_partition(name)
+            else:
+                self.index.delete(ids=ids, namespace=name, **kwargs)
+
+    def fetch(self, ids: List[str], namespace: Optional[str] = None, **kwargs):
+        """Recupera i vettori per id cercandoli in tutte le partizioni."""
+        if namespace is not None:
+            return self.index.fetch(ids=ids, namespace=namespace, **kwargs)
+        names = list(self.list_partitions(refresh=True)) or [LEGACY_NAMESPACE]
+        results = [self.index.fetch(ids=ids, namespace=name, **kwargs) for name in names]
+        for result in results[1:]:
+            results[0].vectors.update(result.vectors or {})
+        return results[0]
+
+    def drop_partition(self, name: str):
+        """Elimina tutti i vettori di una partizione con una sola operazione."""
+        self.index.delete(delete_all=True, namespace=name)
+        with self._lock:
+            if self._namespaces is not None:
+                self._namespaces.pop(name, None)
+        logger.info(f"Dropped partition {name or '(default)'}")
+
+    def drop_partitions_before(self, epoch: int) -> List[str]:
+        """Elimina le partizioni interamente precedenti a ``epoch`` (retention)."""
+        dropped = []
+        for name in self.list_partitions(refresh=True):
+            bounds = partition_range(name)
+            if bounds is not None and bounds[1] <= epoch:
+                self.drop_partition(name)
+                dropped.append(name)
+        return dropped
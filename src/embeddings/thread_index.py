@@ -0,0 +1,134 @@
+import os
+import shutil
+import threading
+import logging
+from typing import Dict, List, Tuple
+import numpy as np
+from config import THREAD_INDEX_DIR, EMBEDDING_DIMENSION
+
+logger = logging.getLogger(__name__)
+
+_thread_index = None
+_thread_index_lock = threading.Lock()
+
+def compute_thread_vector(title_embedding, post_embeddings) -> np.ndarray:
+    """Centroide normalizzato del titolo e dei post (matrice o sequenza di vettori) di un thread."""
+    vectors = np.vstack((title_embedding, post_embeddings)).astype(np.float32, copy=False)
+    centroid = vectors.mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    return centroid / norm if norm > 0 else centroid
+
+class ThreadIndex:
+    """Piccolo indice locale con un vettore per thread, usato per la ricerca coarse-to-fine."""
+
+    def __init__(self, thread_ids: np.ndarray, vectors: np.ndarray):
+        self.thread_ids = thread_ids
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.thread_ids)
+
+    @classmethod
+    def empty(cls) -> "ThreadIndex":
+        return cls(
+            thread_ids=np.array([], dtype="<U32"),
+            vectors=np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32)
+        )
+
+    def merge(self, thread_vectors: Dict[str, np.ndarray]) -> "ThreadIndex":
+        """Restituisce un nuovo indice con i vettori dei thread aggiunti o sostituiti."""
+        if not thread_vectors:
+            return self
+        new_ids = np.array(list(thread_vectors.keys()))
+        new_vectors = np.stack(list(thread_vectors.values())).astype(np.float32, copy=False).reshape(-1, EMBEDDING_DIMENSION)
+        keep = ~np.isin(self.thread_ids, new_ids)
+        return ThreadIndex(
+            thread_ids=np.concatenate([self.thread_ids[keep], new_ids]),
+            vectors=np.concatenate([self.vectors[keep], new_vectors])
+        )
+
+    def without(self, thread_ids: List[str]) -> "ThreadIndex":
+        """Restituisce un nuovo indice senza i thread indicati."""
+        keep = ~np.isin(self.thread_ids, np.array(thread_ids))
+        return ThreadIndex(thread_ids=self.thread_ids[keep], vectors=self.vectors[keep])
+
+    def search(self, query_vector, top_k: int) -> List[Tuple[str, float]]:
+        """Thread più simili alla query (similarità coseno su vettori normalizzati)."""
+        if not len(self):
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        scores = self.vectors @ query
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(str(self.thread_ids[i]), float(scores[i])) for i in top]
+
+    def save(self, path: str = THREAD_INDEX_DIR):
+        """Salva l'indice sostituendo atomicamente la versione precedente."""
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        old_path = f"{path}.old-{os.getpid()}"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            np.save(os.path.join(tmp_path, "thread_ids.npy"), self.thread_ids)
+            np.save(os.path.join(tmp_path, "vectors.npy"), self.vectors)
+            if os.path.exists(path):
+                os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+            logger.info(f"Saved thread index with {len(self)} threads to {path}")
+        except Exception as e:
+            logger.error(f"Error saving thread index: {str(e)}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path: str = THREAD_INDEX_DIR) -> "ThreadIndex":
+        if not os.path.exists(os.path.join(path, "vectors.npy")):
+            return cls.empty()
+        index = cls(
+            thread_ids=np.load(os.path.join(path, "thread_ids.npy")),
+            vectors=np.load(os.path.join(path, "vectors.npy"))
+        )
+        logger.info(f"Loaded thread index with {len(index)} threads from {path}")
+        return index
+
+def _load_thread_index(path: str) -> ThreadIndex:
+    """Carica l'indice condiviso; va chiamata tenendo ``_thread_index_lock``."""
+    global _thread_index
+    if _thread_index is None:
+        try:
+            _thread_index = ThreadIndex.load(path)
+        except Exception as e:
+            logger.error(f"Error loading thread index: {str(e)}")
+            _thread_index = ThreadIndex.empty()
+    return _thread_index
+
+def get_thread_index(path: str = THREAD_INDEX_DIR) -> ThreadIndex:
+    """Restituisce l'indice dei thread del processo, caricandolo al primo accesso."""
+    with _thread_index_lock:
+        return _load_thread_index(path)
+
+def update_thread_index(thread_vectors: Dict[str, np.ndarray], path: str = THREAD_INDEX_DIR) -> ThreadIndex:
+    """Aggiorna i vettori dei thread indicizzati e salva l'indice."""
+    global _thread_index
+    with _thread_index_lock:
+        _thread_index = _load_thread_index(path).merge(thread_vectors)
+        _thread_index.save(path)
+        return _thread_index
+
+def remove_threads(thread_ids: List[str], path: str = THREAD_INDEX_DIR) -> ThreadIndex:
+    """Rimuove dall'indice i thread non più presenti e salva l'indice."""
+    global _thread_index
+    with _thread_index_lock:
+        _thread_index = _load_thread_index(path)
+        if thread_ids:
+            _thread_index = _thread_index.without(thread_ids)
+            _thread_index.save(path)
+        return _thread_index
+
+def clear_thread_index(path: str = THREAD_INDEX_DIR):
+    """Elimina l'indice dei thread."""
+    global _thread_index
+    with _thread_index_lock:
+        shutil.rmtree(path, ignore_errors=True)
+        _thread_index = ThreadIndex.empty()
@@ -0,0 +1,262 @@
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any
+import numpy as np
+from data.catalog import PostCatalog
+from .conversation import detect_date_range
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 10
+
+# Pattern (italiano/inglese) per riconoscere le domande di aggregazione.
+# L'ordine conta: vince il primo intent che corrisponde.
+INTENT_PATTERNS = [
+    ("sentiment_by_month", [
+        r"sentiment.*\b(per|al|ogni)\s+mese\b", r"sentiment.*\bmensil", r"sentiment.*\b(per|by|each)\s+month\b",
+        r"\bmonthly\s+sentiment", r"sentiment.*\bmonthly\b"
+    ]),
+    ("posts_by_month", [
+        r"\bpost\b.*\b(per|al|ogni)\s+mese\b", r"\bposts?\b.*\b(per|by|each)\s+month\b",
+        r"\bpost\s+mensili\b", r"\bmonthly\s+posts?\b"
+    ]),
+    ("top_authors", [
+        r"\bchi\b.*\b(scritto|postato|pubblicato|intervenuto)\b.*\bdi\s+più\b",
+        r"\b(utenti|autori|utente|autore)\b.*\bpiù\s+attiv", r"\bwho\b.*\b(posted|wrote)\b.*\bmost\b",
+        r"\bmost\s+active\s+(users?|authors?|posters?)\b", r"\btop\s+(\d+\s+)?(users?|authors?|posters?)\b"
+    ]),
+    ("top_threads", [
+        r"\bthread\b.*\bpiù\s+(attiv|discuss|lungh)", r"\bmost\s+active\s+threads?\b",
+        r"\btop\s+(\d+\s+)?threads?\b", r"\blongest\s+threads?\b"
+    ]),
+    ("top_keywords", [
+        r"\b(keyword|parole\s+chiave)\b.*\bpiù\b", r"\b(top|most\s+common|most\s+frequent)\s+(\d+\s+)?keywords?\b",
+        r"\bkeywords?\b.*\bmost\b"
+    ]),
+    ("average_sentiment", [
+        r"\bsentiment\s+medio\b", r"\bmedia\s+del\s+sentiment\b", r"\baverage\s+sentiment\b", r"\bmean\s+sentiment\b"
+    ]),
+    ("thread_count", [
+        r"\bquanti\s+thread\b", r"\bnumero\s+(totale\s+)?di\s+thread\b", r"\bhow\s+many\s+threads\b"
+    ]),
+    ("author_count", [
+        r"\bquanti\s+(utenti|autori)\b", r"\bnumero\s+(totale\s+)?di\s+(utenti|autori)\b",
+        r"\bhow\s+many\s+(users|authors|posters)\b"
+    ]),
+    ("post_count", [
+        r"\bquanti\s+post\b", r"\bnumero\s+(totale\s+)?di\s+post\b", r"\bhow\s+many\s+posts\b",
+        r"\b(total|count\s+of)\s+posts\b"
+    ]),
+]
+
+LIMIT_PATTERN = re.compile(r"\b(?:top|primi|prime|i\s+primi|first)\s+(\d{1,3})\b")
+
+# Qualificatori che restringono la domanda a una parte del catalogo
+TOPIC_PATTERN = re.compile(
+    r"\b(?:parla(?:no|to|ndo)?\s+(?:di|del|dello|della|dei|degli|delle|dell')|citano|menzionano|"
+    r"su|sul|sullo|sulla|sui|sugli|sulle|sull'|riguardo(?:\s+a)?|about|on|regarding|mentioning)\s+([^?!.,;:]+)"
+)
+AUTHOR_PATTERN = re.compile(r"(?:\b(?:da|di|by|from|utente|user|autore|author|scritto|scritti|postato|wrote|written|posted)\s+@?|@)([\w.\-]+)")
+QUOTED_PATTERN = re.compile(r"[\"“«]([^\"”»]+)[\"”»]")
+# Parole che chiudono l'argomento: ciò che segue è un altro qualificatore
+TOPIC_STOP_WORDS = {
+    "nel", "nei", "nella", "nelle", "negli", "in", "dal", "dalla", "dai", "da", "per", "al", "a", "di",
+    "tra", "fra", "durante", "ogni", "con", "e", "o", "since", "from", "by", "during", "each", "per",
+    "with", "and", "or", "ultimi", "ultima", "ultimo", "last", "scritti", "scritto", "written", "posted"
+}
+TOPIC_ARTICLES = {"il", "lo", "la", "i", "gli", "le", "un", "una", "the", "a", "an"}
+# Argomenti che indicano l'intero catalogo
+WHOLE_CATALOG_TOPICS = {"forum", "catalogo", "database", "sito", "tutto", "tutti", "site", "all", "everything"}
+
+@dataclass
+class AggregateIntent:
+    """Domanda di aggregazione riconosciuta."""
+    name: str
+    limit: int = DEFAULT_LIMIT
+
+@dataclass
+class AggregateResult:
+    """Tabella calcolata per rispondere a una domanda di aggregazione."""
+    title: str
+    columns: List[str]
+    rows: List[List[Any]] = field(default_factory=list)
+
+    def to_markdown(self) -> str:
+        """Formatta il risultato come tabella markdown."""
+        lines = [
+            f"**{self.title}**",
+            "",
+            "| " + " | ".join(self.columns) + " |",
+            "| " + " | ".join("---" for _ in self.columns) + " |"
+        ]
+        for row in self.rows:
+            lines.append("| " + " | ".join(
+                f"{value:.3f}" if isinstance(value, float) else str(value) for value in row
+            ) + " |")
+        return "\n".join(lines)
+
+def detect_aggregate_intent(query: str) -> Optional[AggregateIntent]:
+    """Riconosce le domande che si risolvono con conteggi e group-by sul catalogo."""
+    text = query.lower()
+    for name, patterns in INTENT_PATTERNS:
+        if any(re.search(pattern, text) for pattern in patterns):
+            limit_match = LIMIT_PATTERN.search(text)
+            limit = int(limit_match.group(1)) if limit_match else DEFAULT_LIMIT
+            return AggregateIntent(name=name, limit=max(1, limit))
+    return None
+
+@dataclass
+class AggregateScope:
+    """Parte del catalogo a cui si riferisce la domanda (None = tutto il catalogo)."""
+    mask: Optional[np.ndarray] = None
+    labels: List[str] = field(default_factory=list)
+
+def extract_topic(text: str) -> Optional[str]:
+    """Argomento della domanda ("parlano di bitcoin" → "bitcoin"), senza articoli e altri qualificatori."""
+    match = TOPIC_PATTERN.search(text)
+    if not match:
+        return None
+    words = []
+    for word in match.group(1).split():
+        if word in TOPIC_STOP_WORDS:
+            break
+        words.append(word)
+    while words and words[0] in TOPIC_ARTICLES:
+        words.pop(0)
+    return " ".join(words) or None
+
+class AggregateQueryEngine:
+    """Risponde esattamente alle domande di aggregazione con calcoli vettoriali sul catalogo."""
+
+    def __init__(self, catalog: PostCatalog):
+        self.catalog = catalog
+
+    def thread_title_mask(self, text: str) -> Optional[np.ndarray]:
+        """Post dei thread il cui titolo contiene ``text`` (None se nessuno)."""
+        codes = [code for code, thread in enumerate(self.catalog.threads) if text in thread["title"].lower()]
+        if not codes:
+            return None
+        return np.isin(self.catalog.thread_codes, codes)
+
+    def resolve_scope(self, query: str) -> Optional[AggregateScope]:
+        """Traduce thread, autori, date e argomenti della domanda in filtri sul catalogo.
+
+        Restituisce None se un qualificatore non corrisponde a nulla nel
+        catalogo (ad es. un argomento che non è una keyword né un titolo):
+        la domanda va allora risolta con il retrieval.
+        """
+        catalog = self.catalog
+        text = re.sub(r"(\w)'", r"\1' ", query.lower())
+        mask = np.ones(len(catalog), dtype=bool)
+        labels = []
+        authors: Dict[str, str] = {author.lower(): author for author in catalog.authors}
+        keywords: Dict[str, str] = {keyword.lower(): keyword for keyword in catalog.keywords}
+
+        for name in AUTHOR_PATTERN.findall(text):
+            author = authors.get(name)
+            if author is not None:
+                mask &= catalog.filter(author=author)
+                labels.append(f"autore: {author}")
+
+        date_range = detect_date_range(query, int(catalog.post_times.max()) if len(catalog) else 0)
+        if date_range is not None:
+            start, end = date_range
+            mask &= catalog.filter(start=start, end=end)
+            labels.append("periodo: " + " – ".join(
+                str(np.datetime64(value, "s").astype("datetime64[D]")) if value is not None else "…"
+                for value in (start, end)
+            ))
+
+        topics = QUOTED_PATTERN.findall(text)
+        topic = extract_topic(text)
+        if topic is not None and topic not in WHOLE_CATALOG_TOPICS and topic not in authors:
+            topics.append(topic)
+        for topic in topics:
+            topic = topic.strip()
+            if topic in keywords:
+                mask &= catalog.filter(keyword=keywords[topic])
+                labels.append(f"keyword: {keywords[topic]}")
+                continue
+            thread_mask = self.thread_title_mask(topic)
+            if thread_mask is None:
+                logger.info(f"Aggregate topic '{topic}' not found among keywords or thread titles")
+                return None
+            mask &= thread_mask
+            labels.append(f"thread: {topic}")
+
+        return AggregateScope(mask if labels else None, labels)
+
+    def month_groups(self):
+        """Mesi distinti (YYYY-MM) e indice del mese per ogni post."""
+        months = np.asarray(self.catalog.post_times).astype("datetime64[s]").astype("datetime64[M]")
+        unique_months, inverse = np.unique(months, return_inverse=True)
+        return [str(month) for month in unique_months], inverse
+
+    def top_counts(self, codes: np.ndarray, labels: List[str], limit: int) -> List[List[Any]]:
+        counts = np.bincount(codes, minlength=len(labels))
+        top = np.argsort(counts, kind="stable")[::-1][:limit]
+        return [[labels[code], int(counts[code])] for code in top if counts[code] > 0]
+
+    def answer(self, intent: AggregateIntent, scope: Optional[AggregateScope] = None) -> AggregateResult:
+        if scope is not None and scope.mask is not None:
+            result = AggregateQueryEngine(self.catalog.without(~scope.mask)).answer(intent)
+            result.title = f"{result.title} — {', '.join(scope.labels)}"
+            return result
+        catalog = self.catalog
+        name = intent.name
+
+        if name == "post_count":
+            return AggregateResult("Totale post", ["Post", "Thread", "Autori"], [[
+                len(catalog),
+                int(np.unique(catalog.thread_codes).size),
+                int(np.unique(catalog.author_codes).size)
+            ]])
+
+        if name == "thread_count":
+            return AggregateResult("Totale thread", ["Thread"], [[int(np.unique(catalog.thread_codes).size)]])
+
+        if name == "author_count":
+            return AggregateResult("Totale autori", ["Autori"], [[int(np.unique(catalog.author_codes).size)]])
+
+        if name == "top_authors":
+            return AggregateResult(
+                f"Autori più attivi (top {intent.limit})", ["Autore", "Post"],
+                self.top_counts(catalog.author_codes, catalog.authors, intent.limit)
+            )
+
+        if name == "top_threads":
+            titles = [thread["title"] for thread in catalog.threads]
+            return AggregateResult(
+                f"Thread più attivi (top {intent.limit})", ["Thread", "Post"],
+                self.top_counts(catalog.thread_codes, titles, intent.limit)
+            )
+
+        if name == "top_keywords":
+            return AggregateResult(
+                f"Keyword più frequenti (top {intent.limit})", ["Keyword", "Occorrenze"],
+                self.top_counts(catalog.keyword_codes, catalog.keywords, intent.limit)
+            )
+
+        if name == "average_sentiment":
+            if not len(catalog):
+                return AggregateResult("Sentiment medio", ["Sentiment medio", "Min", "Max", "Post"])
+            sentiments = np.asarray(catalog.sentiments, dtype=np.float64)
+            return AggregateResult("Sentiment medio", ["Sentiment medio", "Min", "Max", "Post"], [[
+                float(sentiments.mean()), float(sentiments.min()), float(sentiments.max()), len(catalog)
+            ]])
+
+        if name in ("sentiment_by_month", "posts_by_month"):
+            months, inverse = self.month_groups()
+            counts = np.bincount(inverse, minlength=len(months))
+            if name == "posts_by_month":
+                return AggregateResult("Post per mese", ["Mese", "Post"], [
+                    [month, int(count)] for month, count in zip(months, counts)
+                ])
+            sums = np.bincount(inverse, weights=catalog.sentiments, minlength=len(months))
+            return AggregateResult("Sentiment medio per mese", ["Mese", "Sentiment medio", "Post"], [
+                [month, float(total / count), int(count)]
+                for month, total, count in zip(months, sums, counts) if count
+            ])
+
+        raise ValueError(f"Unsupported aggregate intent: {name}")
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from config import LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+# Interruttore per la richiesta corrente: ereditato dai task creati nello stesso contesto
+llm_cache_enabled: ContextVar[bool] = ContextVar("llm_cache_enabled", default=True)
+
+class LLMResponseCache:
+    """Cache persistente (SQLite) delle risposte LLM con TTL e numero massimo di voci.
+
+    La chiave è l'hash di modello, temperatura, max_tokens e messaggi esatti;
+    il valore è il testo della risposta con l'uso dei token.
+    """
+
+    def __init__(self,
+                 path: str = LLM_CACHE_PATH,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    content TEXT NOT NULL,
+                    usage TEXT,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(llm, messages: List) -> str:
+        """Hash della richiesta: modello, parametri di campionamento e messaggi esatti."""
+        payload = json.dumps({
+            "model": llm.model_name,
+            "temperature": llm.temperature,
+            "max_tokens": llm.max_tokens,
+            "messages": [[type(message).__name__, message.content] for message in messages]
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict]]:
+        """Restituisce (contenuto, uso token) se presente e non scaduto."""
+        now = time.time()
+        try:
+            with self._lock:
+                row = self.connection.execute(
+                    "SELECT content, usage FROM llm_cache WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self.connection.commit()
+            return row[0], json.loads(row[1] or "{}")
+        except Exception as e:
+            logger.error(f"Error reading LLM cache: {str(e)}")
+            return None
+
+    def set(self, key: str, model: str, content: str, usage: Optional[Dict] = None):
+        """Salva la risposta e rimuove le voci scadute o meno usate oltre il limite."""
+        now = time.time()
+        try:
+            with self._lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, model, content, usage, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, content, json.dumps(usage or {}), now, now)
+                )
+                self.connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+                self.connection.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+                self.connection.commit()
+        except Exception as e:
+            logger.error(f"Error writing LLM cache: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM llm_cache")
+            self.connection.commit()
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """Restituisce la cache condivisa dal processo (None se non disponibile)."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            try:
+                _response_cache = LLMResponseCache()
+            except Exception as e:
+                logger.error(f"Error opening LLM cache: {str(e)}")
+                return None
+        return _response_cache
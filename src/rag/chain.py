@@ -1,25 +1,67 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 import streamlit as st
 import logging
-from datetime import datetime
-from .swarm import OpenAISwarm
-from .templates import template
-import asyncio
+from config import LLM_MODEL, LLM_CACHE_ENABLED, CASCADE_ENABLED, STREAM_RETRIEVAL_ENABLED
+from data.catalog import to_epoch, get_catalog
+from .swarm import get_swarm
+from .clients import get_llm
+from .runtime import UIBridge
+from .analytics import detect_aggregate_intent, AggregateQueryEngine
+from .summaries import is_broad_query, get_summary_store
+from .conversation import ConversationTurn, classify_follow_up, filter_documents
+from .templates import template, aggregate_template
+from .ratelimit import get_rate_limiter, response_token_usage
+from .tokens import estimate_request_tokens
+import time
 
 logger = logging.getLogger(__name__)
 
 def setup_rag_chain(retriever):
     """Configura una chain RAG con sistema multi-agente."""
-    llm = ChatOpenAI(
-        model_name="gpt-3.5-turbo-16k",
-        temperature=0.3,
-        api_key=st.secrets["OPENAI_API_KEY"]
-    )
+    # Client e swarm sono condivisi dal processo: la chain si può ricreare ad ogni turno
+    llm = get_llm("gpt-3.5-turbo-16k", temperature=0.3)
 
-    swarm = OpenAISwarm()
+    # Modello economico per formulare le risposte calcolate sul catalogo
+    aggregate_llm = get_llm(LLM_MODEL, temperature=0, max_tokens=500, request_timeout=20)
+
+    swarm = get_swarm()
+    rate_limiter = get_rate_limiter()
+    
+    def answer_aggregate_query(query, intent, status):
+        """Risponde a una domanda di aggregazione senza retrieval né swarm."""
+        start_time = time.perf_counter()
+        catalog = get_catalog()
+        if not len(catalog):
+            return None
+        
+        engine = AggregateQueryEngine(catalog)
+        scope = engine.resolve_scope(query)
+        if scope is None:
+            logger.info(f"Aggregate query '{intent.name}' has qualifiers outside the catalog, using retrieval")
+            return None
+        
+        result = engine.answer(intent, scope)
+        table = result.to_markdown()
+        scoped_posts = len(catalog) if scope.mask is None else int(scope.mask.sum())
+        st.write(f"🧮 Domanda di aggregazione ({intent.name}): calcolo esatto su {scoped_posts} post")
+        logger.info(f"Aggregate query '{intent.name}' computed in {time.perf_counter() - start_time:.3f}s")
+        
+        try:
+            messages = [HumanMessage(content=aggregate_template.format(table=table, query=query))]
+            with rate_limiter.limit_blocking(estimate_request_tokens(messages, aggregate_llm.max_tokens)) as reservation:
+                response = aggregate_llm.invoke(messages)
+                reservation.settle(response_token_usage(response))
+            answer = response.content.strip() if response and response.content else ""
+        except Exception as e:
+            logger.warning(f"Aggregate phrasing failed, returning table only: {str(e)}")
+            answer = ""
+        
+        logger.info(f"Aggregate query answered in {time.perf_counter() - start_time:.3f}s")
+        status.update(label="✅ Analisi completata!", state="complete")
+        return {"result": f"{answer}\n\n{table}" if answer else table}
     
-    def get_response(query_input):
+    def get_response(query_input, on_token=None):
+        """Risponde alla query; ``on_token`` riceve il testo accumulato durante lo streaming."""
         try:
             # Gestisci sia input stringa che dizionario
             query = query_input.get("query", "") if isinstance(query_input, dict) else query_input
@@ -29,12 +71,95 @@ def setup_rag_chain(retriever):
                 st.write("📝 Elaborazione query in corso...")
                 logger.info(f"Processing query: {query}")
                 
+                # Le domande di aggregazione si risolvono esattamente sul catalogo
+                intent = detect_aggregate_intent(query)
+                if intent is not None:
+                    try:
+                        aggregate_response = answer_aggregate_query(query, intent, status)
+                        if aggregate_response is not None:
+                            st.session_state.conversation = None
+                            return aggregate_response
+                    except Exception as e:
+                        logger.warning(f"Aggregate query failed: {str(e)}. Falling back to retrieval.")
+                
+                # Domande di follow-up: si riusano post e analisi del turno precedente
+                try:
+                    query_embedding = retriever.embeddings.embed_query(query)
+                except Exception as e:
+                    logger.warning(f"Query embedding failed: {str(e)}")
+                    query_embedding = None
+                previous_turn = st.session_state.get('conversation')
+                follow_up = classify_follow_up(query, query_embedding, previous_turn)
+                if follow_up.kind == "refinement":
+                    try:
+                        start_time = time.monotonic()
+                        follow_up_docs, filtered = filter_documents(previous_turn.documents, follow_up)
+                        st.write(f"🔁 Domanda di follow-up: riuso {len(follow_up_docs)} post e le analisi del turno precedente")
+                        bridge = UIBridge()
+                        answer = bridge.run(swarm.answer_follow_up(
+                            query, previous_turn, follow_up_docs, filtered,
+                            on_token=bridge.callback(on_token) if on_token is not None else None,
+                            use_cache=st.session_state.get('use_llm_cache', LLM_CACHE_ENABLED)
+                        ))
+                        if answer:
+                            logger.info(
+                                f"Follow-up answered from previous turn (similarity {follow_up.similarity:.2f}, "
+                                f"{len(follow_up_docs)} posts) in {time.monotonic() - start_time:.1f}s"
+                            )
+                            previous_turn.query, previous_turn.answer = query, answer
+                            status.update(label="✅ Analisi completata!", state="complete")
+                            return {"result": answer}
+                    except Exception as e:
+                        logger.warning(f"Follow-up reuse failed: {str(e)}. Running full retrieval.")
+                else:
+                    logger.info(f"New topic (similarity {follow_up.similarity:.2f}): running full retrieval")
+                
+                # Query dirette allo swarm: retrieval in streaming, gli agenti partono appena arrivano i thread
+                broad_query = is_broad_query(query)
+                if (STREAM_RETRIEVAL_ENABLED and retriever.reranker is None and retriever.can_stream()
+                        and (broad_query or not CASCADE_ENABLED)
+                        and not (broad_query and len(get_summary_store()))):
+                    try:
+                        turn = ConversationTurn(query=query, query_embedding=query_embedding)
+                        st.session_state.conversation = turn
+                        num_agents = st.session_state.get('num_agents', 3)
+                        st.write(f"🌊 Retrieval in streaming verso al massimo {num_agents} agenti...")
+                        bridge = UIBridge()
+                        result = bridge.run(swarm.process_document_stream(
+                            retriever.stream_relevant_documents(query, query_embedding), query, bridge.proxy(status),
+                            on_token=bridge.callback(on_token) if on_token is not None else None,
+                            num_agents=num_agents,
+                            show_agent_details=st.session_state.get('show_agent_details', False),
+                            use_cache=st.session_state.get('use_llm_cache', LLM_CACHE_ENABLED),
+                            incremental_synthesis=st.session_state.get('incremental_synthesis', False),
+                            analyses_sink=turn.analyses,
+                            documents_sink=turn.documents
+                        ))
+                        if not turn.documents:
+                            logger.warning("No documents found in database")
+                            st.session_state.conversation = None
+                            return {"result": "Non ho trovato dati sufficienti per rispondere."}
+                        if not result:
+                            raise ValueError("Empty result from streaming multi-agent processing")
+                        logger.info(f"Streaming retrieval: {len(turn.documents)} documents kept for follow-ups")
+                        turn.answer = result
+                        status.update(label="✅ Analisi completata!", state="complete")
+                        return {"result": result}
+                    except Exception as e:
+                        logger.warning(f"Streaming pipeline failed: {str(e)}. Falling back to batch retrieval.")
+                
                 # Ottieni i documenti rilevanti
-                docs = retriever.get_relevant_documents(query)
+                docs = retriever.get_relevant_documents(query, query_embedding=query_embedding)
                 if not docs:
                     logger.warning("No documents found in database")
                     return {"result": "Non ho trovato dati sufficienti per rispondere."}
                 
+                # Stato del turno, riusato dalle domande successive
+                turn = None
+                if docs[0].metadata.get("type") != "error":
+                    turn = ConversationTurn(query=query, query_embedding=query_embedding, documents=docs)
+                st.session_state.conversation = turn
+                
                 num_docs = len(docs)
                 st.write(f"📚 Recuperati {num_docs} documenti dal database")
                 logger.info(f"Retrieved {num_docs} documents from the database")
@@ -44,22 +169,64 @@ def setup_rag_chain(retriever):
                 for i, doc in enumerate(docs):
                     logger.info(f"Doc {i+1}: Author: {doc.metadata.get('author')}, Time: {doc.metadata.get('post_time')}")
                 
-                try:
-                    # Inizializza event loop per lo swarm
+                # Domande di panoramica: i thread meno rilevanti passano dalle sintesi precalcolate
+                thread_summaries = None
+                if is_broad_query(query):
+                    summary_store = get_summary_store()
+                    if len(summary_store):
+                        thread_summaries = summary_store.get_many({doc.metadata.get('thread_id') for doc in docs})
+                        if thread_summaries:
+                            st.write(f"📑 Panoramica: sintesi disponibili per {len(thread_summaries)} thread")
+                            logger.info(f"Broad query: {len(thread_summaries)} thread summaries available")
+                
+                # Cascata: una chiamata rapida sui post più rilevanti, lo swarm solo se serve
+                if CASCADE_ENABLED and thread_summaries is None and not is_broad_query(query):
                     try:
-                        loop = asyncio.get_event_loop()
-                    except RuntimeError:
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                    
-                    # Processa i documenti con lo swarm
+                        st.write("⚡ Risposta rapida sui post più rilevanti...")
+                        start_time = time.monotonic()
+                        bridge = UIBridge()
+                        answer, confidence = bridge.run(swarm.quick_answer(
+                            docs, query,
+                            on_token=bridge.callback(on_token) if on_token is not None else None,
+                            use_cache=st.session_state.get('use_llm_cache', LLM_CACHE_ENABLED)
+                        ))
+                        elapsed = time.monotonic() - start_time
+                        if answer:
+                            if turn is not None:
+                                turn.answer = answer
+                            saved = f", ~{swarm.swarm_latency - elapsed:.1f}s saved" if swarm.swarm_latency else ""
+                            logger.info(f"Cascade: answered directly (confidence {confidence}) in {elapsed:.1f}s{saved}")
+                            status.update(label="✅ Risposta rapida completata!", state="complete")
+                            return {"result": answer}
+                        logger.info(f"Cascade: escalating to swarm (confidence {confidence}) after {elapsed:.1f}s")
+                        st.write(f"🔀 Confidenza {confidence}/100: passo all'analisi multi-agente")
+                    except Exception as e:
+                        logger.warning(f"Cascade quick answer failed: {str(e)}. Escalating to swarm.")
+                else:
+                    logger.info("Cascade: broad query routed directly to swarm")
+                
+                try:
+                    # Processa i documenti con lo swarm sul loop condiviso in background;
+                    # gli aggiornamenti UI tornano al thread dello script tramite il bridge
                     num_agents = st.session_state.get('num_agents', 3)
-                    st.write(f"🤖 Avvio elaborazione con {num_agents} agenti...")
-                    result = loop.run_until_complete(swarm.process_documents(docs, query, status))
+                    st.write(f"🤖 Avvio elaborazione con al massimo {num_agents} agenti...")
+                    bridge = UIBridge()
+                    result = bridge.run(swarm.process_documents(
+                        docs, query, bridge.proxy(status),
+                        on_token=bridge.callback(on_token) if on_token is not None else None,
+                        num_agents=num_agents,
+                        show_agent_details=st.session_state.get('show_agent_details', False),
+                        use_cache=st.session_state.get('use_llm_cache', LLM_CACHE_ENABLED),
+                        incremental_synthesis=st.session_state.get('incremental_synthesis', False),
+                        thread_summaries=thread_summaries,
+                        analyses_sink=turn.analyses if turn is not None else None
+                    ))
                     
                     if not result:
                         raise ValueError("Empty result from multi-agent processing")
                         
+                    if turn is not None:
+                        turn.answer = result
                     status.update(label="✅ Analisi completata!", state="complete")
                     return {"result": result}
 
@@ -74,6 +241,7 @@ def setup_rag_chain(retriever):
                         post = {
                             "author": doc.metadata.get("author", "Unknown"),
                             "time": doc.metadata.get("post_time", "Unknown"),
+                            "epoch": doc.metadata.get("post_epoch"),
                             "content": doc.metadata.get("text", ""),
                             "thread_title": doc.metadata.get("thread_title", "Unknown Thread")
                         }
@@ -81,7 +249,7 @@ def setup_rag_chain(retriever):
                     
                     # Ordina i post per timestamp
                     try:
-                        posts_context.sort(key=lambda x: datetime.fromisoformat(x["time"]))
+                        posts_context.sort(key=lambda x: x["epoch"] if x["epoch"] is not None else to_epoch(x["time"]))
                         logger.info("Posts sorted by timestamp successfully")
                     except (ValueError, TypeError) as e:
                         logger.warning(f"Could not sort posts by timestamp: {e}")
@@ -104,13 +272,25 @@ def setup_rag_chain(retriever):
                     # Ottieni la risposta dal LLM
                     try:
                         st.write("🤔 Elaborazione risposta standard...")
-                        response = llm.invoke(messages)
-                        if not response or not hasattr(response, 'content'):
-                            raise ValueError("Invalid response from LLM")
+                        with rate_limiter.limit_blocking(estimate_request_tokens(messages, llm.max_tokens)) as reservation:
+                            if on_token is not None:
+                                content = ""
+                                for chunk in llm.stream(messages):
+                                    if chunk.content:
+                                        content += chunk.content
+                                        on_token(content)
+                            else:
+                                response = llm.invoke(messages)
+                                if not response or not hasattr(response, 'content'):
+                                    raise ValueError("Invalid response from LLM")
+                                content = response.content
+                                reservation.settle(response_token_usage(response))
                             
                         logger.info("LLM response received successfully")
+                        if turn is not None:
+                            turn.answer = content
                         status.update(label="✅ Analisi completata!", state="complete")
-                        return {"result": response.content}
+                        return {"result": content}
                     except Exception as e:
                         logger.error(f"Error getting LLM response: {str(e)}")
                         status.update(label="❌ Errore nell'analisi", state="error")
@@ -0,0 +1,39 @@
+import threading
+import logging
+from typing import Optional
+from langchain_openai import ChatOpenAI
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+_llm_clients = {}
+_llm_clients_lock = threading.Lock()
+
+def get_llm(model_name: str,
+            temperature: float = 0.3,
+            max_tokens: Optional[int] = None,
+            request_timeout: Optional[float] = None,
+            max_retries: int = 2) -> ChatOpenAI:
+    """Restituisce un client ChatOpenAI condiviso dal processo per la configurazione data.
+
+    I client restano vivi tra un turno di chat e l'altro, così il pool HTTP
+    keep-alive del client OpenAI (connessioni e sessioni TLS) viene riusato.
+    """
+    key = (model_name, temperature, max_tokens, request_timeout, max_retries)
+    with _llm_clients_lock:
+        llm = _llm_clients.get(key)
+        if llm is None:
+            api_key = st.secrets["OPENAI_API_KEY"]
+            if not api_key:
+                raise ValueError("OpenAI API key not found")
+            llm = ChatOpenAI(
+                model_name=model_name,
+                temperature=temperature,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                request_timeout=request_timeout,
+                max_retries=max_retries
+            )
+            _llm_clients[key] = llm
+            logger.info(f"Created LLM client {model_name} (max_tokens={max_tokens})")
+        return llm
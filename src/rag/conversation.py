@@ -0,0 +1,143 @@
+import re
+import logging
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+import numpy as np
+from config import FOLLOW_UP_SIMILARITY, FOLLOW_UP_MARKER_SIMILARITY, FOLLOW_UP_MAX_WORDS
+from .records import Post
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 24 * 3600
+
+# Segnali (italiano/inglese) di una domanda che prosegue il turno precedente: solo anafore
+# esplicite ai risultati, non pronomi generici che compaiono anche nelle domande nuove
+FOLLOW_UP_PATTERNS = [
+    r"^(e|ma)\s+invece\b", r"^invece\b", r"^(and\s+)?(what|how)\s+about\b",
+    r"\b(di|tra|fra|su)\s+(questi|queste|quelli|quelle)\b", r"^(quelli|quelle)\b",
+    r"\b(questi|queste|quei|quegli|quelle)\s+(post|thread|utenti|autori|messaggi)\b",
+    r"\b(of|among|from)\s+(these|those|them)\b", r"\b(these|those)\s+(posts|threads|users|authors)\b",
+    r"\bchi\s+l'ha\s+(detto|scritto)\b", r"\bwho\s+said\s+(that|it)\b",
+    r"\b(più\s+dettagli|approfondisci|spiega\s+meglio|elabora|more\s+details|elaborate|expand)\b",
+    r"\b(qui\s+sopra|risposta\s+precedente|analisi\s+precedente|prima\s+risposta|previous\s+answer|above)\b"
+]
+
+# Finestre temporali relative: (pattern, giorni); il gruppo catturato, se presente, è il numero di giorni
+TIME_WINDOW_PATTERNS = [
+    (r"\b(?:ultimi|last)\s+(\d{1,3})\s+(?:giorni|days)\b", None),
+    (r"\b(?:settimana\s+scorsa|ultima\s+settimana|last\s+week)\b", 7),
+    (r"\b(?:mese\s+scorso|ultimo\s+mese|last\s+month)\b", 30),
+    (r"\b(?:ieri|yesterday)\b", 2),
+    (r"\b(?:oggi|today)\b", 1),
+]
+
+# Mesi (italiano/inglese) per riconoscere le date citate nelle domande
+MONTHS = {
+    "gennaio": 1, "febbraio": 2, "marzo": 3, "aprile": 4, "maggio": 5, "giugno": 6, "luglio": 7,
+    "agosto": 8, "settembre": 9, "ottobre": 10, "novembre": 11, "dicembre": 12,
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6, "july": 7,
+    "august": 8, "september": 9, "october": 10, "november": 11, "december": 12
+}
+MONTH_YEAR_PATTERN = rf"\b({'|'.join(MONTHS)})\s+((?:19|20)\d{{2}})\b"
+# Anni solo con un contesto di data ("nel 2021", "2020-2022"): numeri come "RTX 2080" non sono anni
+YEAR_PATTERNS = [
+    r"\b(?:nel|nell'anno|del|dal|al|entro\s+il|anno|in|during|since|until|year)\s+((?:19|20)\d{2})\b",
+    r"\b((?:19|20)\d{2})\s*[-–/]\s*((?:19|20)\d{2})\b",
+    r"\b(?:tra|fra|between)\s+(?:il\s+)?((?:19|20)\d{2})\s+(?:e|and)\s+(?:il\s+)?((?:19|20)\d{2})\b"
+]
+
+@dataclass
+class ConversationTurn:
+    """Stato di un turno di chat riusabile dalle domande successive."""
+    query: str
+    query_embedding: Optional[np.ndarray]
+    documents: List[Post] = field(default_factory=list)
+    analyses: List[str] = field(default_factory=list)
+    answer: str = ""
+
+@dataclass
+class FollowUp:
+    """Classificazione della nuova domanda rispetto al turno precedente."""
+    kind: str  # "refinement" oppure "new_topic"
+    similarity: float = 0.0
+    time_window_days: Optional[int] = None
+
+def detect_time_window(query: str) -> Optional[int]:
+    """Giorni della finestra temporale richiesta ("settimana scorsa", "last 3 days"...)."""
+    text = query.lower()
+    for pattern, days in TIME_WINDOW_PATTERNS:
+        match = re.search(pattern, text)
+        if match:
+            return int(match.group(1)) if days is None else days
+    return None
+
+def detect_date_range(query: str, reference_epoch: int) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """Intervallo [inizio, fine) in epoch a cui si riferisce la domanda, se presente.
+
+    Riconosce mese e anno ("marzo 2024"), anni con un contesto di data
+    ("nel 2023", "2020-2022") e finestre relative ("ultimi 7 giorni"), queste
+    ultime rispetto a ``reference_epoch``. Gli anni successivi a quello di
+    ``reference_epoch`` (l'ultimo post del catalogo) vengono ignorati.
+    """
+    text = query.lower()
+    max_year = datetime.fromtimestamp(reference_epoch, tz=timezone.utc).year
+    month_years = [(month, year) for month, year in re.findall(MONTH_YEAR_PATTERN, text) if int(year) <= max_year]
+    if month_years:
+        starts = [datetime(int(year), MONTHS[month], 1, tzinfo=timezone.utc) for month, year in month_years]
+        last = max(starts)
+        end = datetime(last.year + last.month // 12, last.month % 12 + 1, 1, tzinfo=timezone.utc)
+        return int(min(starts).timestamp()), int(end.timestamp())
+    years = [
+        int(year) for pattern in YEAR_PATTERNS for match in re.findall(pattern, text)
+        for year in (match if isinstance(match, tuple) else (match,)) if int(year) <= max_year
+    ]
+    if years:
+        return (int(datetime(min(years), 1, 1, tzinfo=timezone.utc).timestamp()),
+                int(datetime(max(years) + 1, 1, 1, tzinfo=timezone.utc).timestamp()))
+    days = detect_time_window(text)
+    if days is not None:
+        return reference_epoch - days * DAY_SECONDS, None
+    return None
+
+def classify_follow_up(query: str, query_embedding, previous: Optional[ConversationTurn]) -> FollowUp:
+    """Decide se la domanda raffina il turno precedente o apre un nuovo argomento.
+
+    È un raffinamento se la domanda è molto simile alla precedente, oppure se
+    è breve, contiene riferimenti anaforici o una finestra temporale e ha
+    comunque una similarità minima con la precedente.
+    """
+    if previous is None or not previous.documents:
+        return FollowUp("new_topic")
+
+    similarity = 0.0
+    if query_embedding is not None and previous.query_embedding is not None:
+        a = np.asarray(query_embedding, dtype=np.float32)
+        b = np.asarray(previous.query_embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+        similarity = float(a @ b) / norm if norm > 0 else 0.0
+
+    text = query.lower().strip()
+    time_window = detect_time_window(text)
+    short = len(text.split()) <= FOLLOW_UP_MAX_WORDS
+    has_marker = any(re.search(pattern, text) for pattern in FOLLOW_UP_PATTERNS)
+
+    contextual = short and (has_marker or time_window is not None) and similarity >= FOLLOW_UP_MARKER_SIMILARITY
+    if similarity >= FOLLOW_UP_SIMILARITY or contextual:
+        return FollowUp("refinement", similarity, time_window)
+    return FollowUp("new_topic", similarity)
+
+def filter_documents(documents: List[Post], follow_up: FollowUp) -> Tuple[List[Post], bool]:
+    """Applica la finestra temporale del raffinamento ai documenti del turno precedente.
+
+    La finestra è relativa all'ultimo post dell'insieme (i dati sono scrape
+    storici); se nessun post vi rientra restituisce l'insieme completo e False.
+    """
+    if follow_up.time_window_days is None or not documents:
+        return documents, False
+    epochs = np.array([doc.metadata.get('post_epoch') or 0 for doc in documents], dtype=np.int64)
+    cutoff = epochs.max() - follow_up.time_window_days * DAY_SECONDS
+    filtered = [doc for doc, epoch in zip(documents, epochs) if epoch >= cutoff]
+    if not filtered:
+        return documents, False
+    return filtered, True
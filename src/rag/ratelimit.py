@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from config import (
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_CONCURRENCY,
+    LLM_MIN_CONCURRENCY,
+    LLM_LATENCY_TARGET,
+    LLM_RATE_LIMIT_COOLDOWN
+)
+
+logger = logging.getLogger(__name__)
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def response_token_usage(response) -> Optional[int]:
+    """Token totali riportati dal provider nella risposta, se presenti."""
+    usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+class Reservation:
+    """Token prenotati nel bucket per una chiamata.
+
+    ``settle`` registra l'uso effettivo: all'uscita dal limitatore la
+    differenza con la prenotazione torna nel bucket (o ne viene tolta, se la
+    risposta è stata più lunga del previsto). Senza ``settle`` resta la stima.
+    """
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.used = None
+
+    def settle(self, used: Optional[int]):
+        if used:
+            self.used = used
+
+class LimiterWaitClock:
+    """Tempo in cui le chiamate di una query sono ferme sul limitatore.
+
+    Conta gli intervalli con almeno una chiamata in attesa di uno slot e
+    nessuna in corso: la query non avanza per i limiti condivisi, non per la
+    lentezza dei suoi agenti. Va usato da un solo event loop.
+    """
+
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.stalled = 0.0
+        self.stalled_since = None
+
+    def track(self, waiting: int = 0, running: int = 0):
+        now = time.monotonic()
+        if self.stalled_since is not None:
+            self.stalled += now - self.stalled_since
+            self.stalled_since = None
+        self.waiting += waiting
+        self.running += running
+        if self.waiting > 0 and self.running == 0:
+            self.stalled_since = now
+
+    def stalled_seconds(self) -> float:
+        if self.stalled_since is None:
+            return self.stalled
+        return self.stalled + time.monotonic() - self.stalled_since
+
+# Orologio dell'attesa sul limitatore della query corrente
+limiter_wait_clock: ContextVar[Optional[LimiterWaitClock]] = ContextVar("limiter_wait_clock", default=None)
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Riconosce le risposte 429 del provider."""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return type(error).__name__ == "RateLimitError"
+
+class RateLimiter:
+    """Limitatore di processo per le richieste LLM.
+
+    Due token bucket (richieste/minuto e token/minuto) più un limite di
+    concorrenza adattivo AIMD: cresce di poco ad ogni risposta rapida, si
+    dimezza ad ogni 429. È thread-safe e condiviso da tutte le sessioni.
+    """
+
+    def __init__(self,
+                 requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 min_concurrency: int = LLM_MIN_CONCURRENCY,
+                 latency_target: float = LLM_LATENCY_TARGET,
+                 cooldown: float = LLM_RATE_LIMIT_COOLDOWN):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self.request_bucket = float(requests_per_minute)
+        self.token_bucket = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_bucket = min(self.requests_per_minute, self.request_bucket + elapsed * self.requests_per_minute / 60)
+        self.token_bucket = min(self.tokens_per_minute, self.token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def try_acquire(self, tokens: int) -> float:
+        """Prova ad acquisire uno slot: 0 se acquisito, altrimenti i secondi di attesa stimati."""
+        # Una richiesta più grande del bucket non deve bloccarsi per sempre
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.concurrency_limit):
+                return 0.05
+            if self.request_bucket < 1:
+                return (1 - self.request_bucket) * 60 / self.requests_per_minute
+            if self.token_bucket < tokens:
+                return (tokens - self.token_bucket) * 60 / self.tokens_per_minute
+            self.request_bucket -= 1
+            self.token_bucket -= tokens
+            self.in_flight += 1
+            return 0.0
+
+    def release(self, latency: float, rate_limited: bool = False, reservation: Optional[Reservation] = None):
+        """Libera lo slot, conguaglia i token prenotati e adatta la concorrenza (AIMD) in base a 429 e latenza."""
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if reservation is not None and reservation.used is not None:
+                self._refill(time.monotonic())
+                self.token_bucket = min(self.tokens_per_minute, self.token_bucket + reservation.tokens - reservation.used)
+            if rate_limited:
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + self.cooldown)
+                logger.warning(f"Rate limited by provider: concurrency limit lowered to {int(self.concurrency_limit)}")
+            elif latency > self.latency_target:
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * 0.9)
+            else:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+
+    async def acquire(self, tokens: int):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def acquire_blocking(self, tokens: int):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1.0))
+
+    @asynccontextmanager
+    async def limit(self, tokens: int):
+        """Context manager asincrono attorno a una chiamata LLM; restituisce la ``Reservation``.
+
+        L'attesa di uno slot è registrata sull'orologio della query corrente, se presente.
+        """
+        reservation = Reservation(min(tokens, self.tokens_per_minute))
+        clock = limiter_wait_clock.get()
+        if clock is not None:
+            clock.track(waiting=1)
+        try:
+            await self.acquire(reservation.tokens)
+        except BaseException:
+            if clock is not None:
+                clock.track(waiting=-1)
+            raise
+        if clock is not None:
+            clock.track(waiting=-1, running=1)
+        start_time = time.monotonic()
+        rate_limited = False
+        try:
+            yield reservation
+        except Exception as e:
+            rate_limited = is_rate_limit_error(e)
+            raise
+        finally:
+            if clock is not None:
+                clock.track(running=-1)
+            self.release(time.monotonic() - start_time, rate_limited, reservation)
+
+    @contextmanager
+    def limit_blocking(self, tokens: int):
+        """Context manager sincrono attorno a una chiamata LLM; restituisce la ``Reservation``."""
+        reservation = Reservation(min(tokens, self.tokens_per_minute))
+        self.acquire_blocking(reservation.tokens)
+        start_time = time.monotonic()
+        rate_limited = False
+        try:
+            yield reservation
+        except Exception as e:
+            rate_limited = is_rate_limit_error(e)
+            raise
+        finally:
+            self.release(time.monotonic() - start_time, rate_limited, reservation)
+
+def get_rate_limiter() -> RateLimiter:
+    """Restituisce il limitatore condiviso dal processo."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
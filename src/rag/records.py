@@ -0,0 +1,161 @@
+import sys
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, Optional, Union
+from langchain_core.documents import Document
+
+# Campi specifici del singolo chunk, non significativi a livello di post
+CHUNK_FIELDS = frozenset(("chunk_text", "chunk_start", "chunk_number", "chunk_index", "total_chunks"))
+
+# Campi del post conservati come attributi del record (None = assente)
+POST_FIELDS = dict.fromkeys((
+    "unique_post_id", "author", "post_time", "post_epoch", "score", "matched_chunks",
+    "relevance", "rerank_score", "first_stage_score"
+))
+
+# Campi del thread, condivisi da tutti i post dello stesso thread: chiave -> attributo di ThreadInfo
+THREAD_FIELDS = {"thread_id": "thread_id", "thread_title": "title", "url": "url", "scrape_time": "scrape_time"}
+
+class ThreadInfo:
+    """Dati del thread, un'unica istanza condivisa dai post dello stesso thread."""
+    __slots__ = ("thread_id", "title", "url", "scrape_time")
+
+    def __init__(self, thread_id: str, title: str = "Unknown Thread", url: str = "", scrape_time: str = ""):
+        self.thread_id = sys.intern(thread_id)
+        self.title = title
+        self.url = url
+        self.scrape_time = scrape_time
+
+class PostRecord:
+    """Post restituito dal retriever, al posto di un ``Document`` con metadati copiati.
+
+    Il testo è conservato una sola volta (più la versione evidenziata solo se
+    diversa), i dati del thread sono un ``ThreadInfo`` condiviso e l'autore è
+    una stringa internata. I metadati originali del match sono referenziati
+    senza copia. ``fields`` conserva i campi del post ricavati dallo swarm
+    (una volta per record, non ad ogni stima). ``page_content`` e ``metadata`` hanno la stessa interfaccia di
+    ``Document``, così il resto della pipeline non distingue i due tipi.
+    """
+    __slots__ = (
+        "unique_post_id", "thread", "author", "post_time", "post_epoch", "text", "highlighted",
+        "score", "matched_chunks", "relevance", "rerank_score", "first_stage_score",
+        "source", "extra", "fields", "_metadata"
+    )
+
+    def __init__(self, unique_post_id: str, thread: ThreadInfo, text: str, source: Dict[str, Any],
+                 author: Optional[str] = None, post_time: Optional[str] = None, post_epoch: int = 0,
+                 score: float = 0.0, matched_chunks: int = 1, highlighted: Optional[str] = None):
+        self.unique_post_id = unique_post_id
+        self.thread = thread
+        self.author = sys.intern(author) if author else None
+        self.post_time = post_time
+        self.post_epoch = post_epoch
+        self.text = text
+        self.highlighted = highlighted if highlighted != text else None
+        self.score = score
+        self.matched_chunks = matched_chunks
+        self.relevance = None
+        self.rerank_score = None
+        self.first_stage_score = None
+        self.source = source
+        self.extra = None
+        self.fields = None
+        self._metadata = None
+
+    @property
+    def page_content(self) -> str:
+        return self.highlighted if self.highlighted is not None else self.text
+
+    @page_content.setter
+    def page_content(self, value: str):
+        self.highlighted = value if value != self.text else None
+        self.fields = None
+
+    @property
+    def metadata(self) -> "PostMetadata":
+        if self._metadata is None:
+            self._metadata = PostMetadata(self)
+        return self._metadata
+
+    def to_document(self) -> Document:
+        """Converte il record in ``Document`` (per le API LangChain che lo richiedono)."""
+        return Document(page_content=self.page_content, metadata=dict(self.metadata))
+
+class PostMetadata(MutableMapping):
+    """Vista dict dei campi di un ``PostRecord``, senza copiarli.
+
+    Le chiavi non previste dal record sono lette dai metadati originali del
+    match; le scritture su chiavi nuove finiscono in ``record.extra``.
+    """
+    __slots__ = ("_record",)
+
+    def __init__(self, record: PostRecord):
+        self._record = record
+
+    def __getitem__(self, key: str) -> Any:
+        record = self._record
+        if key in POST_FIELDS:
+            value = getattr(record, key)
+        elif key in THREAD_FIELDS:
+            value = getattr(record.thread, THREAD_FIELDS[key])
+        elif key == "text":
+            value = record.text
+        elif record.extra is not None and key in record.extra:
+            return record.extra[key]
+        elif key in CHUNK_FIELDS:
+            raise KeyError(key)
+        else:
+            return record.source[key]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        record = self._record
+        if key in POST_FIELDS:
+            setattr(record, key, value)
+        elif key in THREAD_FIELDS:
+            setattr(record.thread, THREAD_FIELDS[key], value)
+        elif key == "text":
+            record.text = value
+        else:
+            if record.extra is None:
+                record.extra = {}
+            record.extra[key] = value
+
+    def __delitem__(self, key: str):
+        record = self._record
+        if key in POST_FIELDS and getattr(record, key) is not None:
+            setattr(record, key, None)
+        elif record.extra is not None and key in record.extra:
+            del record.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        record = self._record
+        seen = set()
+        for key in POST_FIELDS:
+            if getattr(record, key) is not None:
+                seen.add(key)
+                yield key
+        for key in THREAD_FIELDS:
+            seen.add(key)
+            yield key
+        seen.add("text")
+        yield "text"
+        for key in record.extra or ():
+            if key not in seen:
+                seen.add(key)
+                yield key
+        for key in record.source:
+            if key not in seen and key not in CHUNK_FIELDS and key not in POST_FIELDS:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+# Post nella pipeline: record del retriever o Document (es. sintesi dei thread)
+Post = Union[PostRecord, Document]
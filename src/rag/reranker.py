@@ -0,0 +1,144 @@
+import logging
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from config import (
+    RERANKER_MODEL,
+    RERANK_BATCH_SIZE,
+    RERANK_MAX_CANDIDATES,
+    RERANK_TIME_BUDGET,
+    RERANK_CACHE_SIZE,
+    RERANK_TOP_N
+)
+from .records import Post
+
+logger = logging.getLogger(__name__)
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+class CrossEncoderReranker:
+    """Riordina i documenti recuperati con un cross-encoder multilingua su CPU."""
+
+    def __init__(self,
+                 model_name: str = RERANKER_MODEL,
+                 batch_size: int = RERANK_BATCH_SIZE,
+                 max_candidates: int = RERANK_MAX_CANDIDATES,
+                 time_budget: float = RERANK_TIME_BUDGET,
+                 cache_size: int = RERANK_CACHE_SIZE,
+                 top_n: Optional[int] = RERANK_TOP_N):
+        try:
+            from sentence_transformers import CrossEncoder
+
+            self.model = CrossEncoder(model_name, max_length=512, device="cpu")
+            self.batch_size = batch_size
+            self.max_candidates = max_candidates
+            self.time_budget = time_budget
+            self.top_n = top_n
+            self.cache_size = cache_size
+            self.cache = OrderedDict()
+            # La cache LRU è condivisa dalle sessioni: accesso solo tenendo il lock
+            self._cache_lock = threading.Lock()
+            # Stima del tempo per coppia, aggiornata ad ogni batch
+            self.seconds_per_pair = None
+            logger.info(f"Cross-encoder reranker loaded: {model_name}")
+        except Exception as e:
+            logger.error(f"Error initializing reranker: {str(e)}")
+            raise
+
+    @staticmethod
+    def get_cache_key(query: str, doc: Post) -> Tuple[str, str]:
+        """Chiave di cache per la coppia (query, post)."""
+        post_id = doc.metadata.get("unique_post_id")
+        if not post_id:
+            post_id = hashlib.md5(doc.page_content.encode()).hexdigest()
+        return query.strip().lower(), post_id
+
+    def get_cached_score(self, key: Tuple[str, str]) -> Optional[float]:
+        with self._cache_lock:
+            score = self.cache.get(key)
+            if score is not None:
+                self.cache.move_to_end(key)
+            return score
+
+    def set_cached_score(self, key: Tuple[str, str], score: float):
+        with self._cache_lock:
+            self.cache[key] = score
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def rerank(self, query: str, documents: List[Post]) -> List[Post]:
+        """Riordina i candidati migliori; se il budget di tempo non basta li restituisce per score di primo livello."""
+        if not documents:
+            return documents
+
+        try:
+            candidates = sorted(documents, key=lambda doc: doc.metadata.get("score", 0.0), reverse=True)
+            head = candidates[:self.max_candidates]
+            tail = candidates[self.max_candidates:]
+
+            keys = [self.get_cache_key(query, doc) for doc in head]
+            scores = [self.get_cached_score(key) for key in keys]
+            missing = [i for i, score in enumerate(scores) if score is None]
+            logger.info(f"Reranking {len(head)} candidates ({len(head) - len(missing)} cached)")
+
+            start = time.perf_counter()
+            for batch_start in range(0, len(missing), self.batch_size):
+                batch = missing[batch_start:batch_start + self.batch_size]
+
+                # Verifica che il prossimo batch rientri nel budget
+                elapsed = time.perf_counter() - start
+                if self.seconds_per_pair is not None:
+                    expected = elapsed + self.seconds_per_pair * len(batch)
+                else:
+                    expected = elapsed
+                if expected > self.time_budget:
+                    logger.warning(
+                        f"Rerank budget of {self.time_budget}s exceeded after {elapsed:.2f}s, "
+                        f"falling back to first-stage order"
+                    )
+                    # ``documents`` arriva raggruppato per thread: l'ordine di primo livello è quello per score
+                    return candidates
+
+                batch_start_time = time.perf_counter()
+                pairs = [(query, head[i].page_content) for i in batch]
+                batch_scores = self.model.predict(
+                    pairs,
+                    batch_size=self.batch_size,
+                    show_progress_bar=False,
+                    convert_to_numpy=True
+                )
+                batch_time = time.perf_counter() - batch_start_time
+                self.seconds_per_pair = batch_time / len(batch)
+
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = float(score)
+                    self.set_cached_score(keys[i], scores[i])
+
+            for doc, score in zip(head, scores):
+                doc.metadata["first_stage_score"] = doc.metadata.get("score", 0.0)
+                doc.metadata["rerank_score"] = score
+
+            ranked = [doc for _, doc in sorted(zip(scores, head), key=lambda item: item[0], reverse=True)]
+            if self.top_n is not None:
+                ranked = ranked[:self.top_n]
+                tail = []
+
+            logger.info(f"Reranking completed in {time.perf_counter() - start:.2f}s")
+            return ranked + tail
+
+        except Exception as e:
+            logger.error(f"Error in reranking: {str(e)}")
+            return documents
+
+def get_reranker() -> CrossEncoderReranker:
+    """Restituisce il reranker condiviso dal processo, caricandolo alla prima richiesta."""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            logger.info("Initializing cross-encoder reranker...")
+            _reranker = CrossEncoderReranker()
+        return _reranker
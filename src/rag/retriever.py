@@ -1,135 +1,322 @@
+import asyncio
+import time
 import streamlit as st
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
 from langchain_core.documents import Document
 import logging
-from datetime import datetime
-from config import EMBEDDING_DIMENSION
+import numpy as np
+from data.catalog import get_catalog
+from embeddings.thread_index import get_thread_index
+from embeddings.indexer import to_vector_values
+from embeddings.partitions import partition_range
+from config import (
+    EMBEDDING_DIMENSION,
+    RETRIEVER_HIGHLIGHT_MATCHES,
+    RETRIEVER_HIGHLIGHT_MARKERS,
+    THREAD_TOP_K,
+    COARSE_RETRIEVAL_MIN_THREADS,
+    RETRIEVAL_BATCH_THREADS
+)
+from .records import PostRecord, ThreadInfo, Post
+from .conversation import detect_date_range
 
 logger = logging.getLogger(__name__)
 
 class SmartRetriever:
-    def __init__(self, index, embeddings):
+    def __init__(self, index, embeddings, reranker=None, catalog=None, thread_index=None,
+                 highlight_matches: bool = RETRIEVER_HIGHLIGHT_MATCHES):
         self.index = index
         self.embeddings = embeddings
+        self.reranker = reranker
+        self.catalog = catalog if catalog is not None else get_catalog()
+        self.thread_index = thread_index if thread_index is not None else get_thread_index()
+        self.THREAD_TOP_K = THREAD_TOP_K
         self.MAX_DOCUMENTS = 10000
         self.EMBEDDING_DIMENSION = EMBEDDING_DIMENSION
+        self.highlight_matches = highlight_matches
+        self.RETRIEVAL_BATCH_THREADS = RETRIEVAL_BATCH_THREADS
 
-    def get_all_documents(self) -> List[Document]:
+    @staticmethod
+    def get_post_key(match) -> str:
+        """Chiave che identifica il post a cui appartiene un chunk."""
+        metadata = match.metadata
+        if metadata.get("unique_post_id"):
+            return metadata["unique_post_id"]
+        # Chunk indicizzati prima dell'introduzione di unique_post_id
+        if metadata.get("author") and metadata.get("post_time"):
+            return f"{metadata.get('thread_id', 'unknown')}_{metadata['author']}_{metadata['post_time']}"
+        return match.id
+
+    def highlight_chunk(self, text: str, chunk_text: str) -> str:
+        """Evidenzia nel testo del post lo span del chunk che ha prodotto il match."""
+        chunk_text = (chunk_text or "").strip()
+        if not chunk_text or chunk_text == text.strip():
+            return text
+        start = text.find(chunk_text)
+        if start == -1:
+            return text
+        open_marker, close_marker = RETRIEVER_HIGHLIGHT_MARKERS
+        end = start + len(chunk_text)
+        return f"{text[:start]}{open_marker}{chunk_text}{close_marker}{text[end:]}"
+
+    def collapse_matches(self, matches) -> List[PostRecord]:
+        """Raggruppa i chunk per post, tiene il punteggio migliore ed emette un ``PostRecord`` per post."""
+        best_matches = {}
+        chunk_counts = {}
+        for match in matches:
+            if "text" not in match.metadata:
+                continue
+            post_key = self.get_post_key(match)
+            chunk_counts[post_key] = chunk_counts.get(post_key, 0) + 1
+            best = best_matches.get(post_key)
+            if best is None or (match.score or 0.0) > (best.score or 0.0):
+                best_matches[post_key] = match
+
+        post_keys = list(best_matches.keys())
+        post_matches = list(best_matches.values())
+
+        # Timestamp dal catalogo colonnare; si fa il parsing solo per i post non catalogati
+        epochs = self.catalog.post_times_for(
+            post_keys,
+            [match.metadata.get("post_time", "") for match in post_matches]
+        )
+
+        # Thread nell'ordine in cui compaiono nei risultati, post ordinati per timestamp
+        thread_ranks = {}
+        ranks = np.array([
+            thread_ranks.setdefault(match.metadata.get("thread_id", "unknown"), len(thread_ranks))
+            for match in post_matches
+        ], dtype=np.int64)
+        order = np.lexsort((epochs, ranks))
+
+        documents = []
+        threads = {}
+        for position in order:
+            post_key = post_keys[position]
+            match = post_matches[position]
+            metadata = match.metadata
+            # Dati del thread condivisi tra i post, senza copiare i metadati del match
+            thread_id = metadata.get("thread_id", "unknown")
+            thread = threads.get(thread_id)
+            if thread is None:
+                thread = threads[thread_id] = ThreadInfo(
+                    thread_id,
+                    metadata.get("thread_title", "Unknown Thread"),
+                    metadata.get("url", ""),
+                    metadata.get("scrape_time", "")
+                )
+
+            text = metadata["text"]
+            highlighted = None
+            if self.highlight_matches:
+                highlighted = self.highlight_chunk(text, metadata.get("chunk_text", ""))
+
+            documents.append(PostRecord(
+                post_key,
+                thread,
+                text,
+                metadata,
+                author=metadata.get("author"),
+                post_time=metadata.get("post_time"),
+                post_epoch=int(epochs[position]),
+                score=match.score or 0.0,
+                matched_chunks=chunk_counts[post_key],
+                highlighted=highlighted
+            ))
+
+        duplicates = sum(chunk_counts.values()) - len(documents)
+        if duplicates:
+            logger.info(f"Collapsed {duplicates} duplicate chunk matches into {len(documents)} posts")
+        return documents
+
+    def partition_args(self, query: str) -> Dict[str, Any]:
+        """Argomenti di query che limitano la ricerca alle partizioni del periodo citato nella domanda.
+
+        Vuoto (tutte le partizioni) se l'indice non è partizionato, se la
+        domanda non cita date o se nessuna partizione copre il periodo.
+        """
+        if not hasattr(self.index, "partitions_for_range"):
+            return {}
+        reference_epoch = int(self.catalog.post_times.max()) if len(self.catalog) else int(time.time())
+        date_range = detect_date_range(query, reference_epoch)
+        if date_range is None:
+            return {}
+        namespaces = self.index.partitions_for_range(*date_range)
+        if not any(partition_range(name) for name in namespaces):
+            return {}
+        logger.info(f"Query limited to {len(namespaces)} partitions: {', '.join(sorted(namespaces))}")
+        return {"namespaces": namespaces}
+
+    @staticmethod
+    def assign_relevance(documents: List[Post]):
+        """Aggiunge ``relevance`` in (0, 1] ad ogni documento, usata per scegliere il contesto degli agenti.
+
+        È il rango percentile del punteggio più fine disponibile: i documenti
+        riordinati dal cross-encoder precedono gli altri, così punteggi su
+        scale diverse restano confrontabili.
+        """
+        if not documents:
+            return
+        keys = [
+            (1, doc.metadata["rerank_score"]) if "rerank_score" in doc.metadata else (0, doc.metadata.get("score", 0.0))
+            for doc in documents
+        ]
+        order = sorted(range(len(documents)), key=lambda i: keys[i], reverse=True)
+        for rank, i in enumerate(order):
+            documents[i].metadata["relevance"] = 1.0 - rank / len(documents)
+
+    def get_all_documents(self) -> List[Post]:
         """Retrieve and reconstruct all documents from the index."""
         try:
             # Create a query that will match all documents
             query_vector = [0.0] * self.EMBEDDING_DIMENSION
             query_vector[0] = 1.0  # Set first element to 1.0 to ensure non-zero vector
-            
+
             logger.info("Retrieving all documents from index...")
-            
+
             results = self.index.query(
                 vector=query_vector,
                 top_k=self.MAX_DOCUMENTS,
                 include_metadata=True
             )
-            
+
             if not results.matches:
                 logger.warning("No documents found in index")
                 return []
-            
-            # Raggruppa i chunks per thread_id
-            grouped_chunks = {}
-            for match in results.matches:
-                thread_id = match.metadata.get("thread_id", "unknown")
-                if thread_id not in grouped_chunks:
-                    grouped_chunks[thread_id] = []
-                grouped_chunks[thread_id].append(match)
-            
-            # Ricostruisci i documenti completi
-            complete_documents = []
-            for thread_chunks in grouped_chunks.values():
-                # Ordina i chunks per timestamp del post
-                thread_chunks.sort(key=lambda x: datetime.fromisoformat(
-                    x.metadata.get("post_time", "1970-01-01T00:00:00+00:00")
-                ))
-                
-                # Ricostruisci ogni post del thread
-                for chunk in thread_chunks:
-                    # Usa il testo originale se disponibile
-                    if "text" in chunk.metadata:
-                        metadata = chunk.metadata.copy()
-                        # Aggiungi informazioni del thread
-                        metadata.update({
-                            "thread_title": chunk.metadata.get("thread_title", "Unknown Thread"),
-                            "url": chunk.metadata.get("url", ""),
-                            "scrape_time": chunk.metadata.get("scrape_time", "")
-                        })
-                        
-                        complete_documents.append(Document(
-                            page_content=chunk.metadata["text"],
-                            metadata=metadata
-                        ))
-            
+
+            complete_documents = self.collapse_matches(results.matches)
+
             logger.info(f"Retrieved and reconstructed {len(complete_documents)} documents")
             return complete_documents
-            
+
         except Exception as e:
             logger.error(f"Error fetching documents: {str(e)}")
             return []
 
-    def get_relevant_documents(self, query: str) -> List[Document]:
-        """Retrieve relevant documents using semantic search."""
+    def get_relevant_documents(self, query: str, query_embedding=None) -> List[Post]:
+        """Retrieve relevant documents using semantic search.
+
+        ``query_embedding`` può essere passato se già calcolato dal chiamante.
+        """
         try:
             # Generate query embedding
-            query_embedding = self.embeddings.embed_query(query)
-            
+            if query_embedding is None:
+                query_embedding = self.embeddings.embed_query(query)
+
             # Verify embedding dimension
             if len(query_embedding) != self.EMBEDDING_DIMENSION:
                 raise ValueError(f"Query embedding dimension {len(query_embedding)} does not match index dimension {self.EMBEDDING_DIMENSION}")
-            
-            # Search for similar documents
+
+            # Prima fase: selezione dei thread più rilevanti dall'indice dei thread
+            query_filter = None
+            if len(self.thread_index) >= COARSE_RETRIEVAL_MIN_THREADS:
+                top_threads = self.thread_index.search(query_embedding, self.THREAD_TOP_K)
+                if top_threads:
+                    query_filter = {"thread_id": {"$in": [thread_id for thread_id, _ in top_threads]}}
+                    logger.info(f"Coarse retrieval selected {len(top_threads)} of {len(self.thread_index)} threads")
+
+            # Seconda fase: ricerca dei post (solo nei thread selezionati, se presenti)
             results = self.index.query(
-                vector=query_embedding,
+                vector=to_vector_values(query_embedding),
                 top_k=self.MAX_DOCUMENTS,
-                include_metadata=True
+                filter=query_filter,
+                include_metadata=True,
+                **self.partition_args(query)
             )
-            
+
             if not results.matches:
                 return [Document(page_content="No documents found", metadata={"type": "error"})]
-            
-            # Raggruppa i chunks per thread_id
-            grouped_chunks = {}
-            for match in results.matches:
-                thread_id = match.metadata.get("thread_id", "unknown")
-                if thread_id not in grouped_chunks:
-                    grouped_chunks[thread_id] = []
-                grouped_chunks[thread_id].append(match)
-            
-            # Ricostruisci i documenti completi
-            relevant_documents = []
-            for thread_chunks in grouped_chunks.values():
-                # Ordina i chunks per timestamp del post
-                thread_chunks.sort(key=lambda x: datetime.fromisoformat(
-                    x.metadata.get("post_time", "1970-01-01T00:00:00+00:00")
-                ))
-                
-                # Ricostruisci ogni post del thread
-                for chunk in thread_chunks:
-                    if "text" in chunk.metadata:
-                        metadata = chunk.metadata.copy()
-                        # Aggiungi informazioni del thread
-                        metadata.update({
-                            "thread_title": chunk.metadata.get("thread_title", "Unknown Thread"),
-                            "url": chunk.metadata.get("url", ""),
-                            "scrape_time": chunk.metadata.get("scrape_time", "")
-                        })
-                        
-                        relevant_documents.append(Document(
-                            page_content=chunk.metadata["text"],
-                            metadata=metadata
-                        ))
-            
-            return relevant_documents
-            
+
+            # Un documento per post, non per chunk
+            documents = self.collapse_matches(results.matches)
+
+            # Riordino opzionale con cross-encoder
+            if self.reranker is not None:
+                documents = self.reranker.rerank(query, documents)
+
+            self.assign_relevance(documents)
+            return documents
+
         except Exception as e:
             logger.error(f"Error in retrieval: {str(e)}")
             return [Document(
                 page_content=f"Error retrieving documents: {str(e)}",
                 metadata={"type": "error"}
-            )]
\ No newline at end of file
+            )]
+
+    def can_stream(self) -> bool:
+        """Il retrieval in streaming interroga i thread dell'indice dei thread a gruppi.
+
+        Serve un indice dei thread: sopra ``COARSE_RETRIEVAL_MIN_THREADS``
+        come per la ricerca coarse-to-fine, sotto solo se copre tutti i thread
+        del catalogo, altrimenti i thread mancanti sfuggirebbero alle query.
+        """
+        if len(self.thread_index) >= COARSE_RETRIEVAL_MIN_THREADS:
+            return True
+        catalog_threads = len(np.unique(self.catalog.thread_codes))
+        return len(self.thread_index) > 0 and len(self.thread_index) >= catalog_threads
+
+    async def stream_relevant_documents(self, query: str, query_embedding=None) -> AsyncIterator[List[Post]]:
+        """Come ``get_relevant_documents``, ma produce i documenti a blocchi di thread completi.
+
+        I thread sono ordinati dall'indice dei thread (i primi ``THREAD_TOP_K``
+        sopra ``COARSE_RETRIEVAL_MIN_THREADS``, tutti sotto) e interrogati a
+        gruppi di ``RETRIEVAL_BATCH_THREADS`` con query concorrenti: ogni
+        gruppo viene prodotto appena arriva. La rilevanza è il rango
+        percentile del punteggio dentro il blocco, come in ``assign_relevance``
+        (il re-ranking richiede l'insieme completo e non è applicato). Senza
+        indice dei thread (``can_stream`` falso) il risultato dell'unica query
+        arriva in un solo blocco.
+        """
+        if query_embedding is None:
+            query_embedding = await asyncio.to_thread(self.embeddings.embed_query, query)
+        query_values = to_vector_values(query_embedding)
+        partition_args = self.partition_args(query)
+
+        def to_batch(matches) -> List[PostRecord]:
+            documents = self.collapse_matches(matches)
+            self.assign_relevance(documents)
+            return documents
+
+        top_threads = []
+        if self.can_stream():
+            top_k = self.THREAD_TOP_K if len(self.thread_index) >= COARSE_RETRIEVAL_MIN_THREADS else len(self.thread_index)
+            top_threads = [thread_id for thread_id, _ in self.thread_index.search(query_embedding, top_k)]
+
+        if not top_threads:
+            results = await asyncio.to_thread(
+                self.index.query,
+                vector=query_values,
+                top_k=self.MAX_DOCUMENTS,
+                include_metadata=True,
+                **partition_args
+            )
+            if results.matches:
+                yield to_batch(results.matches)
+            return
+
+        groups = [
+            top_threads[i:i + self.RETRIEVAL_BATCH_THREADS]
+            for i in range(0, len(top_threads), self.RETRIEVAL_BATCH_THREADS)
+        ]
+        top_k = -(-self.MAX_DOCUMENTS // len(groups))
+        logger.info(f"Streaming retrieval over {len(top_threads)} threads in {len(groups)} batches")
+        tasks = [
+            asyncio.create_task(asyncio.to_thread(
+                self.index.query,
+                vector=query_values,
+                top_k=top_k,
+                filter={"thread_id": {"$in": group}},
+                include_metadata=True,
+                **partition_args
+            ))
+            for group in groups
+        ]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                results = await next_result
+                if results.matches:
+                    yield to_batch(results.matches)
+        finally:
+            for task in tasks:
+                task.cancel()
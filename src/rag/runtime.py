@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future, wait
+from typing import Any, Callable, Coroutine
+
+logger = logging.getLogger(__name__)
+
+_async_runner = None
+_async_runner_lock = threading.Lock()
+
+class AsyncRunner:
+    """Event loop unico del processo, eseguito in un thread in background.
+
+    Tutte le coroutine LLM girano su questo loop: i client asincroni e i loro
+    pool di connessioni restano legati a un solo loop per tutta la vita del processo.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="llm-event-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Pianifica la coroutine sul loop e restituisce un Future thread-safe."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+def get_async_runner() -> AsyncRunner:
+    """Restituisce il runner condiviso dal processo, avviandolo al primo utilizzo."""
+    global _async_runner
+    with _async_runner_lock:
+        if _async_runner is None:
+            _async_runner = AsyncRunner()
+            logger.info("Started background event loop for LLM requests")
+        return _async_runner
+
+class UIProxy:
+    """Oggetto segnaposto per un elemento Streamlit usato dal loop in background."""
+
+    __slots__ = ("_bridge", "_handle")
+
+    def __init__(self, bridge: "UIBridge", handle: int):
+        self._bridge = bridge
+        self._handle = handle
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            return self._bridge.enqueue(self._handle, name, args, kwargs)
+        return call
+
+class UIBridge:
+    """Inoltra al thread dello script Streamlit le chiamate UI fatte dal loop in background.
+
+    Streamlit accetta aggiornamenti solo dal thread dello script: il loop
+    accoda le chiamate e ``run`` le esegue mentre attende il risultato.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.handles = {}
+        self.handle_ids = itertools.count(1)
+
+    def proxy(self, target: Any) -> UIProxy:
+        handle = next(self.handle_ids)
+        self.handles[handle] = target
+        return UIProxy(self, handle)
+
+    def callback(self, fn: Callable) -> Callable:
+        """Callback sicura da chiamare dal loop; viene eseguita nel thread dello script."""
+        handle = next(self.handle_ids)
+        self.handles[handle] = fn
+
+        def call(*args, **kwargs):
+            self.queue.put((handle, None, None, args, kwargs))
+        return call
+
+    def enqueue(self, handle: int, method: str, args: tuple, kwargs: dict) -> UIProxy:
+        result_handle = next(self.handle_ids)
+        self.queue.put((handle, method, result_handle, args, kwargs))
+        return UIProxy(self, result_handle)
+
+    def drain(self):
+        """Esegue le chiamate UI in coda."""
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for position, (handle, method, result_handle, args, kwargs) in enumerate(items):
+            # Callback consecutive sulla stessa funzione (es. streaming): basta l'ultima
+            if method is None and position + 1 < len(items):
+                next_handle, next_method = items[position + 1][:2]
+                if next_handle == handle and next_method is None:
+                    continue
+            target = self.handles.get(handle)
+            if target is None:
+                continue
+            try:
+                if method is None:
+                    target(*args, **kwargs)
+                else:
+                    self.handles[result_handle] = getattr(target, method)(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"Error applying UI update {method or 'callback'}: {str(e)}")
+
+    def run(self, coro: Coroutine, poll_interval: float = 0.05) -> Any:
+        """Esegue la coroutine sul loop condiviso applicando gli aggiornamenti UI finché non termina."""
+        future = get_async_runner().submit(coro)
+        try:
+            while not future.done():
+                wait([future], timeout=poll_interval)
+                self.drain()
+        except BaseException:
+            # Rerun o interruzione dello script: la coroutine non deve restare orfana
+            future.cancel()
+            raise
+        self.drain()
+        return future.result()
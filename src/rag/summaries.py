@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List
+from langchain_core.documents import Document
+from langchain_core.messages import SystemMessage
+from config import THREAD_SUMMARIES_PATH, SUMMARY_MAX_TOKENS, SUMMARY_CONTEXT_TOKENS
+from data.catalog import get_catalog
+from embeddings.indexer import fetch_post_records
+from .clients import get_llm
+from .swarm import get_swarm
+from .templates import thread_summary_template
+
+logger = logging.getLogger(__name__)
+
+_summary_store = None
+_summary_store_lock = threading.Lock()
+
+# Domande di panoramica (italiano/inglese), a cui bastano le sintesi dei thread
+BROAD_QUERY_PATTERNS = [
+    r"\bin\s+generale\b", r"\bpanoramica\b", r"\briassum", r"\bsintesi\b", r"\bdi\s+cosa\s+(si\s+)?parla",
+    r"\bdi\s+cosa\s+(si\s+)?discute", r"\btemi\s+(principali|ricorrenti)\b", r"\bargomenti\s+principali\b",
+    r"\bquali\s+(sono\s+)?(i\s+)?(temi|argomenti)\b", r"\bcosa\s+pensano\b", r"\bopinione\s+generale\b",
+    r"\boverview\b", r"\bsummar", r"\bin\s+general\b", r"\bmain\s+(topics|themes|points)\b",
+    r"\bwhat\s+(are\s+)?(people|users)\s+(talking|saying|think)", r"\boverall\b"
+]
+
+def is_broad_query(query: str) -> bool:
+    """Riconosce le domande di panoramica su più thread."""
+    text = query.lower()
+    return any(re.search(pattern, text) for pattern in BROAD_QUERY_PATTERNS)
+
+def compute_thread_hash(post_hashes: Dict[str, str]) -> str:
+    """Hash del thread da ``{unique_post_id: hash del contenuto}``: cambia se post aggiunti, rimossi o modificati."""
+    keys = sorted(f"{post_id}:{content_hash}" for post_id, content_hash in post_hashes.items())
+    return hashlib.md5("|".join(keys).encode()).hexdigest()
+
+class ThreadSummaryStore:
+    """Sintesi dei thread su file JSON: ``{thread_id: {title, summary, post_hash, posts, updated_at}}``."""
+
+    def __init__(self, path: str = THREAD_SUMMARIES_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.summaries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.summaries = json.load(f)
+                logger.info(f"Loaded {len(self.summaries)} thread summaries from {path}")
+            except Exception as e:
+                logger.error(f"Error loading thread summaries: {str(e)}")
+
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+    def get_many(self, thread_ids: Iterable[str]) -> Dict[str, Dict]:
+        with self._lock:
+            return {thread_id: self.summaries[thread_id] for thread_id in thread_ids if thread_id in self.summaries}
+
+    def needs_update(self, thread_id: str, post_hash: str) -> bool:
+        with self._lock:
+            summary = self.summaries.get(thread_id)
+            return summary is None or summary.get("post_hash") != post_hash
+
+    def put_many(self, summaries: Dict[str, Dict]):
+        """Aggiunge o sostituisce le sintesi e salva atomicamente il file."""
+        if not summaries:
+            return
+        with self._lock:
+            self.summaries.update(summaries)
+            self.save()
+
+    def remove_many(self, thread_ids: Iterable[str]):
+        """Elimina le sintesi dei thread indicati e salva il file."""
+        with self._lock:
+            removed = [self.summaries.pop(thread_id) for thread_id in thread_ids if thread_id in self.summaries]
+            if removed:
+                self.save()
+                logger.info(f"Removed {len(removed)} thread summaries")
+
+    def save(self):
+        """Salva atomicamente le sintesi; va chiamata tenendo ``_lock``."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.summaries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self._lock:
+            self.summaries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+def get_summary_store() -> ThreadSummaryStore:
+    """Restituisce l'archivio delle sintesi condiviso dal processo."""
+    global _summary_store
+    with _summary_store_lock:
+        if _summary_store is None:
+            _summary_store = ThreadSummaryStore()
+        return _summary_store
+
+def clear_thread_summaries():
+    """Elimina tutte le sintesi dei thread."""
+    get_summary_store().clear()
+
+class ThreadSummarizer:
+    """Calcola le sintesi dei thread dopo l'ingestione, solo per i thread cambiati.
+
+    Con ``index`` i post del thread già catalogati ma assenti dallo snapshot
+    ingerito sono letti dall'indice, così la sintesi copre sempre il thread intero.
+    """
+
+    def __init__(self, store: ThreadSummaryStore = None, index=None):
+        self.store = store if store is not None else get_summary_store()
+        self.index = index
+        self.swarm = get_swarm()
+        self.llm = get_llm(
+            "gpt-3.5-turbo-16k",
+            temperature=0,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            request_timeout=60,
+            max_retries=0
+        )
+
+    async def summarize_thread(self, thread_id: str, posts: List[Dict], post_hash: str) -> Dict:
+        """Sintetizza un thread a partire dai post (metadati completi dell'ingestione)."""
+        documents = [Document(page_content=post["text"], metadata=post) for post in posts]
+        documents.sort(key=self.swarm.get_post_epoch)
+        context, _, included = self.swarm.format_documents_with_tokens(documents, SUMMARY_CONTEXT_TOKENS)
+        title = posts[0].get("thread_title", "Unknown Thread")
+        messages = [SystemMessage(content=thread_summary_template.format(title=title, context=context))]
+        summary = await self.swarm.invoke_llm(self.llm, messages)
+        if len(included) < len(documents):
+            logger.info(f"Thread {thread_id}: summary based on {len(included)}/{len(documents)} posts")
+        return {
+            "title": title,
+            "summary": summary.strip(),
+            "post_hash": post_hash,
+            "posts": len(posts),
+            "updated_at": time.time()
+        }
+
+    async def thread_posts(self, thread_id: str, posts: List[Dict], catalog_posts: Dict[str, str]) -> List[Dict]:
+        """Post dello snapshot più quelli del thread presenti solo nel catalogo, letti dall'indice."""
+        snapshot_ids = {post["unique_post_id"] for post in posts}
+        missing = [post_id for post_id in catalog_posts if post_id not in snapshot_ids]
+        if not missing or self.index is None:
+            return posts
+        fetched = await asyncio.to_thread(fetch_post_records, self.index, missing)
+        logger.info(f"Thread {thread_id}: {len(fetched)} indexed posts added to the {len(posts)} of the snapshot")
+        return posts + fetched
+
+    async def summarize_threads(self, records: List[Dict]) -> int:
+        """Aggiorna le sintesi dei thread presenti in ``records`` che sono cambiati.
+
+        ``records`` sono i post dello snapshot ingerito; l'hash del thread
+        unisce il loro contenuto a quello dei post già nel catalogo, così un
+        post modificato cambia l'hash e uno snapshot parziale non restringe la
+        sintesi ai soli post ricevuti. Restituisce il numero di sintesi
+        aggiornate; un errore su un thread non blocca gli altri.
+        """
+        threads = {}
+        for record in records:
+            threads.setdefault(record["thread_id"], []).append(record)
+
+        catalog = get_catalog()
+        changed = {}
+        for thread_id, posts in threads.items():
+            catalog_posts = catalog.thread_posts(thread_id)
+            post_hashes = {**catalog_posts, **{post["unique_post_id"]: post.get("content_hash", "") for post in posts}}
+            post_hash = compute_thread_hash(post_hashes)
+            if self.store.needs_update(thread_id, post_hash):
+                try:
+                    posts = await self.thread_posts(thread_id, posts, catalog_posts)
+                except Exception as e:
+                    logger.error(f"Error fetching posts of thread {thread_id}: {str(e)}")
+                    continue
+                changed[thread_id] = (posts, post_hash)
+        if not changed:
+            return 0
+
+        start_time = time.monotonic()
+        results = await asyncio.gather(*[
+            self.summarize_thread(thread_id, posts, post_hash)
+            for thread_id, (posts, post_hash) in changed.items()
+        ], return_exceptions=True)
+
+        summaries = {}
+        for thread_id, result in zip(changed, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error summarizing thread {thread_id}: {str(result)}")
+            elif result["summary"]:
+                summaries[thread_id] = result
+        self.store.put_many(summaries)
+        logger.info(
+            f"Updated {len(summaries)}/{len(changed)} thread summaries "
+            f"({len(threads) - len(changed)} unchanged) in {time.monotonic() - start_time:.1f}s"
+        )
+        return len(summaries)
@@ -1,14 +1,40 @@
 import asyncio
-from typing import List, Dict, Any, Optional, Tuple
+import heapq
+import re
+import threading
+import time
+from typing import List, Dict, Any, Optional, Set, Tuple, Callable, AsyncIterator, Iterable
 from langchain_core.documents import Document
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
-import streamlit as st
 import logging
-from datetime import datetime
-import tiktoken
-from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from collections import Counter
+from contextvars import ContextVar
 import numpy as np
+from config import (
+    QUERY_DEADLINE_SECONDS,
+    SYNTHESIS_RESERVE_SECONDS,
+    LIMITER_WAIT_MAX_SECONDS,
+    HEDGE_LATENCY_FACTOR,
+    HEDGE_MIN_COMPLETED,
+    LLM_CACHE_ENABLED,
+    SUMMARY_RAW_THREADS,
+    LLM_MODEL,
+    CASCADE_TOP_POSTS,
+    CASCADE_CONTEXT_TOKENS,
+    CASCADE_CONFIDENCE_THRESHOLD,
+    FOLLOW_UP_CONTEXT_TOKENS,
+    FOLLOW_UP_ANALYSES_TOKENS,
+    CONVERSATION_MAX_DOCUMENTS,
+    STREAM_EMIT_FILL
+)
+from data.catalog import to_epoch
+from data.processor import parse_post_text
+from .tokens import count_tokens, count_text_tokens, count_prompt_tokens, expected_completion_tokens, get_tokenizer
+from .ratelimit import get_rate_limiter, LimiterWaitClock, limiter_wait_clock
+from .cache import get_response_cache, llm_cache_enabled
+from .records import Post, PostRecord
+from .clients import get_llm
 from .templates import (
     template, 
     analyzer_role_desc, 
@@ -16,54 +42,114 @@ from .templates import (
     analyzer_instructions,
     synthesizer_role_desc,
     synthesizer_context_section,
-    synthesizer_instructions
+    synthesizer_instructions,
+    reducer_role_desc,
+    reducer_instructions,
+    compact_context_legend,
+    cascade_template,
+    follow_up_template
 )
 
 logger = logging.getLogger(__name__)
 
+CONFIDENCE_PATTERN = re.compile(r"CONFIDENZA\s*:\s*(\d{1,3})", re.IGNORECASE)
+
+# Alias più lungo previsto, usato per stimare per eccesso intestazioni e legenda degli autori
+ALIAS_PLACEHOLDER = "A999"
+
+_swarm = None
+_swarm_lock = threading.Lock()
+
+class LowConfidenceAnswer(Exception):
+    """La risposta rapida ha dichiarato una confidenza sotto soglia."""
+
+    def __init__(self, confidence: int):
+        super().__init__(f"Low confidence: {confidence}")
+        self.confidence = confidence
+
+# Token del contesto per agente nella query corrente: {agent_id: (compatti, formato esteso)}
+context_token_stats: ContextVar[Optional[Dict[int, Tuple[int, int]]]] = ContextVar("context_token_stats", default=None)
+
 class OpenAISwarm:
     def __init__(self):
         try:
-            api_key = st.secrets["OPENAI_API_KEY"]
-            if not api_key:
-                raise ValueError("OpenAI API key not found")
-
+            # Client condivisi dal processo: connessioni riusate tra le query
             # Analyzer agents use 16k model for more context
-            self.analyzer_llm = ChatOpenAI(
-                model_name="gpt-3.5-turbo-16k",
+            self.analyzer_llm = get_llm(
+                "gpt-3.5-turbo-16k",
                 temperature=0.3,
-                api_key=api_key,
                 max_tokens=4000,
-                request_timeout=60
+                request_timeout=60,
+                max_retries=0  # I retry passano dal rate limiter condiviso
+            )
+            
+            # Synthesizer agent uses standard model (contesto di 4k token)
+            self.synthesizer_llm = get_llm(
+                "gpt-3.5-turbo",
+                temperature=0.3,
+                max_tokens=2000,
+                request_timeout=30,
+                max_retries=0
+            )
+            
+            # Reducer agents merge groups of analyses in the tree-reduce synthesis
+            self.reducer_llm = get_llm(
+                "gpt-3.5-turbo",
+                temperature=0.3,
+                max_tokens=1500,
+                request_timeout=30,
+                max_retries=0
             )
             
-            # Synthesizer agent uses standard model
-            self.synthesizer_llm = ChatOpenAI(
-                model_name="gpt-3.5-turbo",
+            # Cascade: risposta rapida con una sola chiamata prima dello swarm
+            self.cascade_llm = get_llm(
+                LLM_MODEL,
                 temperature=0.3,
-                api_key=api_key,
-                max_tokens=3000,
-                request_timeout=30
+                max_tokens=1000,
+                request_timeout=20,
+                max_retries=0
             )
             
             # Token management
-            self.tokenizer = tiktoken.encoding_for_model("gpt-3.5-turbo")
+            self.tokenizer = get_tokenizer()
             self.MAX_TOKENS_PER_REQUEST = 14000  # Safe limit for gpt-3.5-turbo-16k
-            self.MAX_SYNTHESIS_TOKENS = 10000
+            self.SEPARATOR_TOKENS = 2  # "\n\n" tra un post e l'altro
+            self.FOOTER_TOKENS = 2  # "\n---" in coda ad ogni post
+            self.RESPONSE_TOKENS = 4000  # Riservati alla risposta dell'analizzatore
+            self.SYNTHESIS_CONTEXT_TOKENS = 4096  # Contesto di gpt-3.5-turbo (sintetizzatore e riduttori)
+            self.SYNTHESIS_RESPONSE_TOKENS = 2000  # Riservati alla risposta del sintetizzatore
+            self.REDUCE_RESPONSE_TOKENS = 1500  # Riservati alla risposta di ogni riduttore
+            self.ANALYSIS_HEADER_TOKENS = 12  # "--- Analisi Agente #N ---" e separatori
             self.MAX_RETRIES = 3
             self.MAX_PARALLEL_REQUESTS = 5
+            self.rate_limiter = get_rate_limiter()
+            
+            # Cache persistente delle risposte (analisi, riduzioni e sintesi)
+            self.response_cache = get_response_cache() if LLM_CACHE_ENABLED else None
+            
+            # Deadline e hedging
+            self.QUERY_DEADLINE_SECONDS = QUERY_DEADLINE_SECONDS
+            self.SYNTHESIS_RESERVE_SECONDS = SYNTHESIS_RESERVE_SECONDS
+            self.LIMITER_WAIT_MAX_SECONDS = LIMITER_WAIT_MAX_SECONDS
+            self.HEDGE_LATENCY_FACTOR = HEDGE_LATENCY_FACTOR
+            self.HEDGE_MIN_COMPLETED = HEDGE_MIN_COMPLETED
+            self.HEDGE_CHECK_INTERVAL = 1.0
+            self.STREAM_EMIT_FILL = STREAM_EMIT_FILL
+            
+            # Latenza media dello swarm (EMA), per stimare il tempo risparmiato dalla cascata
+            self.swarm_latency = None
             
         except Exception as e:
             logger.error(f"Error initializing OpenAISwarm: {str(e)}")
             raise
 
     def count_tokens(self, text: str) -> int:
-        """Conta i token in un testo usando tiktoken."""
-        try:
-            return len(self.tokenizer.encode(text))
-        except Exception as e:
-            logger.error(f"Error counting tokens: {str(e)}")
-            return len(text) // 4  # Fallback approssimativo
+        """Conta i token in un testo usando tiktoken (con cache LRU di processo)."""
+        return count_tokens(text)
+
+    def count_content_tokens(self, text: str) -> int:
+        """Conta i token di un contenuto lungo (post, sintesi) senza tenerlo nella cache."""
+        return count_text_tokens(text)
 
     def truncate_to_token_limit(self, text: str, max_tokens: int) -> str:
         """Tronca il testo per rispettare il limite di token mantenendo frasi complete."""
@@ -84,12 +170,70 @@ class OpenAISwarm:
             logger.error(f"Error truncating text: {str(e)}")
             return text[:max_tokens * 4]  # Fallback approssimativo
 
-    def split_documents_for_agents(self, documents: List[Document], num_agents: int) -> List[List[Document]]:
-        """Divide i documenti equamente tra gli agenti mantenendo i thread intatti."""
+    def analyzer_system_tokens(self, query: str, agent_id: int = 98) -> int:
+        """Token del messaggio di sistema dell'analizzatore senza contesto (id a due cifre per eccesso)."""
+        return self.count_tokens(template.format(
+            agent_id=agent_id + 1,
+            role_desc=analyzer_role_desc,
+            context_section=analyzer_context_section.format(context=""),
+            query=query,
+            role_instructions=analyzer_instructions
+        ))
+
+    def agent_context_budget(self, query: str) -> int:
+        """Token di contesto di un agente: lo stesso budget applicato da ``analyze_with_agent``."""
+        return self.MAX_TOKENS_PER_REQUEST - self.RESPONSE_TOKENS - self.analyzer_system_tokens(query)
+
+    def context_overhead_tokens(self) -> int:
+        """Token fissi del contesto compatto: legenda del formato e intestazione degli alias."""
+        return self.count_tokens(compact_context_legend) + self.count_tokens("\nAutori: ") + self.SEPARATOR_TOKENS
+
+    def agent_packing_capacity(self, query: str) -> int:
+        """Token di post che entrano in un agente, al netto delle parti fisse del contesto."""
+        return self.agent_context_budget(query) - self.context_overhead_tokens()
+
+    @staticmethod
+    def get_post_epoch(doc: Post) -> int:
+        """Timestamp epoch del post, precalcolato dal retriever quando disponibile."""
+        epoch = doc.metadata.get('post_epoch')
+        if epoch is not None:
+            return epoch
+        return to_epoch(doc.metadata.get('post_time', ''))
+
+    def split_thread_pieces(self, posts: List[Post], capacity: int) -> List[Tuple[List[Post], int]]:
+        """Divide i post di un thread, in ordine cronologico, in pezzi che entrano in ``capacity`` token."""
+        posts = sorted(posts, key=self.get_post_epoch)
+        header_tokens = self.count_thread_header_tokens(posts[0])
+        pieces = []
+        current_piece, current_tokens, current_authors = [], header_tokens, set()
+        for doc in posts:
+            authors = self.post_authors(doc)
+            doc_tokens = self.count_post_tokens(doc) + self.count_alias_tokens(authors - current_authors)
+            if current_piece and current_tokens + doc_tokens > capacity:
+                pieces.append((current_piece, current_tokens))
+                current_piece, current_tokens, current_authors = [], header_tokens, set()
+                doc_tokens = self.count_post_tokens(doc) + self.count_alias_tokens(authors)
+            current_piece.append(doc)
+            current_tokens += doc_tokens
+            current_authors |= authors
+        if current_piece:
+            pieces.append((current_piece, current_tokens))
+        return pieces
+
+    def split_documents_for_agents(self, documents: List[Post], num_agents: int, query: str) -> List[List[Post]]:
+        """Distribuisce i thread tra gli agenti in base al peso in token.
+
+        I thread vengono impacchettati in stile first-fit-decreasing nel budget
+        di contesto che ``analyze_with_agent`` applica per ``query``; i thread
+        troppo grandi sono divisi sui confini dei post. Il numero di agenti
+        deriva dai token totali e ``num_agents`` è solo il limite massimo.
+        """
         try:
             if not documents:
                 return []
 
+            capacity = self.agent_packing_capacity(query)
+
             # Raggruppa i documenti per thread_id
             threads = {}
             for doc in documents:
@@ -97,41 +241,58 @@ class OpenAISwarm:
                 if thread_id not in threads:
                     threads[thread_id] = []
                 threads[thread_id].append(doc)
-            
-            # Ordina i thread per timestamp del primo post
-            sorted_threads = sorted(
-                threads.values(),
-                key=lambda x: datetime.fromisoformat(x[0].metadata.get('post_time', '1970-01-01T00:00:00+00:00'))
-            )
 
-            # Calcola il numero approssimativo di thread per agente
-            threads_per_agent = len(sorted_threads) // num_agents
-            if threads_per_agent == 0:
-                threads_per_agent = 1
+            # Ordina i thread per timestamp del primo post (epoch dal catalogo)
+            thread_posts = list(threads.values())
+            first_epochs = np.array([
+                min(self.get_post_epoch(doc) for doc in posts) for posts in thread_posts
+            ], dtype=np.int64)
+            sorted_threads = [thread_posts[i] for i in np.argsort(first_epochs, kind="stable")]
 
-            # Distribuisci i thread tra gli agenti
-            agent_docs = []
-            current_agent_docs = []
-            current_thread_count = 0
+            # Pezzi da assegnare: thread interi o porzioni di thread sui confini dei post
+            pieces = []
+            for thread_rank, posts in enumerate(sorted_threads):
+                for piece_docs, piece_tokens in self.split_thread_pieces(posts, capacity):
+                    pieces.append({"rank": (thread_rank, len(pieces)), "docs": piece_docs, "tokens": piece_tokens})
+
+            total_tokens = sum(piece["tokens"] for piece in pieces)
+            max_agents = max(1, num_agents)
+            target_agents = min(max_agents, max(1, -(-total_tokens // capacity)))
 
-            for thread_posts in sorted_threads:
-                current_agent_docs.extend(thread_posts)
-                current_thread_count += 1
+            # First-fit-decreasing: ogni pezzo va nell'agente meno carico in cui entra
+            bins = [{"pieces": [], "tokens": 0} for _ in range(target_agents)]
+            overflow_tokens = 0
+            for piece in sorted(pieces, key=lambda p: p["tokens"], reverse=True):
+                fitting = [b for b in bins if b["tokens"] + piece["tokens"] <= capacity]
+                if fitting:
+                    target = min(fitting, key=lambda b: b["tokens"])
+                elif len(bins) < max_agents:
+                    target = {"pieces": [], "tokens": 0}
+                    bins.append(target)
+                else:
+                    # Limite di agenti raggiunto: il pezzo va all'agente meno carico
+                    target = min(bins, key=lambda b: b["tokens"])
+                    overflow_tokens += max(0, min(piece["tokens"], target["tokens"] + piece["tokens"] - capacity))
+                target["pieces"].append(piece)
+                target["tokens"] += piece["tokens"]
 
-                # Se questo agente ha abbastanza thread e non è l'ultimo agente
-                if current_thread_count >= threads_per_agent and len(agent_docs) < num_agents - 1:
-                    agent_docs.append(current_agent_docs)
-                    current_agent_docs = []
-                    current_thread_count = 0
+            # Ripristina l'ordine cronologico dentro ogni agente
+            agent_docs = []
+            for agent_bin in bins:
+                if not agent_bin["pieces"]:
+                    continue
+                agent_bin["pieces"].sort(key=lambda p: p["rank"])
+                agent_docs.append([doc for piece in agent_bin["pieces"] for doc in piece["docs"]])
 
-            # Aggiungi i thread rimanenti all'ultimo agente
-            if current_agent_docs:
-                agent_docs.append(current_agent_docs)
+            if overflow_tokens:
+                logger.warning(
+                    f"Agent cap of {max_agents} reached: about {overflow_tokens} tokens exceed the agents' context budget"
+                )
 
             # Log della distribuzione
-            for i, docs in enumerate(agent_docs):
+            for i, (docs, agent_bin) in enumerate(zip(agent_docs, [b for b in bins if b["pieces"]])):
                 thread_ids = set(doc.metadata.get('thread_id', 'unknown') for doc in docs)
-                logger.info(f"Agent #{i+1}: {len(thread_ids)} threads, {len(docs)} posts")
+                logger.info(f"Agent #{i+1}: {len(thread_ids)} threads, {len(docs)} posts, {agent_bin['tokens']} tokens")
 
             return agent_docs
 
@@ -139,45 +300,388 @@ class OpenAISwarm:
             logger.error(f"Error splitting documents for agents: {str(e)}")
             raise
 
-    def format_documents(self, documents: List[Document]) -> str:
-        """Formatta i documenti per l'analisi."""
-        try:
-            formatted_posts = []
-            total_tokens = 0
-            
-            for doc in documents:
-                thread_title = doc.metadata.get('thread_title', 'Unknown Thread')
-                author = doc.metadata.get('author', 'Unknown')
-                time = doc.metadata.get('post_time', '')
-                content = doc.page_content.strip()
-                keywords = doc.metadata.get('keywords', [])
-                sentiment = doc.metadata.get('sentiment', 0.0)
-                
-                post = f"""Thread: {thread_title}
+    def format_post_header(self, doc: Post) -> str:
+        """Intestazione del post nel formato esteso (tutto ciò che precede il contenuto)."""
+        thread_title = doc.metadata.get('thread_title', 'Unknown Thread')
+        author = doc.metadata.get('author', 'Unknown')
+        time = doc.metadata.get('post_time', '')
+        keywords = doc.metadata.get('keywords', [])
+        sentiment = doc.metadata.get('sentiment', 0.0)
+
+        return f"""Thread: {thread_title}
 Author: {author}
 Time: {time}
 Keywords: {', '.join(keywords) if keywords else 'N/A'}
 Sentiment: {sentiment}
-Content: {content}
----"""
-                
-                post_tokens = self.count_tokens(post)
-                
-                # Se il post non supera il limite, aggiungilo
-                if total_tokens + post_tokens <= self.MAX_TOKENS_PER_REQUEST * 0.7:  # 70% del limite per sicurezza
-                    formatted_posts.append(post)
-                    total_tokens += post_tokens
-                else:
-                    break
-            
-            return "\n\n".join(formatted_posts)
+Content: """
+
+    def format_post(self, doc: Post) -> str:
+        """Formatta un singolo post nel formato esteso."""
+        return f"{self.format_post_header(doc)}{doc.page_content.strip()}\n---"
+
+    def count_verbose_post_tokens(self, doc: Post) -> int:
+        """Token del post nel formato esteso, riferimento per misurare il risparmio del formato compatto.
+
+        Usa il conteggio precalcolato all'ingestione (``token_count``) più
+        l'intestazione; solo i post senza conteggio vengono tokenizzati per intero.
+        """
+        token_count = doc.metadata.get('token_count')
+        if token_count is None:
+            return self.count_content_tokens(self.format_post(doc)) + self.SEPARATOR_TOKENS
+        return int(token_count) + self.count_tokens(self.format_post_header(doc)) + self.FOOTER_TOKENS + self.SEPARATOR_TOKENS
+
+    @staticmethod
+    def format_relative_time(seconds: int) -> str:
+        """Tempo trascorso in forma compatta: +45m, +3h20m, +2d5h."""
+        minutes = max(0, int(seconds)) // 60
+        days, minutes = divmod(minutes, 1440)
+        hours, minutes = divmod(minutes, 60)
+        if days:
+            return f"+{days}d{hours}h" if hours else f"+{days}d"
+        if hours:
+            return f"+{hours}h{minutes}m" if minutes else f"+{hours}h"
+        return f"+{minutes}m"
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Testo normalizzato per confrontare citazioni e post (spazi, maiuscole, evidenziazioni)."""
+        return " ".join(text.replace("*", "").split()).lower()
+
+    def post_fields(self, doc: Post) -> Dict[str, Any]:
+        """Campi del post: metadati quando presenti, altrimenti ricavati dal testo.
+
+        I token di contenuto e citazione sono quelli salvati all'ingestione
+        (``content_tokens``, ``quote_tokens``): si tokenizzano solo i post
+        indicizzati prima o con lo span evidenziato. Sui ``PostRecord`` il
+        risultato resta nel record, così impacchettamento, selezione e
+        formattazione non ripetono il parsing.
+        """
+        if isinstance(doc, PostRecord) and doc.fields is not None:
+            return doc.fields
+        metadata = doc.metadata
+        if metadata.get('is_summary'):
+            content = doc.page_content.strip()
+            content_tokens = metadata.get('content_tokens')
+            return {
+                "author": None, "content": content, "quoted_author": None,
+                "quoted_content": None, "keywords": [], "sentiment": None,
+                "summary_posts": metadata.get('summary_posts', 0),
+                "content_tokens": self.count_content_tokens(content) if content_tokens is None else content_tokens,
+                "quote_tokens": 0
+            }
+        fields = parse_post_text(doc.page_content)
+        keywords = metadata.get('keywords')
+        if keywords is None:
+            keywords = [k.strip() for k in fields.get('keywords', '').split(',') if k.strip()]
+        sentiment = metadata.get('sentiment', fields.get('sentiment'))
+        try:
+            sentiment = f"{round(float(sentiment), 2):g}"
+        except (TypeError, ValueError):
+            sentiment = None
+        quoted_content = metadata.get('quoted_content') or fields.get('quoted_content')
+
+        # L'evidenziazione cambia il testo rispetto a quello contato all'ingestione
+        highlighted = isinstance(doc, PostRecord) and doc.highlighted is not None
+        content_tokens = None if highlighted else metadata.get('content_tokens')
+        if content_tokens is None:
+            content_tokens = self.count_content_tokens(fields['content'])
+        quote_tokens = metadata.get('quote_tokens') if quoted_content else 0
+        if quote_tokens is None:
+            quote_tokens = self.count_content_tokens(quoted_content)
+
+        fields = {
+            "author": metadata.get('author') or fields.get('author') or 'Unknown',
+            "content": fields['content'],
+            "quoted_author": metadata.get('quoted_author') or fields.get('quoted_author'),
+            "quoted_content": quoted_content,
+            "keywords": keywords,
+            "sentiment": sentiment,
+            "content_tokens": int(content_tokens),
+            "quote_tokens": int(quote_tokens)
+        }
+        if isinstance(doc, PostRecord):
+            doc.fields = fields
+        return fields
+
+    def compact_post_lines(self, fields: Dict[str, Any], number: int, author: str, relative_time: str,
+                           reference: Optional[int] = None, quoted_author: Optional[str] = None) -> List[str]:
+        """Righe del post nel formato compatto: intestazione, citazione (se non in contesto), contenuto."""
+        if fields.get('summary_posts') is not None:
+            return [f"#{number} sintesi del thread ({fields['summary_posts']} post)", fields['content']]
+        header = f"#{number} {author} {relative_time}"
+        if fields['keywords']:
+            header += f" | kw: {', '.join(fields['keywords'])}"
+        if fields['sentiment'] is not None:
+            header += f" | s={fields['sentiment']}"
+        lines = []
+        if reference is not None:
+            header += f" ↪#{reference}"
+            lines.append(header)
+        else:
+            lines.append(header)
+            if fields['quoted_content']:
+                lines.append(f"> {quoted_author or fields['quoted_author'] or '?'}: {fields['quoted_content']}")
+        lines.append(fields['content'])
+        return lines
+
+    def count_post_lines_tokens(self, fields: Dict[str, Any], lines: List[str]) -> int:
+        """Token delle righe di ``compact_post_lines`` unite da "\n".
+
+        Si tokenizzano solo l'intestazione e l'etichetta della citazione, brevi
+        e in cache; contenuto e testo citato usano i conteggi di ``post_fields``.
+        """
+        tokens = self.count_tokens(lines[0]) + fields['content_tokens'] + len(lines) - 1
+        if len(lines) == 3:
+            # Riga "> autore: citazione": l'etichetta precede il testo citato
+            quote_label = lines[1][:len(lines[1]) - len(fields['quoted_content'])]
+            tokens += self.count_tokens(quote_label) + fields['quote_tokens']
+        return tokens
+
+    def estimate_label(self, name: Optional[str]) -> Optional[str]:
+        """Nome o alias dell'autore, quello con più token, per le stime per eccesso."""
+        if name and self.count_tokens(name) < self.count_tokens(ALIAS_PLACEHOLDER):
+            return ALIAS_PLACEHOLDER
+        return name
+
+    def count_post_tokens(self, doc: Post) -> int:
+        """Stima per eccesso dei token del post nel formato compatto, separatore incluso.
+
+        Contenuto e citazione usano i conteggi precalcolati all'ingestione; si
+        aggiunge solo la stima dell'intestazione. Le voci della legenda degli
+        alias sono a parte (``count_alias_tokens``), perché si pagano una sola
+        volta per autore.
+        """
+        fields = self.post_fields(doc)
+        relative_time = "+99d23h" if self.get_post_epoch(doc) else doc.metadata.get('post_time', '')
+        lines = self.compact_post_lines(
+            fields, 9999, self.estimate_label(fields['author']), relative_time,
+            quoted_author=self.estimate_label(fields['quoted_author'])
+        )
+        return self.count_post_lines_tokens(fields, lines) + self.SEPARATOR_TOKENS
+
+    def post_authors(self, doc: Post) -> Set[str]:
+        """Autori del post (scrittore e citato) che possono ricevere un alias."""
+        fields = self.post_fields(doc)
+        return {name for name in (fields['author'], fields['quoted_author']) if name}
+
+    def count_alias_tokens(self, authors: Iterable[str]) -> int:
+        """Stima per eccesso delle voci "alias=nome, " della legenda per gli autori dati."""
+        return sum(self.count_tokens(f"{ALIAS_PLACEHOLDER}={name}, ") for name in authors)
+
+    def format_thread_header(self, doc: Post) -> str:
+        """Intestazione compatta del thread con l'ora del primo post in contesto."""
+        title = doc.metadata.get('thread_title', 'Unknown Thread')
+        epoch = self.get_post_epoch(doc)
+        start = datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%d %H:%M") if epoch else doc.metadata.get('post_time', '')
+        return f"## {title} ({start})"
+
+    def count_thread_header_tokens(self, doc: Post) -> int:
+        return self.count_tokens(self.format_thread_header(doc)) + self.SEPARATOR_TOKENS
+
+    def find_quoted_post(self, fields: Dict[str, Any], rendered: List[Tuple[int, str, str]]) -> Optional[int]:
+        """Numero del post già in contesto da cui proviene la citazione, se presente."""
+        if not fields['quoted_content']:
+            return None
+        quote = self.normalize_text(fields['quoted_content'])
+        if not quote:
+            return None
+        for number, author, content in reversed(rendered):
+            if fields['quoted_author'] and author != fields['quoted_author']:
+                continue
+            if quote == content or (len(quote) >= 20 and quote[:200] in content):
+                return number
+        return None
+
+    def apply_thread_summaries(self, documents: List[Post], summaries: Dict[str, Dict]) -> List[Post]:
+        """Sostituisce i post dei thread meno rilevanti con la loro sintesi precalcolata.
+
+        I primi ``SUMMARY_RAW_THREADS`` thread per rilevanza, e quelli senza
+        sintesi, mantengono i post originali.
+        """
+        threads = {}
+        for doc in documents:
+            threads.setdefault(doc.metadata.get('thread_id', 'unknown'), []).append(doc)
+        ranking = sorted(
+            threads, key=lambda t: max(doc.metadata.get('relevance', 0.0) for doc in threads[t]), reverse=True
+        )
+        raw_threads = set(ranking[:SUMMARY_RAW_THREADS])
+
+        result = []
+        for thread_id, docs in threads.items():
+            summary = summaries.get(thread_id)
+            if thread_id in raw_threads or not summary:
+                result.extend(docs)
+                continue
+            result.append(Document(page_content=summary["summary"], metadata={
+                "thread_id": thread_id,
+                "thread_title": summary.get("title") or docs[0].metadata.get('thread_title', 'Unknown Thread'),
+                "post_epoch": min(self.get_post_epoch(doc) for doc in docs),
+                "relevance": max(doc.metadata.get('relevance', 0.0) for doc in docs),
+                "is_summary": True,
+                "summary_posts": summary.get("posts", len(docs)),
+                "content_tokens": self.count_content_tokens(summary["summary"].strip()),
+                "replaced_posts": len(docs)
+            }))
+
+        summarized = sum(1 for doc in result if doc.metadata.get('is_summary'))
+        logger.info(
+            f"Thread summaries: {summarized} threads summarized, "
+            f"{len(documents)} posts reduced to {len(result)} documents"
+        )
+        return result
+
+    def select_documents_for_budget(self, documents: List[Post], budget: int) -> List[Post]:
+        """Sceglie i post da includere nel budget con un knapsack greedy per rilevanza/token.
+
+        I post sono presi in ordine di rilevanza per token finché entrano; lo
+        spazio rimasto va ai post adiacenti (nello stesso thread) a quelli scelti.
+        Il risultato mantiene l'ordine cronologico di ``documents``.
+        """
+        costs = [self.count_post_tokens(doc) for doc in documents]
+        doc_authors = [self.post_authors(doc) for doc in documents]
+        header_costs = {}
+        for doc in documents:
+            thread_id = doc.metadata.get('thread_id', 'unknown')
+            if thread_id not in header_costs:
+                header_costs[thread_id] = self.count_thread_header_tokens(doc)
+        all_authors = set().union(*doc_authors) if doc_authors else set()
+        if sum(costs) + sum(header_costs.values()) + self.count_alias_tokens(all_authors) <= budget:
+            return documents
+
+        thread_ids = [doc.metadata.get('thread_id', 'unknown') for doc in documents]
+        relevance = np.array([doc.metadata.get('relevance', 1.0) for doc in documents], dtype=np.float64)
+        selected = np.zeros(len(documents), dtype=bool)
+        open_threads = set()
+        seen_authors = set()
+        used_tokens = 0
+
+        def try_select(i: int) -> bool:
+            nonlocal used_tokens
+            cost = costs[i] + (0 if thread_ids[i] in open_threads else header_costs[thread_ids[i]])
+            cost += self.count_alias_tokens(doc_authors[i] - seen_authors)
+            if used_tokens + cost > budget:
+                return False
+            selected[i] = True
+            open_threads.add(thread_ids[i])
+            seen_authors.update(doc_authors[i])
+            used_tokens += cost
+            return True
+
+        # Knapsack greedy: rilevanza per token decrescente, saltando i post che non entrano
+        density = relevance / np.maximum(np.asarray(costs, dtype=np.float64), 1)
+        for i in np.argsort(-density, kind="stable"):
+            try_select(int(i))
+
+        # Vicini conversazionali dei post scelti, a partire dai più rilevanti
+        for i in np.argsort(-relevance, kind="stable"):
+            if not selected[i]:
+                continue
+            for j in (int(i) - 1, int(i) + 1):
+                if 0 <= j < len(documents) and not selected[j] and thread_ids[j] == thread_ids[i]:
+                    try_select(j)
+
+        logger.info(
+            f"Context selection: {int(selected.sum())}/{len(documents)} posts, "
+            f"{used_tokens}/{budget} tokens, relevance kept {relevance[selected].sum() / relevance.sum():.0%}"
+        )
+        return [doc for doc, keep in zip(documents, selected) if keep]
+
+    def format_documents(self, documents: List[Post]) -> str:
+        """Formatta i documenti per l'analisi."""
+        formatted_content, _, _ = self.format_documents_with_tokens(documents)
+        return formatted_content
+
+    def format_documents_with_tokens(self,
+                                     documents: List[Post],
+                                     max_tokens: Optional[int] = None) -> Tuple[str, int, List[Post]]:
+        """Formatta i documenti in forma compatta entro il budget.
+
+        Un'intestazione per thread, alias per gli autori ricorrenti, tempi
+        relativi al primo post del thread e riferimenti ``↪#n`` al posto delle
+        citazioni di post già presenti. Restituisce testo, token (somma
+        incrementale, il contesto non viene ritokenizzato) e post inclusi.
+        """
+        try:
+            limit = self.MAX_TOKENS_PER_REQUEST - self.RESPONSE_TOKENS
+            budget = limit if max_tokens is None else min(max_tokens, limit)
+            legend_tokens = self.context_overhead_tokens()
+
+            # Se i post non entrano tutti, scegli i più utili per token
+            documents = self.select_documents_for_budget(documents, budget - legend_tokens)
+
+            # Alias solo per gli autori che ricorrono: per gli altri il nome costa meno della legenda
+            posts = [(doc, self.post_fields(doc)) for doc in documents]
+            mentions = Counter()
+            for _, fields in posts:
+                if fields['author']:
+                    mentions[fields['author']] += 1
+                if fields['quoted_author']:
+                    mentions[fields['quoted_author']] += 1
+
+            aliases = {}
+            blocks = []
+            rendered = []  # (numero, autore, contenuto normalizzato)
+            included = []
+            current_thread, thread_start = None, 0
+            total_tokens = legend_tokens
+
+            for doc, fields in posts:
+                new_aliases = {}
+
+                def label(name: Optional[str]) -> Optional[str]:
+                    if not name or mentions[name] < 2:
+                        return name
+                    if name not in aliases and name not in new_aliases:
+                        new_aliases[name] = f"A{len(aliases) + len(new_aliases) + 1}"
+                    return aliases.get(name) or new_aliases[name]
+
+                post_blocks, post_tokens = [], 0
+                thread_id = doc.metadata.get('thread_id', 'unknown')
+                epoch = self.get_post_epoch(doc)
+                start = thread_start
+                if thread_id != current_thread:
+                    thread_header = self.format_thread_header(doc)
+                    post_blocks.append(thread_header)
+                    post_tokens += self.count_thread_header_tokens(doc)
+                    start = epoch
+
+                reference = self.find_quoted_post(fields, rendered)
+                number = len(rendered) + 1
+                lines = self.compact_post_lines(
+                    fields, number, label(fields['author']),
+                    self.format_relative_time(epoch - start) if epoch and start else doc.metadata.get('post_time', ''),
+                    reference, label(fields['quoted_author']) if reference is None else None
+                )
+                post_blocks.append("\n".join(lines))
+                post_tokens += self.count_post_lines_tokens(fields, lines) + self.SEPARATOR_TOKENS
+                post_tokens += sum(self.count_tokens(f"{alias}={name}, ") for name, alias in new_aliases.items())
+
+                # Le stime sono per eccesso: un post che non entra viene saltato senza fermare gli altri
+                if total_tokens + post_tokens > budget:
+                    continue
+                aliases.update(new_aliases)
+                blocks.extend(post_blocks)
+                rendered.append((number, fields['author'], self.normalize_text(fields['content'])))
+                included.append(doc)
+                total_tokens += post_tokens
+                current_thread, thread_start = thread_id, start
+
+            if len(rendered) < len(documents):
+                logger.warning(f"Context budget of {budget} tokens reached: {len(rendered)}/{len(documents)} posts included")
+            if not rendered:
+                return "", 0, []
+
+            legend = compact_context_legend
+            if aliases:
+                legend += "\nAutori: " + ", ".join(f"{alias}={name}" for name, alias in aliases.items())
+            return "\n\n".join([legend] + blocks), total_tokens, included
             
         except Exception as e:
             logger.error(f"Error formatting documents: {str(e)}")
             raise
 
     async def analyze_with_agent(self, 
-                           documents: List[Document], 
+                           documents: List[Post], 
                            agent_id: int,
                            query: str,
                            retry_count: int = 0) -> Optional[str]:
@@ -187,36 +691,21 @@ Content: {content}
             return None
 
         try:
-            formatted_content = self.format_documents(documents)
+            # Il contesto viene costruito direttamente entro i token disponibili,
+            # lo stesso budget usato per dividere i thread tra gli agenti
+            formatted_content, content_tokens, included = self.format_documents_with_tokens(
+                documents, self.agent_context_budget(query)
+            )
             if not formatted_content.strip():
                 logger.warning(f"Agent #{agent_id}: Empty formatted content")
                 return None
-
-            # Calcola i token del contenuto formattato
-            content_tokens = self.count_tokens(formatted_content)
             logger.info(f"Agent #{agent_id}: Content tokens: {content_tokens}")
 
-            # Prepara il messaggio di sistema
-            system_message = template.format(
-                agent_id=agent_id + 1,
-                role_desc=analyzer_role_desc,
-                context_section=analyzer_context_section.format(context="[CONTEXT]"),  # Placeholder
-                query=query,
-                role_instructions=analyzer_instructions
-            )
-            system_tokens = self.count_tokens(system_message)
-            logger.info(f"Agent #{agent_id}: System message tokens: {system_tokens}")
-
-            # Verifica se il totale dei token è entro il limite
-            total_tokens = content_tokens + system_tokens
-            available_tokens = self.MAX_TOKENS_PER_REQUEST - 4000  # Riserva 4000 token per la risposta
-            
-            if total_tokens > available_tokens:
-                logger.warning(f"Agent #{agent_id}: Token limit exceeded. Total: {total_tokens}, Available: {available_tokens}")
-                # Tronca il contenuto se necessario
-                max_content_tokens = available_tokens - system_tokens
-                formatted_content = self.truncate_to_token_limit(formatted_content, max_content_tokens)
-                logger.info(f"Agent #{agent_id}: Content truncated to {self.count_tokens(formatted_content)} tokens")
+            # Risparmio rispetto al formato esteso, raccolto per la query corrente
+            token_stats = context_token_stats.get()
+            if token_stats is not None:
+                verbose_tokens = sum(self.count_verbose_post_tokens(doc) for doc in included)
+                token_stats[agent_id] = (content_tokens, verbose_tokens)
 
             # Costruisci il messaggio finale
             system_message = template.format(
@@ -232,14 +721,14 @@ Content: {content}
             ]
             
             logger.info(f"Agent #{agent_id}: Sending request to OpenAI")
-            response = await self.analyzer_llm.ainvoke(messages)
+            content = await self.invoke_llm(self.analyzer_llm, messages)
             
-            if not response or not response.content:
+            if not content:
                 logger.warning(f"Agent #{agent_id}: Empty response from OpenAI")
                 return None
                 
             logger.info(f"Agent #{agent_id}: Successfully received response")
-            return response.content
+            return content
             
         except Exception as e:
             logger.error(f"Error in agent #{agent_id} analysis (attempt {retry_count + 1}): {str(e)}")
@@ -248,11 +737,188 @@ Content: {content}
                 return await self.analyze_with_agent(documents, agent_id, query, retry_count + 1)
             return None
 
+    async def invoke_llm(self, llm, messages, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Esegue una chiamata LLM attraverso il rate limiter condiviso dal processo.
+
+        Le risposte sono servite dalla cache persistente quando la stessa
+        richiesta (modello, temperatura, messaggi) è già stata eseguita, a meno
+        che la cache non sia disattivata per la query corrente.
+        """
+        cache = self.response_cache if llm_cache_enabled.get() else None
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(llm, messages)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                content, usage = cached
+                logger.info(f"LLM cache hit for {llm.model_name} ({usage.get('total_tokens', '?')} tokens saved)")
+                if on_token is not None:
+                    on_token(content)
+                return content
+
+        # Nel bucket si prenota la risposta attesa; a fine chiamata si conguaglia con l'uso effettivo
+        prompt_tokens = count_prompt_tokens(messages)
+        tokens = prompt_tokens + expected_completion_tokens(llm.max_tokens)
+        async with self.rate_limiter.limit(tokens) as reservation:
+            if on_token is not None:
+                content = await self.stream_response(llm, messages, on_token)
+                usage = {}
+            else:
+                response = await llm.ainvoke(messages)
+                content = response.content if response else ""
+                usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+            if not usage:
+                # Lo streaming non riporta l'uso: stima con il tokenizer
+                completion_tokens = count_text_tokens(content)
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "estimated": True
+                }
+            reservation.settle(usage.get("total_tokens"))
+
+        if cache is not None and content:
+            cache.set(cache_key, llm.model_name, content, dict(usage))
+        return content
+
+    async def stream_response(self, llm, messages, on_token: Callable[[str], None]) -> str:
+        """Genera la risposta in streaming passando il testo accumulato alla callback."""
+        content = ""
+        async for chunk in llm.astream(messages):
+            if chunk.content:
+                content += chunk.content
+                on_token(content)
+        return content
+
+    def build_synthesis_messages(self, analyses: List[str], query: str, agent_id: str = "S",
+                                 role_desc: str = synthesizer_role_desc,
+                                 role_instructions: str = synthesizer_instructions,
+                                 label: str = "Analisi Agente") -> list:
+        """Messaggi per una chiamata di sintesi su un gruppo di analisi.
+
+        Le analisi stanno solo nel messaggio di sistema; il messaggio utente
+        porta la domanda, così le analisi non occupano il contesto due volte.
+        """
+        synthesis_text = "\n\n".join([
+            f"--- {label} #{i+1} ---\n{analysis}"
+            for i, analysis in enumerate(analyses)
+        ])
+        return [
+            SystemMessage(content=template.format(
+                agent_id=agent_id,
+                role_desc=role_desc,
+                context_section=synthesizer_context_section.format(context=synthesis_text),
+                query=query,
+                role_instructions=role_instructions
+            )),
+            HumanMessage(content=query)
+        ]
+
+    def group_by_tokens(self, token_counts: List[int], budget: int) -> List[List[int]]:
+        """Raggruppa in ordine elementi consecutivi senza superare il budget di token."""
+        groups, current, current_tokens = [], [], 0
+        for i, tokens in enumerate(token_counts):
+            if current and current_tokens + tokens > budget:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    async def reduce_group(self, analyses: List[str], query: str, level: int, group_id: int) -> str:
+        """Fonde un gruppo di analisi in una sintesi parziale (un nodo del tree-reduce)."""
+        messages = self.build_synthesis_messages(
+            analyses, query,
+            agent_id=f"R{level}.{group_id + 1}",
+            role_desc=reducer_role_desc,
+            role_instructions=reducer_instructions
+        )
+        for retry_count in range(self.MAX_RETRIES):
+            try:
+                content = await self.invoke_llm(self.reducer_llm, messages)
+                if content:
+                    return content
+                raise ValueError("Empty response from reduce step")
+            except Exception as e:
+                logger.error(f"Error in reduce step L{level}.{group_id + 1} (attempt {retry_count + 1}): {str(e)}")
+                await asyncio.sleep(2 ** retry_count)
+
+        # In caso di errore il gruppo prosegue con le analisi troncate
+        per_analysis = max(1, self.REDUCE_RESPONSE_TOKENS // len(analyses))
+        return "\n\n".join(self.truncate_to_token_limit(a, per_analysis) for a in analyses)
+
+    def synthesis_budgets(self, query: str) -> Tuple[int, int]:
+        """Token di analisi per la sintesi finale e per ogni gruppo del tree-reduce."""
+        def input_budget(response_tokens: int, **prompt_args) -> int:
+            messages = self.build_synthesis_messages([], query, **prompt_args)
+            prompt_tokens = sum(self.count_tokens(message.content) for message in messages)
+            return self.SYNTHESIS_CONTEXT_TOKENS - response_tokens - prompt_tokens
+
+        final_budget = input_budget(self.SYNTHESIS_RESPONSE_TOKENS)
+        group_budget = input_budget(
+            self.REDUCE_RESPONSE_TOKENS, agent_id="R00.00",
+            role_desc=reducer_role_desc, role_instructions=reducer_instructions
+        )
+        return final_budget, group_budget
+
+    async def reduce_analyses(self, analyses: List[str], query: str) -> List[str]:
+        """Riduce le analisi a livelli, in parallelo, finché entrano in una sola sintesi.
+
+        I budget derivano dal contesto del modello meno la risposta riservata
+        e il prompt: quello del sintetizzatore per la sintesi finale, quello
+        dei riduttori per i gruppi, formati dai conteggi reali dei token di
+        ogni analisi. I gruppi di una sola analisi passano al livello
+        successivo senza chiamate.
+        """
+        final_budget, group_budget = self.synthesis_budgets(query)
+        # Ogni analisi occupa al massimo metà budget: ogni gruppo, salvo l'ultimo, ne contiene almeno due
+        max_analysis_tokens = group_budget // 2 - self.ANALYSIS_HEADER_TOKENS
+
+        level = 0
+        while True:
+            token_counts = [self.count_tokens(a) + self.ANALYSIS_HEADER_TOKENS for a in analyses]
+            if sum(token_counts) <= final_budget:
+                return analyses
+            if len(analyses) == 1:
+                # Nulla da fondere: l'analisi rimasta viene troncata al budget della sintesi
+                return [self.truncate_to_token_limit(analyses[0], final_budget - self.ANALYSIS_HEADER_TOKENS)]
+
+            level += 1
+            analyses = [
+                self.truncate_to_token_limit(a, max_analysis_tokens) if tokens > group_budget // 2 else a
+                for a, tokens in zip(analyses, token_counts)
+            ]
+            token_counts = [min(tokens, group_budget // 2) for tokens in token_counts]
+            groups = self.group_by_tokens(token_counts, group_budget)
+            logger.info(
+                f"Synthesis tree-reduce level {level}: {len(analyses)} analyses "
+                f"({sum(token_counts)} tokens) into {len(groups)} groups"
+            )
+
+            async def reduce_or_pass(group: List[int], group_id: int) -> str:
+                if len(group) == 1:
+                    return analyses[group[0]]
+                return await self.reduce_group([analyses[i] for i in group], query, level, group_id)
+
+            analyses = await asyncio.gather(*[
+                reduce_or_pass(group, group_id) for group_id, group in enumerate(groups)
+            ])
+
     async def synthesize_analyses(self, 
                             analyses: List[str], 
                             query: str,
-                            retry_count: int = 0) -> str:
-        """Sintetizza le analisi degli agenti."""
+                            retry_count: int = 0,
+                            on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Sintetizza le analisi degli agenti.
+
+        Se le analisi non entrano in una sola chiamata vengono prima fuse con
+        un tree-reduce (``reduce_analyses``). Se ``on_token`` è fornito la
+        risposta finale viene generata in streaming e la callback riceve il
+        testo accumulato dopo ogni token.
+        """
         if retry_count >= self.MAX_RETRIES:
             return "Non è stato possibile completare la sintesi dei risultati."
 
@@ -261,86 +927,476 @@ Content: {content}
             if not valid_analyses:
                 return "Nessuna analisi valida da sintetizzare."
 
-            synthesis_text = "\n\n".join([
-                f"--- Analisi Agente #{i+1} ---\n{analysis}"
-                for i, analysis in enumerate(valid_analyses)
-            ])
+            # I tentativi successivi ripartono dalle analisi già ridotte
+            if retry_count == 0:
+                analyses = valid_analyses = await self.reduce_analyses(valid_analyses, query)
 
-            messages = [
-                SystemMessage(content=template.format(
-                    agent_id="S",
-                    role_desc=synthesizer_role_desc,
-                    context_section=synthesizer_context_section.format(context=synthesis_text),
-                    query=query,
-                    role_instructions=synthesizer_instructions
-                )),
-                HumanMessage(content=synthesis_text)
-            ]
+            messages = self.build_synthesis_messages(valid_analyses, query)
             
-            response = await self.synthesizer_llm.ainvoke(messages)
-            if not response or not response.content:
+            content = await self.invoke_llm(self.synthesizer_llm, messages, on_token)
+            if not content:
                 raise ValueError("Empty response from synthesis")
                 
-            return response.content
+            return content
             
         except Exception as e:
             logger.error(f"Error in synthesis (attempt {retry_count + 1}): {str(e)}")
             if retry_count < self.MAX_RETRIES:
                 await asyncio.sleep(2 ** retry_count)
-                return await self.synthesize_analyses(analyses, query, retry_count + 1)
+                return await self.synthesize_analyses(analyses, query, retry_count + 1, on_token)
             return "Errore nella sintesi dei risultati."
 
+    async def fold_analysis(self,
+                            previous: Optional[asyncio.Task],
+                            analysis: Optional[str],
+                            query: str,
+                            step: int,
+                            on_token: Optional[Callable[[str], None]] = None,
+                            final: bool = False) -> Optional[str]:
+        """Fonde una nuova analisi nella sintesi progressiva.
+
+        Attende il passaggio precedente (i passaggi sono in catena, gli agenti
+        continuano in parallelo); l'ultimo passaggio usa il sintetizzatore e
+        produce la risposta finale, gli altri il riduttore.
+        """
+        summary = await previous if previous is not None else None
+        analyses = [a for a in (summary, analysis) if a]
+        if not analyses:
+            return None
+        if final:
+            return await self.synthesize_analyses(analyses, query, on_token=on_token)
+        if len(analyses) == 1:
+            return analyses[0]
+        _, group_budget = self.synthesis_budgets(query)
+        max_analysis_tokens = group_budget // 2 - self.ANALYSIS_HEADER_TOKENS
+        analyses = [self.truncate_to_token_limit(a, max_analysis_tokens) for a in analyses]
+        return await self.reduce_group(analyses, query, level=0, group_id=step - 1)
+
+    @staticmethod
+    def parse_confidence(line: str) -> int:
+        """Confidenza dichiarata nella prima riga ("CONFIDENZA: N"); 0 se assente."""
+        match = CONFIDENCE_PATTERN.search(line)
+        return min(100, int(match.group(1))) if match else 0
+
+    async def quick_answer(self,
+                           documents: List[Post],
+                           query: str,
+                           on_token: Optional[Callable[[str], None]] = None,
+                           use_cache: bool = True) -> Tuple[Optional[str], int]:
+        """Primo livello della cascata: una sola chiamata sui post più rilevanti.
+
+        Il modello dichiara la propria confidenza nella prima riga: se è sotto
+        ``CASCADE_CONFIDENCE_THRESHOLD`` lo streaming viene interrotto subito e
+        si restituisce ``(None, confidenza)`` perché la query passi allo swarm.
+        """
+        top_posts = sorted(documents, key=lambda doc: doc.metadata.get('relevance', 0.0), reverse=True)
+        top_posts = sorted(top_posts[:CASCADE_TOP_POSTS], key=self.get_post_epoch)
+        context, _, included = self.format_documents_with_tokens(top_posts, CASCADE_CONTEXT_TOKENS)
+        if not included:
+            return None, 0
+
+        messages = [SystemMessage(content=cascade_template.format(
+            included=len(included), total=len(documents), context=context, query=query
+        ))]
+
+        confidence = None
+
+        def forward(text: str):
+            nonlocal confidence
+            if confidence is None:
+                if "\n" not in text:
+                    return
+                confidence = self.parse_confidence(text.split("\n", 1)[0])
+                if confidence < CASCADE_CONFIDENCE_THRESHOLD:
+                    raise LowConfidenceAnswer(confidence)
+            answer = text.split("\n", 1)[1].lstrip()
+            if on_token is not None and answer:
+                on_token(answer)
+
+        cache_token = llm_cache_enabled.set(use_cache)
+        try:
+            content = await self.invoke_llm(self.cascade_llm, messages, on_token=forward)
+        except LowConfidenceAnswer as e:
+            return None, e.confidence
+        finally:
+            llm_cache_enabled.reset(cache_token)
+
+        first_line, _, answer = content.partition("\n")
+        confidence = self.parse_confidence(first_line)
+        answer = answer.strip()
+        if confidence < CASCADE_CONFIDENCE_THRESHOLD or not answer:
+            return None, confidence
+        return answer, confidence
+
+    async def answer_follow_up(self,
+                               query: str,
+                               previous,
+                               documents: List[Post],
+                               filtered: bool = False,
+                               on_token: Optional[Callable[[str], None]] = None,
+                               use_cache: bool = True) -> str:
+        """Risponde a una domanda di follow-up con una sola chiamata.
+
+        Riusa domanda, risposta e analisi del turno precedente (``previous``,
+        un ``ConversationTurn``) e i suoi post, eventualmente già filtrati.
+        """
+        analyses = "\n\n".join(previous.analyses)
+        if analyses:
+            analyses = self.truncate_to_token_limit(analyses, FOLLOW_UP_ANALYSES_TOKENS)
+        context, _, _ = self.format_documents_with_tokens(
+            sorted(documents, key=self.get_post_epoch), FOLLOW_UP_CONTEXT_TOKENS
+        )
+        messages = [
+            SystemMessage(content=follow_up_template.format(
+                previous_query=previous.query,
+                previous_answer=self.truncate_to_token_limit(previous.answer, self.REDUCE_RESPONSE_TOKENS),
+                analyses=analyses or "(nessuna)",
+                filter_note=" (filtrati per periodo)" if filtered else "",
+                context=context
+            )),
+            HumanMessage(content=query)
+        ]
+        cache_token = llm_cache_enabled.set(use_cache)
+        try:
+            return await self.invoke_llm(self.analyzer_llm, messages, on_token)
+        finally:
+            llm_cache_enabled.reset(cache_token)
+
+    def record_swarm_latency(self, latency: float):
+        """Aggiorna la latenza media dello swarm (media mobile esponenziale)."""
+        if self.swarm_latency is None:
+            self.swarm_latency = latency
+        else:
+            self.swarm_latency = 0.8 * self.swarm_latency + 0.2 * latency
+
+    def hedge_threshold(self, latencies: List[float]) -> Optional[float]:
+        """Latenza oltre la quale un agente viene duplicato (multiplo della mediana)."""
+        if len(latencies) < self.HEDGE_MIN_COMPLETED:
+            return None
+        return float(np.median(latencies)) * self.HEDGE_LATENCY_FACTOR
+
+    async def analyze_with_hedging(self,
+                                   documents: List[Post],
+                                   agent_id: int,
+                                   query: str,
+                                   latencies: List[float]) -> Optional[str]:
+        """Esegue l'agente e, se resta indietro rispetto alla mediana, lancia una richiesta duplicata.
+
+        Vince la prima risposta valida; l'altra richiesta viene cancellata.
+        """
+        start_time = time.monotonic()
+        running = {asyncio.create_task(self.analyze_with_agent(documents, agent_id, query))}
+        hedged = False
+        try:
+            while running:
+                done, running = await asyncio.wait(
+                    running, timeout=self.HEDGE_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = task.result()
+                    if result or not running:
+                        if result:
+                            latencies.append(time.monotonic() - start_time)
+                        return result
+
+                threshold = self.hedge_threshold(latencies)
+                if not hedged and threshold is not None and time.monotonic() - start_time > threshold:
+                    logger.info(f"Agent #{agent_id}: slower than {threshold:.1f}s, sending hedged request")
+                    running.add(asyncio.create_task(self.analyze_with_agent(documents, agent_id, query)))
+                    hedged = True
+            return None
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def iterate_workloads(self,
+                                documents: List[Post],
+                                num_agents: int,
+                                query: str,
+                                status_container,
+                                thread_summaries: Optional[Dict[str, Dict]] = None) -> AsyncIterator[List[Post]]:
+        """Carichi degli agenti per un insieme di documenti già completo."""
+        if thread_summaries:
+            documents = self.apply_thread_summaries(documents, thread_summaries)
+        agent_docs = self.split_documents_for_agents(documents, num_agents, query)
+        status_container.write(f"📦 Documenti divisi tra {len(agent_docs)} agenti")
+        logger.info(f"Documents split between {len(agent_docs)} agents")
+        for docs in agent_docs:
+            yield docs
+
+    async def partition_stream(self,
+                               batches: AsyncIterator[List[Post]],
+                               num_agents: int,
+                               query: str) -> AsyncIterator[List[Post]]:
+        """Partizionatore in streaming: emette il carico di un agente appena i thread arrivati lo riempiono.
+
+        Ogni blocco contiene thread completi. I pezzi di thread si accumulano
+        nell'agente corrente; l'agente parte quando il prossimo pezzo non
+        entra nel budget o, a fine blocco, quando è pieno almeno per
+        ``STREAM_EMIT_FILL``. L'ultimo agente consentito da ``num_agents``
+        raccoglie il resto (la selezione per rilevanza lo riporta nel budget).
+        """
+        capacity = self.agent_packing_capacity(query)
+        max_agents = max(1, num_agents)
+        pieces, current_tokens, emitted = [], 0, 0
+
+        def flush() -> List[Post]:
+            # Ordine cronologico dei thread dentro l'agente
+            pieces.sort(key=lambda piece: self.get_post_epoch(piece[0]))
+            return [doc for piece in pieces for doc in piece]
+
+        async for batch in batches:
+            threads = {}
+            for doc in batch:
+                threads.setdefault(doc.metadata.get('thread_id', 'unknown'), []).append(doc)
+            for posts in threads.values():
+                for piece_docs, piece_tokens in self.split_thread_pieces(posts, capacity):
+                    if pieces and current_tokens + piece_tokens > capacity and emitted < max_agents - 1:
+                        yield flush()
+                        emitted += 1
+                        pieces, current_tokens = [], 0
+                    pieces.append(piece_docs)
+                    current_tokens += piece_tokens
+            if pieces and current_tokens >= capacity * self.STREAM_EMIT_FILL and emitted < max_agents - 1:
+                yield flush()
+                emitted += 1
+                pieces, current_tokens = [], 0
+        if pieces:
+            yield flush()
+
     async def process_documents(self, 
-                              documents: List[Document], 
+                              documents: List[Post], 
                               query: str,
-                              status_container) -> str:
-        """Processa i documenti usando il sistema multi-agente."""
+                              status_container,
+                              on_token: Optional[Callable[[str], None]] = None,
+                              deadline: Optional[float] = None,
+                              num_agents: int = 3,
+                              show_agent_details: bool = False,
+                              use_cache: bool = True,
+                              incremental_synthesis: bool = False,
+                              thread_summaries: Optional[Dict[str, Dict]] = None,
+                              analyses_sink: Optional[List[str]] = None) -> str:
+        """Processa i documenti usando il sistema multi-agente.
+
+        ``deadline`` è l'istante (``time.monotonic()``) entro cui la risposta
+        deve essere pronta: gli agenti ancora in corso quando resta solo il
+        tempo della sintesi vengono cancellati e si sintetizzano le analisi
+        completate, riportando la copertura ottenuta.
+
+        Può girare nel loop in background: le preferenze della sessione
+        (``num_agents``, ``show_agent_details``, ``use_cache``) arrivano come
+        parametri. Con ``use_cache=False`` tutte le chiamate della query
+        ignorano la cache delle risposte.
+
+        Con ``incremental_synthesis`` ogni analisi viene fusa in una sintesi
+        progressiva appena arriva, così la risposta è pronta subito dopo
+        l'ultimo agente.
+
+        Con ``thread_summaries`` (domande di panoramica) i thread meno
+        rilevanti sono analizzati tramite la loro sintesi precalcolata.
+        ``analyses_sink``, se fornita, riceve le analisi valide degli agenti
+        (riusate dalle domande di follow-up).
+        """
+        if not documents:
+            return "Nessun documento da analizzare."
+        return await self.run_agents(
+            self.iterate_workloads(documents, num_agents, query, status_container, thread_summaries),
+            query, status_container,
+            on_token=on_token, deadline=deadline, show_agent_details=show_agent_details,
+            use_cache=use_cache, incremental_synthesis=incremental_synthesis, analyses_sink=analyses_sink
+        )
+
+    async def process_document_stream(self,
+                                      batches: AsyncIterator[List[Post]],
+                                      query: str,
+                                      status_container,
+                                      on_token: Optional[Callable[[str], None]] = None,
+                                      deadline: Optional[float] = None,
+                                      num_agents: int = 3,
+                                      show_agent_details: bool = False,
+                                      use_cache: bool = True,
+                                      incremental_synthesis: bool = False,
+                                      analyses_sink: Optional[List[str]] = None,
+                                      documents_sink: Optional[List[Post]] = None) -> str:
+        """Come ``process_documents``, ma consuma i documenti a blocchi mentre il retrieval prosegue.
+
+        Gli agenti partono appena il partizionatore ne riempie uno, così le
+        prime richieste LLM si sovrappongono al resto del retrieval.
+        ``documents_sink``, se fornita, riceve i documenti man mano che arrivano,
+        limitati ai ``CONVERSATION_MAX_DOCUMENTS`` più rilevanti.
+        """
+        async def collect():
+            async for batch in batches:
+                if documents_sink is not None:
+                    documents_sink.extend(batch)
+                    if len(documents_sink) > CONVERSATION_MAX_DOCUMENTS:
+                        documents_sink[:] = heapq.nlargest(
+                            CONVERSATION_MAX_DOCUMENTS, documents_sink,
+                            key=lambda doc: doc.metadata.get('relevance', 0.0)
+                        )
+                yield batch
+
+        return await self.run_agents(
+            self.partition_stream(collect(), num_agents, query),
+            query, status_container,
+            on_token=on_token, deadline=deadline, show_agent_details=show_agent_details,
+            use_cache=use_cache, incremental_synthesis=incremental_synthesis, analyses_sink=analyses_sink
+        )
+
+    async def run_agents(self,
+                         workloads: AsyncIterator[List[Post]],
+                         query: str,
+                         status_container,
+                         on_token: Optional[Callable[[str], None]] = None,
+                         deadline: Optional[float] = None,
+                         show_agent_details: bool = False,
+                         use_cache: bool = True,
+                         incremental_synthesis: bool = False,
+                         analyses_sink: Optional[List[str]] = None) -> str:
+        """Lancia un agente per ogni carico appena disponibile e sintetizza le analisi."""
+        cache_token = llm_cache_enabled.set(use_cache)
+        stats_token = context_token_stats.set({})
+        wait_clock = LimiterWaitClock()
+        clock_token = limiter_wait_clock.set(wait_clock)
+        start_time = time.monotonic()
+        running = set()
+        next_workload = None
         try:
-            if not documents:
-                return "Nessun documento da analizzare."
+            if deadline is None:
+                deadline = start_time + self.QUERY_DEADLINE_SECONDS
+            agents_deadline = deadline - self.SYNTHESIS_RESERVE_SECONDS
+
+            def agents_time_left() -> float:
+                # Il tempo in cui la query è ferma sul rate limiter condiviso non
+                # conta come lentezza degli agenti: proroga la deadline, entro un massimo
+                extension = min(wait_clock.stalled_seconds(), self.LIMITER_WAIT_MAX_SECONDS)
+                return agents_deadline + extension - time.monotonic()
 
-            # Get number of agents from session state
-            num_agents = st.session_state.get('num_agents', 3)
-                
-            # Split documents between agents
-            agent_docs = self.split_documents_for_agents(documents, num_agents)
-            status_container.write(f"📦 Documenti divisi tra {len(agent_docs)} agenti")
-            logger.info(f"Documents split between {len(agent_docs)} agents")
-            
             # Create progress tracking
             progress_text = "🔄 Analisi in corso..."
             progress_bar = status_container.progress(0, text=progress_text)
             
-            # Process documents with agents in parallel
-            semaphore = asyncio.Semaphore(self.MAX_PARALLEL_REQUESTS)
+            # Latenze degli agenti completati, usate per decidere gli hedge
+            latencies = []
+
+            # Process documents with agents in parallel (concurrency is bounded
+            # process-wide by the shared rate limiter)
             async def process_with_agent(docs, agent_id):
-                async with semaphore:
-                    result = await self.analyze_with_agent(docs, agent_id, query)
-                    progress = (agent_id + 1) / len(agent_docs)
-                    progress_bar.progress(progress, text=f"{progress_text} ({agent_id + 1}/{len(agent_docs)})")
-                    
-                    if result:
-                        msg = f"✅ Agente #{agent_id + 1}: Analisi completata"
-                        if st.session_state.show_agent_details:
-                            msg += f"\n{result}\n---"
-                        status_container.write(msg)
-                    else:
-                        status_container.warning(f"⚠️ Agente #{agent_id + 1}: Analisi completata con warning")
-                    return result
-
-            # Execute analyses in parallel
-            tasks = [process_with_agent(docs, i) for i, docs in enumerate(agent_docs)]
-            agent_results = await asyncio.gather(*tasks)
+                return agent_id, await self.analyze_with_hedging(docs, agent_id, query, latencies)
+
+            agent_docs, agent_results = [], []
+            completed = 0
+            summary_task = None  # Sintesi progressiva (modalità incrementale)
+            final_folded = False
+            next_workload = asyncio.ensure_future(workloads.__anext__())
+
+            # Ogni agente parte appena il suo carico è pronto e ogni analisi viene
+            # mostrata appena arriva, fino alla deadline degli agenti
+            try:
+                while running or next_workload is not None:
+                    waiting = running | ({next_workload} if next_workload is not None else set())
+                    timeout = agents_time_left()
+                    done = set()
+                    if timeout > 0:
+                        done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        if agents_time_left() > 0:
+                            continue
+                        raise asyncio.TimeoutError
+
+                    if next_workload in done:
+                        try:
+                            docs = next_workload.result()
+                        except StopAsyncIteration:
+                            next_workload = None
+                        else:
+                            agent_docs.append(docs)
+                            agent_results.append(None)
+                            running.add(asyncio.create_task(process_with_agent(docs, len(agent_docs) - 1)))
+                            next_workload = asyncio.ensure_future(workloads.__anext__())
+
+                    for task in done:
+                        if task not in running:
+                            continue
+                        running.discard(task)
+                        agent_id, result = task.result()
+                        agent_results[agent_id] = result
+                        completed += 1
+                        progress_bar.progress(
+                            completed / len(agent_docs),
+                            text=f"{progress_text} ({completed}/{len(agent_docs)})"
+                        )
+
+                        if result:
+                            msg = f"✅ Agente #{agent_id + 1}: Analisi completata"
+                            if show_agent_details:
+                                msg += f"\n{result}\n---"
+                            status_container.write(msg)
+                        else:
+                            status_container.warning(f"⚠️ Agente #{agent_id + 1}: Analisi completata con warning")
+
+                        if incremental_synthesis:
+                            final = next_workload is None and not running
+                            final_folded = final_folded or final
+                            summary_task = asyncio.create_task(self.fold_analysis(
+                                summary_task, result, query, completed,
+                                on_token=on_token if final else None, final=final
+                            ))
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Deadline reached: cancelling {len(running)} of {len(agent_docs)} agents "
+                    f"({wait_clock.stalled_seconds():.1f}s stalled on the rate limiter)"
+                )
+                status_container.warning(f"⏱️ Tempo scaduto: {len(running)} agenti interrotti, sintesi con le analisi completate")
 
             # Filter valid results
             valid_results = [r for r in agent_results if r]
             if not valid_results:
+                if summary_task is not None:
+                    summary_task.cancel()
                 return "Nessun agente ha prodotto un'analisi valida."
 
+            if analyses_sink is not None:
+                analyses_sink.extend(valid_results)
+
+            # Copertura raggiunta: agenti e post effettivamente analizzati
+            total_posts = sum(len(docs) for docs in agent_docs)
+            covered_posts = sum(len(docs) for docs, r in zip(agent_docs, agent_results) if r)
+            coverage = covered_posts / total_posts
+            logger.info(
+                f"Coverage: {len(valid_results)}/{len(agent_docs)} agents, "
+                f"{covered_posts}/{total_posts} posts ({coverage:.0%})"
+            )
+
+            # Token risparmiati dal formato compatto rispetto a quello esteso
+            token_stats = context_token_stats.get()
+            if token_stats:
+                compact_tokens = sum(compact for compact, _ in token_stats.values())
+                verbose_tokens = sum(verbose for _, verbose in token_stats.values())
+                if verbose_tokens:
+                    logger.info(
+                        f"Compact context: {compact_tokens} tokens instead of {verbose_tokens} "
+                        f"({1 - compact_tokens / verbose_tokens:.0%} saved)"
+                    )
+
             # Synthesize results
-            status_container.write("🤖 Agente sintetizzatore al lavoro...")
-            final_result = await self.synthesize_analyses(valid_results, query)
+            if summary_task is not None:
+                # La sintesi progressiva è già quasi pronta: manca al più l'ultimo passaggio
+                status_container.write("🤖 Completamento della sintesi progressiva...")
+                final_result = await summary_task
+                if not final_folded:
+                    final_result = await self.synthesize_analyses([final_result], query, on_token=on_token)
+            else:
+                status_container.write("🤖 Agente sintetizzatore al lavoro...")
+                final_result = await self.synthesize_analyses(valid_results, query, on_token=on_token)
+
+            if len(valid_results) < len(agent_docs):
+                final_result += (
+                    f"\n\n---\n*Copertura parziale: {len(valid_results)}/{len(agent_docs)} agenti, "
+                    f"{covered_posts}/{total_posts} post analizzati ({coverage:.0%}).*"
+                )
 
+            self.record_swarm_latency(time.monotonic() - start_time)
             status_container.write("🏁 Analisi completata!")
             return final_result
 
@@ -348,4 +1404,23 @@ Content: {content}
             error_msg = f"Error in multi-agent processing: {str(e)}"
             logger.error(error_msg)
             status_container.error(f"❌ {error_msg}")
-            return f"Errore nell'elaborazione: {str(e)}"
\ No newline at end of file
+            return f"Errore nell'elaborazione: {str(e)}"
+        finally:
+            # Agenti e retrieval ancora in corso (deadline, errori o cancellazione)
+            pending = list(running) + ([next_workload] if next_workload is not None else [])
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await workloads.aclose()
+            limiter_wait_clock.reset(clock_token)
+            context_token_stats.reset(stats_token)
+            llm_cache_enabled.reset(cache_token)
+
+
+def get_swarm() -> OpenAISwarm:
+    """Restituisce lo swarm condiviso dal processo."""
+    global _swarm
+    with _swarm_lock:
+        if _swarm is None:
+            _swarm = OpenAISwarm()
+        return _swarm
@@ -97,4 +97,82 @@ Usa la formattazione per:
 - Citazioni significative con '>'
 - Concetti chiave in **grassetto**
 - Trend con emoji appropriate
-Fornisci una sintesi coerente e supportata dai dati.""" 
\ No newline at end of file
+Fornisci una sintesi coerente e supportata dai dati.""" 
+
+# Template per le risposte alle domande di aggregazione (calcolate sul catalogo)
+aggregate_template = """Sei un assistente esperto nell'analisi di conversazioni dei forum.
+I numeri seguenti sono stati calcolati in modo esatto sui post del database,
+limitati ai filtri indicati nel titolo della tabella (tutti i post se non ce ne sono).
+
+{table}
+
+Domanda: {query}
+
+Rispondi in modo preciso e conciso usando esclusivamente i numeri della tabella.
+Non inventare dati e non ricalcolare i valori. Usa **grassetto** per i numeri chiave."""
+
+
+# Template per gli agenti riduttori (sintesi parziali nel tree-reduce)
+reducer_role_desc = """Fondi un gruppo di analisi parziali in un'unica analisi intermedia che
+verrà a sua volta sintetizzata con altre. Conserva:
+- Dati concreti, numeri e timestamp
+- Citazioni più significative
+- Trend, pattern e contraddizioni tra le analisi"""
+
+reducer_instructions = """Produci un'analisi intermedia compatta:
+- Elimina le ripetizioni tra le analisi
+- Non perdere fatti rilevanti per la domanda
+- Mantieni le citazioni chiave con '>'
+Non scrivere introduzioni o conclusioni: il testo sarà fuso con altre analisi."""
+
+
+# Legenda del formato compatto del contesto degli agenti analizzatori
+compact_context_legend = """Formato: "## titolo (inizio)" apre ogni thread; "#n autore +tempo | kw: keyword | s=sentiment" apre ogni post, con il tempo relativo al primo post del thread (m=minuti, h=ore, d=giorni).
+"↪#n" indica che il post cita il post #n; "> autore: testo" è una citazione di un post non presente.
+"#n sintesi del thread" riassume i post di un thread non riportati per intero."""
+
+
+# Template per le sintesi dei thread calcolate all'ingestione
+thread_summary_template = """Sei un assistente esperto nell'analisi di conversazioni dei forum.
+Riassumi il thread "{title}" in modo conciso (massimo 200 parole) indicando:
+- Fatti chiave, domande e conclusioni della discussione
+- Evoluzione del sentiment dall'inizio alla fine
+- Partecipanti principali e le loro posizioni
+
+La sintesi sostituirà i post originali nelle analisi successive: includi date e numeri rilevanti.
+
+{context}"""
+
+
+# Template per la risposta rapida della cascata (una sola chiamata sui post più rilevanti)
+cascade_template = """Sei un assistente esperto nell'analisi di conversazioni dei forum.
+Rispondi alla domanda usando solo i {included} post più rilevanti (su {total} recuperati) riportati sotto.
+
+La PRIMA riga della risposta deve essere esattamente "CONFIDENZA: N", con N da 0 a 100:
+- alta se i post contengono tutto il necessario per una risposta completa e precisa
+- bassa se servono più post, un confronto tra molti thread o un'analisi di trend
+
+Dalla seconda riga scrivi la risposta, concisa e supportata da citazioni dei post.
+
+{context}
+
+Domanda: {query}"""
+
+
+# Template per le domande di follow-up (una sola chiamata sul turno precedente)
+follow_up_template = """Sei un assistente esperto nell'analisi di conversazioni dei forum.
+La nuova domanda prosegue la conversazione precedente: rispondi usando le analisi
+e i post già raccolti, senza ripetere la risposta precedente.
+
+Domanda precedente: {previous_query}
+
+Risposta precedente:
+{previous_answer}
+
+Analisi degli agenti sul turno precedente:
+{analyses}
+
+Post rilevanti{filter_note}:
+{context}
+
+Rispondi in modo preciso alla nuova domanda, con citazioni dei post quando utili."""
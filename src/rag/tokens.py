@@ -0,0 +1,43 @@
+import logging
+from functools import lru_cache
+import tiktoken
+from config import TOKENIZER_MODEL, TOKEN_CACHE_SIZE, LLM_EXPECTED_COMPLETION_TOKENS
+
+logger = logging.getLogger(__name__)
+
+_tokenizer = None
+
+def get_tokenizer():
+    """Restituisce l'encoder tiktoken condiviso dal processo."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    return _tokenizer
+
+def count_text_tokens(text: str) -> int:
+    """Conta i token di un testo senza cache (contenuti dei post, prompt interi)."""
+    try:
+        return len(get_tokenizer().encode(text))
+    except Exception as e:
+        logger.error(f"Error counting tokens: {str(e)}")
+        return len(text) // 4  # Fallback approssimativo
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """Conta i token di un testo breve e ricorrente; i risultati restano in una cache LRU di processo."""
+    return count_text_tokens(text)
+
+def count_prompt_tokens(messages) -> int:
+    """Conta i token del prompt di una richiesta chat."""
+    # ~4 token di overhead per messaggio nel formato chat; i prompt non entrano nella cache
+    return sum(count_text_tokens(message.content) + 4 for message in messages)
+
+def expected_completion_tokens(max_tokens: int = 0) -> int:
+    """Token di risposta da prenotare: la lunghezza attesa, non il massimo consentito."""
+    if not max_tokens:
+        return LLM_EXPECTED_COMPLETION_TOKENS
+    return min(max_tokens, LLM_EXPECTED_COMPLETION_TOKENS)
+
+def estimate_request_tokens(messages, max_tokens: int = 0) -> int:
+    """Stima i token di una richiesta chat: prompt più risposta attesa."""
+    return count_prompt_tokens(messages) + expected_completion_tokens(max_tokens)
@@ -1,4 +1,5 @@
 import streamlit as st
+from config import RERANK_ENABLED, LLM_CACHE_ENABLED
 
 def apply_custom_styles():
     """Apply custom styles to the Streamlit app."""
@@ -213,6 +214,12 @@ def render_sidebar():
         st.session_state.num_agents = 3
     if 'show_agent_details' not in st.session_state:
         st.session_state.show_agent_details = False
+    if 'incremental_synthesis' not in st.session_state:
+        st.session_state.incremental_synthesis = False
+    if 'use_reranker' not in st.session_state:
+        st.session_state.use_reranker = RERANK_ENABLED
+    if 'use_llm_cache' not in st.session_state:
+        st.session_state.use_llm_cache = LLM_CACHE_ENABLED
         
     def nav_to(page):
         st.session_state.current_page = page
@@ -232,12 +239,12 @@ def render_sidebar():
     
     # Number of agents slider
     num_agents = st.sidebar.slider(
-        "Numero di agenti analisti",
+        "Numero massimo di agenti analisti",
         min_value=3,
         max_value=10,
         value=st.session_state.num_agents,
         step=1,
-        help="Aumenta il numero di agenti se l'analisi va in overflow di token"
+        help="Gli agenti vengono assegnati in base ai token dei documenti; questo è il limite massimo"
     )
     if num_agents != st.session_state.num_agents:
         st.session_state.num_agents = num_agents
@@ -251,6 +258,33 @@ def render_sidebar():
     if show_details != st.session_state.show_agent_details:
         st.session_state.show_agent_details = show_details
     
+    # Incremental synthesis toggle
+    incremental_synthesis = st.sidebar.toggle(
+        "Sintesi progressiva",
+        value=st.session_state.incremental_synthesis,
+        help="Fonde ogni analisi in una sintesi man mano che gli agenti terminano"
+    )
+    if incremental_synthesis != st.session_state.incremental_synthesis:
+        st.session_state.incremental_synthesis = incremental_synthesis
+    
+    # Cross-encoder re-ranking toggle
+    use_reranker = st.sidebar.toggle(
+        "Re-ranking dei risultati",
+        value=st.session_state.use_reranker,
+        help="Riordina i post recuperati con un cross-encoder locale (entro un budget di tempo)"
+    )
+    if use_reranker != st.session_state.use_reranker:
+        st.session_state.use_reranker = use_reranker
+    
+    # LLM response cache toggle
+    use_llm_cache = st.sidebar.toggle(
+        "Cache delle risposte",
+        value=st.session_state.use_llm_cache,
+        help="Riusa le analisi e le sintesi già calcolate per richieste identiche"
+    )
+    if use_llm_cache != st.session_state.use_llm_cache:
+        st.session_state.use_llm_cache = use_llm_cache
+    
     st.sidebar.markdown('</div>', unsafe_allow_html=True)
     
     # Navigation menu
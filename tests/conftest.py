@@ -0,0 +1,5 @@
+import os
+import sys
+
+# I moduli dell'app si importano come top-level da src (come con streamlit run src/app.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,73 @@
+import pytest
+from langchain_core.documents import Document
+from rag import swarm as swarm_module
+
+QUERY = "Cosa pensano gli utenti delle nuove schede video?"
+
+@pytest.fixture
+def swarm(monkeypatch):
+    # Nessun client reale: il test usa solo tokenizzazione, impacchettamento e formattazione
+    monkeypatch.setattr(swarm_module, "get_llm", lambda *args, **kwargs: None)
+    monkeypatch.setattr(swarm_module, "get_response_cache", lambda: None)
+    swarm = swarm_module.OpenAISwarm()
+    # Tokenizzatore deterministico (~4 caratteri per token): il test non dipende dagli encoding di tiktoken
+    swarm.count_tokens = lambda text: -(-len(text) // 4)
+    swarm.count_content_tokens = swarm.count_tokens
+    return swarm
+
+def make_posts(threads: int, posts_per_thread: int):
+    # Nomi brevi e una citazione per post: ogni autore ricorre e la legenda degli alias costa più di quanto fa risparmiare
+    authors = [f"u{i}" for i in range(160)]
+    documents = []
+    for t in range(threads):
+        for p in range(posts_per_thread):
+            author = authors[(t * 7 + p) % len(authors)]
+            quoted = authors[(t * 7 + p + 3) % len(authors)]
+            documents.append(Document(
+                page_content=f"Post {p} del thread {t}: " + "la scheda scalda parecchio sotto carico " * (5 + p % 9),
+                metadata={
+                    "thread_id": f"thread-{t}",
+                    "thread_title": f"Discussione sulle GPU numero {t}",
+                    "author": author,
+                    "post_epoch": 1_700_000_000 + t * 86_400 + p * 600,
+                    "keywords": ["gpu", "temperature"],
+                    "sentiment": -0.25,
+                    "quoted_author": quoted,
+                    "quoted_content": f"testo citato {p}",
+                    "relevance": 1.0
+                }
+            ))
+    return documents
+
+def test_packed_agents_format_every_assigned_post(swarm):
+    # Thread più grandi di un agente: i pezzi riempiono gli agenti fino al limite
+    documents = make_posts(threads=4, posts_per_thread=150)
+    agents = swarm.split_documents_for_agents(documents, num_agents=20, query=QUERY)
+    budget = swarm.agent_context_budget(QUERY)
+
+    assert len(agents) > 1
+    assert sum(len(docs) for docs in agents) == len(documents)
+    fullest = 0
+    for docs in agents:
+        _, tokens, included = swarm.format_documents_with_tokens(docs, budget)
+        assert included == docs
+        assert tokens <= budget
+        fullest = max(fullest, tokens)
+    # Almeno un agente deve essere quasi pieno perché il test verifichi il limite
+    assert fullest > budget * 0.9
+
+def test_precomputed_content_tokens_skip_tokenization(swarm):
+    # Post ingeriti con i conteggi salvati: il contenuto non passa dal tokenizzatore
+    documents = make_posts(threads=1, posts_per_thread=3)
+    for doc in documents:
+        doc.metadata["content_tokens"] = swarm.count_tokens(doc.page_content.strip())
+        doc.metadata["quote_tokens"] = swarm.count_tokens(doc.metadata["quoted_content"])
+    expected = [swarm.count_post_tokens(doc) for doc in documents]
+
+    def fail(text):
+        raise AssertionError("content tokenized again")
+
+    swarm.count_content_tokens = fail
+    assert [swarm.count_post_tokens(doc) for doc in documents] == expected
+    _, _, included = swarm.format_documents_with_tokens(documents)
+    assert included == documents